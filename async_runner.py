@@ -0,0 +1,577 @@
+#!/usr/bin/env python3
+
+"""
+Run one or more ArduSub simulations on an asyncio event loop.
+
+This does the same thing as sitl_runner.py, but MAVLink receive, RC output, rangefinder injection and STATUSTEXT
+logging are separate coroutines on one loop, and every wait has a timeout. Several vehicles can be driven
+from one process, each in its own directory (instance0, instance1, ...):
+
+    async_runner.py --instance 0 1 2 --terrain terrain/sawtooth.csv --speedup 20 --time 150
+"""
+
+import argparse
+import asyncio
+import contextlib
+import os
+import socket
+import struct
+import time
+from typing import Callable, Optional
+
+from pymavlink.dialects.v20 import ardupilotmega as apm2
+
+import mavutil2
+import mission_protocol
+from gen_terrain import DROPOUT, LOW_SIGNAL_QUALITY
+from run_log import RunLog
+from scheduler import DeadlineScheduler
+from param_cache import ParamCache
+from noise import SensorNoise
+from sitl_runner import SimRunner, SubZHistory, ardusub_files, calc_rf, fake_sub_file, mavlink_port, rc_port, \
+    send_distance_sensor_msg, start_ardusub, start_fake_sub, write_run_metadata
+from terrain import open_terrain
+
+# Timeout for each startup step, in seconds of wall time
+STEP_TIMEOUT = 30.0
+
+# Timeout for (re)connecting to ArduSub, in seconds of wall time
+CONNECT_TIMEOUT = 10.0
+
+
+class MissionUploadFailedException(Exception):
+    pass
+
+
+class AsyncLink:
+    """
+    A MAVLink connection to ArduSub. The receive() coroutine parses incoming messages and hands them to handlers,
+    waiters and listeners.
+    """
+
+    def __init__(self, port: int):
+        self.address = ('127.0.0.1', port)
+        self.sock: Optional[socket.socket] = None
+
+        # The MAVLink object writes to self.write()
+        self.mav = apm2.MAVLink(self, srcSystem=255, srcComponent=0)
+        self.mav.robust_parsing = True
+
+        self.target_system = 1
+        self.target_component = 1
+        self.armed = False
+
+        # Handlers are called for every message of a type
+        self.handlers: dict[str, list[Callable]] = {}
+
+        # Waiters are (types, condition, future) tuples, each future gets the first matching message
+        self.waiters: list[tuple[list[str], Optional[Callable], asyncio.Future]] = []
+
+        # Listeners are (types, queue) tuples, each queue gets all matching messages
+        self.listeners: list[tuple[list[str], asyncio.Queue]] = []
+
+    def write(self, buf: bytes):
+        if self.sock is not None:
+            try:
+                self.sock.send(buf)
+            except OSError:
+                # Dropped, receive() will reconnect
+                pass
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + CONNECT_TIMEOUT
+        while True:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            try:
+                await loop.sock_connect(sock, self.address)
+                self.sock = sock
+                return
+            except OSError:
+                sock.close()
+                if loop.time() > deadline:
+                    raise TimeoutError(f'Could not connect to {self.address}')
+                await asyncio.sleep(0.2)
+
+    async def receive(self):
+        """
+        Receive and dispatch messages until cancelled
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                data = await loop.sock_recv(self.sock, 4096)
+            except OSError:
+                data = b''
+
+            if len(data) == 0:
+                # ArduSub closes the connection when it reboots
+                self.sock.close()
+                self.sock = None
+                await self.connect()
+                continue
+
+            for msg in self.mav.parse_buffer(data) or []:
+                self.dispatch(msg)
+
+    def dispatch(self, msg):
+        msg_type = msg.get_type()
+        if msg_type == 'BAD_DATA':
+            return
+
+        msg._timestamp = time.time()
+
+        if msg_type == 'HEARTBEAT' and msg.type != apm2.MAV_TYPE_GCS:
+            self.armed = (msg.base_mode & apm2.MAV_MODE_FLAG_SAFETY_ARMED) != 0
+
+        for handler in self.handlers.get(msg_type, []):
+            handler(msg)
+
+        for types, queue in self.listeners:
+            if msg_type in types:
+                queue.put_nowait(msg)
+
+        for waiter in list(self.waiters):
+            types, condition, future = waiter
+            if msg_type in types and not future.done() and (condition is None or condition(msg)):
+                future.set_result(msg)
+                self.waiters.remove(waiter)
+
+    def subscribe(self, msg_type: str, handler: Callable):
+        self.handlers.setdefault(msg_type, []).append(handler)
+
+    async def recv(self, types: str or list[str], timeout: float, condition: Optional[Callable] = None):
+        """
+        Wait for the next message that matches, raise TimeoutError if it doesn't arrive in time
+        """
+        waiter = ([types] if isinstance(types, str) else types, condition, asyncio.get_running_loop().create_future())
+        self.waiters.append(waiter)
+        try:
+            return await asyncio.wait_for(waiter[2], timeout)
+        finally:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+
+    @contextlib.contextmanager
+    def listen(self, types: str or list[str]):
+        """
+        Queue every matching message while the context is active. Use this for exchanges where several replies can
+        arrive back-to-back, e.g., PARAM_VALUE.
+        """
+        listener = ([types] if isinstance(types, str) else types, asyncio.Queue())
+        self.listeners.append(listener)
+        try:
+            yield listener[1]
+        finally:
+            self.listeners.remove(listener)
+
+    def command_long_send(self, command: int, *params: float):
+        params = list(params) + [0] * (7 - len(params))
+        self.mav.command_long_send(self.target_system, self.target_component, command, 0, *params)
+
+    def set_mode(self, mode: int):
+        self.command_long_send(apm2.MAV_CMD_DO_SET_MODE, apm2.MAV_MODE_FLAG_CUSTOM_MODE_ENABLED, mode)
+
+    def arm(self):
+        self.command_long_send(apm2.MAV_CMD_COMPONENT_ARM_DISARM, 1)
+
+
+class AsyncVehicle:
+    """
+    Manage a simulation, see SimRunner
+    """
+
+    def __init__(self, args, instance: int, log_dir: str):
+        self.speedup = args.speedup
+        self.duration = args.time
+        self.terrain_spec = args.terrain
+        self.terrain = open_terrain(args.terrain)
+
+        # Each vehicle gets its own noise stream, seed + instance if there is a seed
+        self.noise = SensorNoise(args.noise, None if args.seed is None else args.seed + instance)
+        self.delay = args.delay
+        self.heavy = args.heavy
+        self.depth = args.depth
+        self.mission = args.mission
+        self.mode = args.mode
+        self.params_file = args.params
+        self.cold = args.cold
+        self.fake = args.fake
+        self.overrun = args.overrun
+        self.log_batch = args.log_batch
+        self.npz = args.npz
+        self.crash_safe = args.crash_safe
+        self.instance = instance
+        self.log_dir = log_dir
+
+        self.link = AsyncLink(mavlink_port(instance))
+        self.clock: Optional[mavutil2.LockedSimClock] = None
+        self.sub_z_history = SubZHistory(self.delay)
+        self.history_ready = asyncio.Event()
+        self.channels = [1500] * 6 + [1000] * 10
+        self.statustext_queue = asyncio.Queue()
+        self.process = None
+        self.param_cache: Optional[ParamCache] = None
+        self.warm = False
+
+    def print(self, message):
+        sim_time = self.clock.rough_time_s() if self.clock else 0.0
+        print(f'[{self.instance}] [{sim_time :.2f}] {message}')
+
+    # Handlers, called by AsyncLink.dispatch()
+
+    def on_position(self, msg):
+        self.clock.update(msg.time_boot_ms, msg._timestamp)
+        self.sub_z_history.add(msg.time_boot_ms * 0.001, msg.relative_alt * 0.001)
+        if self.sub_z_history.length_s() > self.delay:
+            self.history_ready.set()
+
+    def on_system_time(self, msg):
+        self.clock.update(msg.time_boot_ms, msg._timestamp)
+
+    def on_timesync(self, msg):
+        self.clock.handle_timesync(msg)
+
+    # Coroutines
+
+    async def log_statustext(self):
+        while True:
+            msg = await self.statustext_queue.get()
+            self.print(f'{SimRunner.severity_name(msg.severity)}: {msg.text}')
+
+    async def send_rc(self):
+        """
+        Send RC input to ArduSub every 0.1s of sim time
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        try:
+            while True:
+                sock.sendto(struct.pack('<16H', *self.channels), ('127.0.0.1', rc_port(self.instance)))
+                await asyncio.sleep(0.1 / (self.clock.rate if self.clock else self.speedup))
+        finally:
+            sock.close()
+
+    async def inject_rangefinder(self):
+        """
+        Send rf readings until we reach the time limit
+        """
+        self.print('Send rangefinder readings')
+
+        # Bootstrap: wait for enough history
+        await asyncio.wait_for(self.history_ready.wait(), STEP_TIMEOUT)
+
+        scheduler = DeadlineScheduler(self.clock, self.terrain.interval, self.overrun)
+        scheduler.start()
+
+        # Index of the next terrain reading, skips forward if the scheduler skipped deadlines
+        index = 0
+        count_readings = 0
+
+        write_run_metadata(os.path.join(self.log_dir, 'run.json'), self.noise, terrain=self.terrain_spec,
+                           duration=self.duration, delay=self.delay, depth=self.depth, mode=self.mode)
+
+        with RunLog(os.path.join(self.log_dir, 'stamped_terrain.csv'), self.log_batch, npz=self.npz,
+                    crash_safe=self.crash_safe) as run_log:
+            while True:
+                self.clock.send_timesync(self.link)
+
+                delayed_time = self.clock.monotonic_time_s() - self.delay
+                sub_z = self.sub_z_history.get(delayed_time)
+                assert sub_z is not None
+
+                terrain_z = self.terrain[index]
+
+                if terrain_z == DROPOUT:
+                    rf_cm, signal_quality = -1, -1
+
+                elif terrain_z == LOW_SIGNAL_QUALITY:
+                    rf_cm, signal_quality = 555, 10
+                    send_distance_sensor_msg(self.link, rf_cm, signal_quality)
+
+                else:
+                    rf, signal_quality = calc_rf(terrain_z, sub_z, self.noise)
+                    rf_cm = int(rf * 100.0)
+                    send_distance_sensor_msg(self.link, rf_cm, signal_quality)
+
+                run_log.append(int(delayed_time * 1000000), terrain_z * 100.0, sub_z * 100.0, rf_cm, signal_quality)
+
+                count_readings += 1
+                if count_readings == 10:
+                    self.print(f'Set mode to {self.mode}')
+                    self.link.set_mode(self.mode)
+
+                index += 1 + await scheduler.wait_async()
+
+                if self.clock.rough_time_s() > self.duration:
+                    scheduler.write_stats(os.path.join(self.log_dir, 'injection_stats.json'))
+                    return
+
+    # Startup steps
+
+    async def verify_params(self, params: mavutil2.ParameterList, send: Callable):
+        """
+        Run a mavutil2.ParamExchange on the event loop
+        """
+        loop = asyncio.get_running_loop()
+        exchange = mavutil2.ParamExchange(params, send)
+        with self.link.listen('PARAM_VALUE') as queue:
+            while not exchange.done():
+                exchange.pump(loop.time())
+                try:
+                    exchange.handle(await asyncio.wait_for(queue.get(), exchange.next_timeout(loop.time())))
+                except TimeoutError:
+                    pass
+        params.check()
+
+    async def fetch_param_list(self) -> dict[str, float]:
+        """
+        Collect all parameters, see mavutil2.fetch_param_list
+        """
+        link = self.link
+        values: dict[int, tuple[str, float]] = {}
+        count = None
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + STEP_TIMEOUT
+
+        with link.listen('PARAM_VALUE') as queue:
+            link.mav.param_request_list_send(link.target_system, link.target_component)
+            while count is None or len(values) < count:
+                if loop.time() > deadline:
+                    raise TimeoutError(f'PARAM_REQUEST_LIST got {len(values)} of {count} parameters')
+                try:
+                    msg = await asyncio.wait_for(queue.get(), 0.2)
+                except TimeoutError:
+                    if count is None:
+                        link.mav.param_request_list_send(link.target_system, link.target_component)
+                    else:
+                        missing = [i for i in range(count) if i not in values][:mavutil2.ParamExchange.WINDOW]
+                        for i in missing:
+                            link.mav.param_request_read_send(link.target_system, link.target_component, b'', i)
+                    continue
+                if msg.param_index < msg.param_count:
+                    count = msg.param_count
+                    values[msg.param_index] = (msg.param_id, msg.param_value)
+
+        return dict(values.values())
+
+    async def get_boot_count(self) -> int:
+        with self.link.listen('PARAM_VALUE') as queue:
+            self.link.mav.param_request_read_send(self.link.target_system, self.link.target_component,
+                                                  b'STAT_BOOTCNT', -1)
+            while True:
+                msg = await asyncio.wait_for(queue.get(), 1.0)
+                if msg.param_id == 'STAT_BOOTCNT':
+                    return int(msg.param_value)
+
+    async def reboot(self):
+        """
+        Reboot the autopilot and verify that it actually happened, see mavutil2.reboot_autopilot
+        """
+        prev_boot_count = await self.get_boot_count()
+        self.link.command_long_send(apm2.MAV_CMD_PREFLIGHT_REBOOT_SHUTDOWN, 1)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + STEP_TIMEOUT
+        while loop.time() < deadline:
+            try:
+                await self.link.recv('HEARTBEAT', 1.0)
+                curr_boot_count = await self.get_boot_count()
+            except TimeoutError:
+                continue
+            if curr_boot_count - prev_boot_count == 1:
+                self.print(f'STAT_BOOTCNT was {prev_boot_count}, now {curr_boot_count}, reboot detected')
+                return
+            elif curr_boot_count != prev_boot_count:
+                break
+        raise mavutil2.RebootFailedException(f'STAT_BOOTCNT was {prev_boot_count}, reboot not detected')
+
+    async def upload_mission(self):
+        """
+        Upload a mission using the mission protocol, see mission_protocol.upload_using_mission_protocol
+        """
+        items = mission_protocol.mission_from_path(self.mission)
+        mission_type = apm2.MAV_MISSION_TYPE_MISSION
+        with self.link.listen(['MISSION_REQUEST', 'MISSION_REQUEST_INT', 'MISSION_ACK']) as queue:
+            self.link.mav.mission_count_send(self.link.target_system, self.link.target_component, len(items),
+                                             mission_type)
+            while True:
+                msg = await asyncio.wait_for(queue.get(), STEP_TIMEOUT)
+                if msg.get_type() == 'MISSION_ACK':
+                    if msg.type == apm2.MAV_MISSION_ACCEPTED and msg.mission_type == mission_type:
+                        self.print(f'Upload of all {len(items)} items succeeded')
+                        return
+                    raise MissionUploadFailedException(f'Unexpected MISSION_ACK {str(msg)}')
+                if msg.seq >= len(items) or msg.mission_type != mission_type:
+                    raise MissionUploadFailedException(f'Bad request {str(msg)}')
+                self.link.mav.send(items[msg.seq])
+
+    async def startup(self):
+        self.print('Wait for HEARTBEAT')
+        await self.link.recv('HEARTBEAT', STEP_TIMEOUT)
+
+        param_list = mavutil2.ParameterList(self.params_file)
+        if self.warm:
+            self.print('Compare parameters')
+            current = await self.fetch_param_list()
+            drift = self.param_cache.drift(current)
+            if drift:
+                self.print(f'{len(drift)} parameters changed since the snapshot: {", ".join(drift)}')
+            stale = param_list.compare(current)
+        else:
+            stale = param_list
+
+        if len(stale.params) == 0:
+            self.print(f'All {len(param_list.params)} parameters match, skip reboot')
+        else:
+            self.print(f'Set {len(stale.params)} parameters')
+            await self.verify_params(stale, lambda p: self.link.mav.param_set_send(
+                self.link.target_system, self.link.target_component, p.param_id.encode(), p.param_value,
+                apm2.MAV_PARAM_TYPE_REAL32))
+
+            self.print('Reboot')
+            await self.reboot()
+
+            self.print('Fetch parameters')
+            await self.verify_params(param_list, lambda p: self.link.mav.param_request_read_send(
+                self.link.target_system, self.link.target_component, p.param_id.encode(), -1))
+
+            self.print('Save parameter snapshot')
+            self.param_cache.save(await self.fetch_param_list())
+
+        self.print('Set message intervals')
+        for msg_type, msg_rate in SimRunner.REQUEST_MSGS.items():
+            mavutil2.set_message_interval(self.link, msg_type, msg_rate)
+
+        self.print('Wait for GPS fix')
+        await self.link.recv('GPS_RAW_INT', STEP_TIMEOUT, lambda m: m.fix_type >= 3 and m.lat != 0)
+
+        if self.mission:
+            self.print('Upload mission')
+            await self.upload_mission()
+
+        self.print('Start sim clock')
+        gpi_msg = await self.link.recv('GLOBAL_POSITION_INT', STEP_TIMEOUT)
+        self.clock = mavutil2.LockedSimClock(self.speedup)
+        self.clock.update(gpi_msg.time_boot_ms, gpi_msg._timestamp)
+        self.link.subscribe('GLOBAL_POSITION_INT', self.on_position)
+        self.link.subscribe('SYSTEM_TIME', self.on_system_time)
+        self.link.subscribe('TIMESYNC', self.on_timesync)
+
+    async def dive(self):
+        self.print('Set mode to DEPTH_HOLD')
+        self.link.set_mode(2)
+
+        self.print('Arm')
+        self.link.arm()
+        await self.link.recv('HEARTBEAT', STEP_TIMEOUT,
+                             lambda m: (m.base_mode & apm2.MAV_MODE_FLAG_SAFETY_ARMED) != 0)
+
+        self.print(f'Dive to {self.depth}m')
+        with self.link.listen('VFR_HUD') as queue:
+            alt = (await asyncio.wait_for(queue.get(), STEP_TIMEOUT)).alt
+            descend = alt > self.depth
+            self.channels[2] = 1300 if descend else 1700
+            while (alt > self.depth and descend) or (alt < self.depth and not descend):
+                alt = (await asyncio.wait_for(queue.get(), STEP_TIMEOUT)).alt
+            self.channels[2] = 1500
+
+        # Wait for the EKF to produce a good solution (required for CIRCLE and AUTO)
+        self.print('Wait for EKF solution')
+        await asyncio.sleep(self.clock.wall_time_until(self.clock.rough_time_s() + 25))
+
+    async def run(self):
+        os.makedirs(self.log_dir, exist_ok=True)
+
+        # Keep the parameters in eeprom from the last run if they match the snapshot, see param_cache.py
+        self.param_cache = ParamCache(self.params_file,
+                                      [fake_sub_file()] if self.fake else list(ardusub_files(self.heavy)),
+                                      'eeprom.json' if self.fake else 'eeprom.bin', self.log_dir)
+        self.warm = self.param_cache.is_warm() and not self.cold
+        if not self.warm:
+            self.param_cache.invalidate()
+
+        if self.fake:
+            self.print(f'Start fake_sub.py instance {self.instance}{", warm start" if self.warm else ""}')
+            self.process = start_fake_sub(self.speedup, self.instance, self.log_dir, wipe=not self.warm)
+        else:
+            self.print(f'Start ArduSub instance {self.instance}{", warm start" if self.warm else ""}')
+            self.process = start_ardusub(self.speedup, self.heavy, self.instance, self.log_dir, wipe=not self.warm)
+
+        try:
+            self.print('Connect to ArduSub')
+            await self.link.connect()
+
+            self.link.subscribe('STATUSTEXT', self.statustext_queue.put_nowait)
+
+            async with asyncio.TaskGroup() as tg:
+                background = [
+                    tg.create_task(self.link.receive()),
+                    tg.create_task(self.log_statustext()),
+                ]
+
+                await self.startup()
+
+                background.append(tg.create_task(self.send_rc()))
+
+                await self.dive()
+                await self.inject_rangefinder()
+                self.print('Time limit reached')
+
+                for task in background:
+                    task.cancel()
+        finally:
+            self.print('Stop ArduSub')
+            self.process.terminate()
+            await asyncio.to_thread(self.process.wait)
+
+
+async def run_vehicles(vehicles: list[AsyncVehicle]) -> bool:
+    results = await asyncio.gather(*[vehicle.run() for vehicle in vehicles], return_exceptions=True)
+    ok = True
+    for vehicle, result in zip(vehicles, results):
+        if isinstance(result, BaseException):
+            vehicle.print(f'Failed: {repr(result)}')
+            ok = False
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('--speedup', type=float, default=1.0, help='SIM_SPEEDUP value')
+    parser.add_argument('--time', type=int, default=60, help='How long to run the simulation')
+    parser.add_argument('--terrain', type=str, default='terrain/zeros.csv', help='terrain file or stream:<name>')
+    parser.add_argument('--delay', type=float, default=0.3, help='Sensor delay in seconds, default 0.3')
+    parser.add_argument('--heavy', action='store_true', help='Use heavy (6dof) config')
+    parser.add_argument('--depth', type=float, default=-10.0, help='Run depth, default -10m')
+    parser.add_argument('--mission', type=str, default=None, help='Upload mission items')
+    parser.add_argument('--mode', type=int, default=21, help='Mode, default 21 (surftrak)')
+    parser.add_argument('--params', type=str, default='params/sitl.params', help='Params file')
+    parser.add_argument('--instance', type=int, nargs='+', default=[0], help='SITL instance numbers, default 0')
+    parser.add_argument('--fake', action='store_true', help='Run against fake_sub.py instead of ArduSub')
+    parser.add_argument('--overrun', type=str, default=DeadlineScheduler.CATCH_UP, choices=DeadlineScheduler.POLICIES,
+                        help='What to do when a reading misses its deadline, default catch-up')
+    parser.add_argument('--log-batch', type=int, default=100, help='Rows per stamped_terrain.csv write, default 100')
+    parser.add_argument('--npz', action='store_true', help='Also write stamped_terrain.npz')
+    parser.add_argument('--crash-safe', action='store_true', help='fsync stamped_terrain.csv after every batch')
+    parser.add_argument('--cold', action='store_true', help='Ignore the parameter snapshot, always wipe and reboot')
+    parser.add_argument('--noise', type=str, action='append', default=None,
+                        help='Rangefinder noise model, may be repeated, default gaussian,sigma=0.05, see noise.py')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Noise seed, each instance adds its instance number, default random')
+    args = parser.parse_args()
+
+    # Give each vehicle its own directory if there are several
+    if len(args.instance) == 1:
+        vehicles = [AsyncVehicle(args, args.instance[0], '.')]
+    else:
+        vehicles = [AsyncVehicle(args, instance, f'instance{instance}') for instance in args.instance]
+
+    if not asyncio.run(run_vehicles(vehicles)):
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
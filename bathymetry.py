@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+"""
+Georeferenced bathymetry: the seafloor height at a latitude and longitude, for position-dependent rangefinder readings.
+
+A bathymetry directory has bathymetry.json and a grid of square tiles in tiles/<row>_<col>.npy. The grid is a local
+north/east plane around the origin (the south-west corner), one float32 seafloor z (m, up) every resolution meters.
+Each tile repeats the first row and column of its neighbors, so the 4 corners of every cell are in one tile.
+
+Tiles are memory-mapped on first use and kept in an LRU cache, so a survey area much larger than memory is fine.
+Lookups use bilinear interpolation; a lookup in the same tile as the last one costs a few microseconds.
+
+slant_range() follows the rangefinder beam from the sub to the seafloor, taking roll, pitch and yaw into account. The
+beam moves in steps of at most the clearance over the steepest slope of the grid (bathymetry.json max_slope), so it
+can't pass through the seafloor, and a vertical beam hits it in one step.
+
+Example, make a 2km x 2km fractal seabed around the SITL home location, 1m resolution:
+    bathymetry.py make bathy --size 2000 --resolution 1 --sigma 2 --seed 3
+    sitl_runner.py --bathymetry bathy --mission mission/fr10.txt ...
+
+Example, import a grid from a survey, rows south to north, columns west to east:
+    bathymetry.py import survey.npy bathy --lat 47.6 --lon -122.35 --resolution 0.5
+"""
+
+import argparse
+import collections
+import json
+import math
+import os
+import shutil
+import time
+
+import numpy as np
+
+INDEX_FILE = 'bathymetry.json'
+DEFAULT_TILE_SIZE = 256
+DEFAULT_CACHE_TILES = 64
+
+# Same as sitl_runner.distance_m()
+EARTH_RADIUS_M = 6371000.0
+
+# Ray march: stop within this distance of the seafloor, give up after this many steps
+HIT_TOLERANCE_M = 0.001
+MAX_STEPS = 64
+
+
+def fractal_surface(rows: int, cols: int, beta: float, rng: np.random.Generator) -> np.ndarray:
+    """
+    2D version of gen_terrain.fractal_noise(): zero mean, unit standard deviation, 1/f^beta
+    """
+    spectrum = np.fft.rfft2(rng.standard_normal((rows, cols)))
+    f = np.hypot(*np.meshgrid(np.fft.fftfreq(rows), np.fft.rfftfreq(cols), indexing='ij'))
+    f[0, 0] = 1.0
+    spectrum *= f ** (-beta / 2)
+    spectrum[0, 0] = 0.0
+    surface = np.fft.irfft2(spectrum, (rows, cols))
+    std = surface.std()
+    return surface / std if std > 0 else surface
+
+
+def write_bathymetry(out_dir: str, z: np.ndarray, origin_lat: float, origin_lon: float, resolution: float,
+                     tile_size: int = DEFAULT_TILE_SIZE):
+    """
+    Split a grid of seafloor z, rows south to north and columns west to east, into tiles
+    """
+    z = np.asarray(z, dtype=np.float32)
+    rows, cols = z.shape
+    tile_rows, tile_cols = -(-(rows - 1) // tile_size), -(-(cols - 1) // tile_size)
+
+    # Pad with the edge values so the last tiles are full size, plus the overlap
+    padded = np.pad(z, ((0, tile_rows * tile_size + 1 - rows), (0, tile_cols * tile_size + 1 - cols)), mode='edge')
+
+    # Write to a temporary directory and rename it, so a failed write is never mistaken for a good one
+    tmp_dir = out_dir.rstrip('/') + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(os.path.join(tmp_dir, 'tiles'))
+    for r in range(tile_rows):
+        for c in range(tile_cols):
+            tile = padded[r * tile_size:(r + 1) * tile_size + 1, c * tile_size:(c + 1) * tile_size + 1]
+            np.save(os.path.join(tmp_dir, 'tiles', f'{r}_{c}.npy'), np.ascontiguousarray(tile))
+
+    # Steepest slope between neighboring samples, for the ray march
+    with np.errstate(invalid='ignore'):
+        max_slope = max(np.nanmax(np.abs(np.diff(z, axis=0)), initial=0.0),
+                        np.nanmax(np.abs(np.diff(z, axis=1)), initial=0.0)) / resolution
+    index = {
+        'origin_lat': origin_lat,
+        'origin_lon': origin_lon,
+        'resolution': resolution,
+        'tile_size': tile_size,
+        'rows': rows,
+        'cols': cols,
+        'min_z': float(np.nanmin(z)),
+        'max_z': float(np.nanmax(z)),
+        # Bilinear interpolation within a cell can be steeper than the edges by a factor of up to sqrt(2)
+        'max_slope': float(max_slope) * math.sqrt(2.0),
+    }
+    with open(os.path.join(tmp_dir, INDEX_FILE), 'w') as f:
+        json.dump(index, f, indent=2)
+
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.rename(tmp_dir, out_dir)
+
+
+class Bathymetry:
+    """
+    Seafloor z lookups in a bathymetry directory
+    """
+
+    def __init__(self, path: str, cache_tiles: int = DEFAULT_CACHE_TILES):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        self.resolution = self.index['resolution']
+        self.tile_size = self.index['tile_size']
+        self.rows = self.index['rows']
+        self.cols = self.index['cols']
+        self.max_slope = self.index['max_slope']
+
+        # Equirectangular projection around the origin, good enough for a survey area
+        self.origin_lat = self.index['origin_lat']
+        self.origin_lon = self.index['origin_lon']
+        self.m_per_deg_lat = math.radians(1.0) * EARTH_RADIUS_M
+        self.m_per_deg_lon = self.m_per_deg_lat * math.cos(math.radians(self.origin_lat))
+
+        # (tile row, tile column): memory-mapped tile, least recently used first
+        self.cache_tiles = cache_tiles
+        self.tiles = collections.OrderedDict()
+        self.last_key = None
+        self.last_tile = None
+        self.loads = 0
+
+    def __str__(self):
+        return (f'{self.path}: {self.rows}x{self.cols} samples, {self.resolution}m, z {self.index["min_z"] :.1f} to '
+                f'{self.index["max_z"] :.1f}m')
+
+    def to_ne(self, lat: float, lon: float) -> tuple[float, float]:
+        """
+        Meters north and east of the origin
+        """
+        return (lat - self.origin_lat) * self.m_per_deg_lat, (lon - self.origin_lon) * self.m_per_deg_lon
+
+    def tile(self, key: tuple[int, int]) -> np.ndarray:
+        if key == self.last_key:
+            return self.last_tile
+        tile = self.tiles.get(key)
+        if tile is None:
+            tile = np.load(os.path.join(self.path, 'tiles', f'{key[0]}_{key[1]}.npy'), mmap_mode='r')
+            self.loads += 1
+            self.tiles[key] = tile
+            if len(self.tiles) > self.cache_tiles:
+                self.tiles.popitem(last=False)
+        else:
+            self.tiles.move_to_end(key)
+        self.last_key, self.last_tile = key, tile
+        return tile
+
+    def height_ne(self, north: float, east: float) -> float:
+        """
+        Seafloor z at a point north and east of the origin, NaN outside the grid
+        """
+        y = north / self.resolution
+        x = east / self.resolution
+        if not (0.0 <= y <= self.rows - 1 and 0.0 <= x <= self.cols - 1):
+            return math.nan
+        row, col = int(y), int(x)
+        tile_row, r = divmod(row, self.tile_size)
+        tile_col, c = divmod(col, self.tile_size)
+        tile = self.tile((tile_row, tile_col))
+
+        # item() returns a Python float, much faster than numpy scalar math
+        fy, fx = y - row, x - col
+        z00, z01 = tile.item(r, c), tile.item(r, c + 1)
+        z10, z11 = tile.item(r + 1, c), tile.item(r + 1, c + 1)
+        return (z00 * (1.0 - fx) + z01 * fx) * (1.0 - fy) + (z10 * (1.0 - fx) + z11 * fx) * fy
+
+    def height(self, lat: float, lon: float) -> float:
+        return self.height_ne(*self.to_ne(lat, lon))
+
+    def slant_range(self, lat: float, lon: float, z: float, roll: float = 0.0, pitch: float = 0.0, yaw: float = 0.0,
+                    max_range: float = 50.0) -> float:
+        """
+        Distance along the beam of a down-facing rangefinder to the seafloor, inf if it doesn't hit within max_range.
+        Attitude in radians, NED body frame.
+        """
+        # The body z axis in NED
+        cr, sr = math.cos(roll), math.sin(roll)
+        cp, sp = math.cos(pitch), math.sin(pitch)
+        cy, sy = math.cos(yaw), math.sin(yaw)
+        d_north = cy * sp * cr + sy * sr
+        d_east = sy * sp * cr - cy * sr
+        d_down = cp * cr
+
+        # Beam descent per meter, worst case: the seafloor rises at max_slope under the horizontal part of the beam
+        closing = d_down + self.max_slope * math.hypot(d_north, d_east)
+        if closing <= 0.0:
+            return math.inf
+
+        north, east = self.to_ne(lat, lon)
+        s = 0.0
+        for _ in range(MAX_STEPS):
+            floor_z = self.height_ne(north + d_north * s, east + d_east * s)
+            if floor_z != floor_z:
+                # Off the grid
+                return math.inf
+            clearance = z - d_down * s - floor_z
+            if clearance <= HIT_TOLERANCE_M:
+                return s
+            s += clearance / closing
+            if s > max_range:
+                return math.inf
+        return s
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    make_parser = subparsers.add_parser('make', help='make a fractal seabed centered on a location')
+    make_parser.add_argument('out_dir', type=str, help='bathymetry directory to write')
+    make_parser.add_argument('--lat', type=float, default=None, help='center latitude, default SITL home')
+    make_parser.add_argument('--lon', type=float, default=None, help='center longitude, default SITL home')
+    make_parser.add_argument('--size', type=float, default=1000.0, help='width and height in m, default 1000')
+    make_parser.add_argument('--resolution', type=float, default=1.0, help='m per sample, default 1')
+    make_parser.add_argument('--depth', type=float, default=-20.0, help='mean seafloor z, default -20m')
+    make_parser.add_argument('--sigma', type=float, default=1.0, help='standard deviation, default 1m')
+    make_parser.add_argument('--beta', type=float, default=2.5, help='spectral slope, see gen_terrain.py')
+    make_parser.add_argument('--seed', type=int, default=None, help='random seed')
+    make_parser.add_argument('--tile-size', type=int, default=DEFAULT_TILE_SIZE, help='samples per tile side')
+
+    import_parser = subparsers.add_parser('import', help='import a grid from a .npy file')
+    import_parser.add_argument('grid', type=str, help='.npy file, rows south to north, columns west to east')
+    import_parser.add_argument('out_dir', type=str, help='bathymetry directory to write')
+    import_parser.add_argument('--lat', type=float, required=True, help='latitude of the south-west sample')
+    import_parser.add_argument('--lon', type=float, required=True, help='longitude of the south-west sample')
+    import_parser.add_argument('--resolution', type=float, required=True, help='m per sample')
+    import_parser.add_argument('--tile-size', type=int, default=DEFAULT_TILE_SIZE, help='samples per tile side')
+
+    sample_parser = subparsers.add_parser('sample', help='look up a location, and time random lookups')
+    sample_parser.add_argument('path', type=str, help='bathymetry directory')
+    sample_parser.add_argument('lat', type=float)
+    sample_parser.add_argument('lon', type=float)
+    sample_parser.add_argument('--z', type=float, default=-10.0, help='sub z for the slant range, default -10m')
+
+    args = parser.parse_args()
+
+    if args.command == 'make':
+        # Import here, sitl_runner imports this module
+        from sitl_runner import HOME_LAT, HOME_LON
+
+        lat = HOME_LAT if args.lat is None else args.lat
+        lon = HOME_LON if args.lon is None else args.lon
+        n = int(round(args.size / args.resolution)) + 1
+        z = args.depth + args.sigma * fractal_surface(n, n, args.beta, np.random.default_rng(args.seed))
+        half = args.size / 2.0
+        origin_lat = lat - half / (math.radians(1.0) * EARTH_RADIUS_M)
+        origin_lon = lon - half / (math.radians(1.0) * EARTH_RADIUS_M * math.cos(math.radians(lat)))
+        write_bathymetry(args.out_dir, z, origin_lat, origin_lon, args.resolution, args.tile_size)
+        print(Bathymetry(args.out_dir))
+    elif args.command == 'import':
+        write_bathymetry(args.out_dir, np.load(args.grid), args.lat, args.lon, args.resolution, args.tile_size)
+        print(Bathymetry(args.out_dir))
+    else:
+        bathymetry = Bathymetry(args.path)
+        print(bathymetry)
+        print(f'z {bathymetry.height(args.lat, args.lon) :.3f}m, slant range from {args.z}m: vertical '
+              f'{bathymetry.slant_range(args.lat, args.lon, args.z) :.3f}m, 20° roll '
+              f'{bathymetry.slant_range(args.lat, args.lon, args.z, roll=math.radians(20)) :.3f}m')
+
+        # A sub moving at 1m/s, sampled at 50Hz
+        n = 100000
+        north, east = bathymetry.to_ne(args.lat, args.lon)
+        lats = args.lat + (np.arange(n) * 0.02 / bathymetry.m_per_deg_lat)
+        start = time.perf_counter()
+        for lat in lats.tolist():
+            bathymetry.height(lat, args.lon)
+        height_us = (time.perf_counter() - start) / n * 1e6
+        start = time.perf_counter()
+        for lat in lats.tolist():
+            bathymetry.slant_range(lat, args.lon, args.z, 0.1, 0.05, 1.0)
+        slant_us = (time.perf_counter() - start) / n * 1e6
+        print(f'height {height_us :.2f}us, slant range {slant_us :.2f}us per lookup, {bathymetry.loads} tiles loaded')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the rangefinder injection loop in sitl_runner.py against fake_sub.py, no ArduPilot build required.
+
+Each run injects a flat terrain at a fixed interval, and fake_sub.py reports the rate it actually received. The highest
+speedup where the received rate keeps up with the requested rate is the maximum sustainable rate of the runner.
+
+Run from the repo root:
+    python -m bench.injection_rate --interval 0.02 --speedup 10 20 50 100
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def write_terrain(path: str, interval: float, count: int):
+    with open(path, 'w') as f:
+        f.write(f'{interval}\n')
+        f.write('-20.0\n' * count)
+
+
+def run_once(work_dir: str, terrain: str, speedup: float, duration: int) -> dict:
+    result = subprocess.run([
+        sys.executable, os.path.join(REPO_DIR, 'sitl_runner.py'),
+        '--fake',
+        '--speedup', str(speedup),
+        '--time', str(duration),
+        '--terrain', terrain,
+        '--depth', '-2',
+        '--params', os.path.join(REPO_DIR, 'params', 'sitl.params'),
+    ], cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if result.returncode != 0:
+        raise RuntimeError(f'sitl_runner.py failed at speedup {speedup}')
+
+    with open(os.path.join(work_dir, 'fake_sub_stats.json')) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('--interval', type=float, default=0.1, help='Terrain interval in seconds, default 0.1')
+    parser.add_argument('--speedup', type=float, nargs='+', default=[1, 5, 10, 20, 50], help='Speedups to try')
+    parser.add_argument('--time', type=int, default=90, help='Sim time per run, including startup, default 90')
+    args = parser.parse_args()
+
+    requested_hz = 1.0 / args.interval
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        terrain = os.path.join(work_dir, 'flat.csv')
+        write_terrain(terrain, args.interval, 1000)
+
+        print(f'{"speedup" :>8}{"requested Hz" :>14}{"sim Hz" :>10}{"wall Hz" :>10}{"kept up" :>9}'
+              f'{"p50 ms" :>9}{"p99 ms" :>9}')
+        for speedup in args.speedup:
+            stats = run_once(work_dir, terrain, speedup, args.time)
+            rate = stats.get('rate_sim_hz', 0.0)
+            print(f'{speedup :8.0f}{requested_hz :14.1f}{rate :10.1f}{stats.get("rate_wall_hz", 0.0) :10.1f}'
+                  f'{rate / requested_hz :9.0%}{stats.get("response_p50_ms", 0.0) :9.2f}'
+                  f'{stats.get("response_p99_ms", 0.0) :9.2f}')
+
+
+if __name__ == '__main__':
+    main()
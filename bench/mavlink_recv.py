@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmark the receive path in sitl_runner.py: recv_match() vs. mavutil2.MsgDispatcher.
+
+The link traffic is a mix of typical ArduSub streams. recv_match() decodes every message; the dispatcher only decodes
+the messages that SimRunner handles, so its cost should follow the handled rate, not the link rate.
+
+Run from the repo root:
+    python -m bench.mavlink_recv
+"""
+
+import argparse
+import os
+import time
+
+from pymavlink.dialects.v20 import ardupilotmega as apm2
+
+# Use MAVLink2 wire protocol, must include this before importing pymavlink.mavutil
+os.environ['MAVLINK20'] = '1'
+
+import mavutil2
+
+# Link traffic: message, rate in Hz. The first 3 are handled by SimRunner, the rest are streams nobody reads.
+STREAMS = [
+    (apm2.MAVLink_global_position_int_message(0, 476078860, -1223443240, -10000, -10000, 0, 0, 0, 0), 5),
+    (apm2.MAVLink_system_time_message(0, 0), 20),
+    (apm2.MAVLink_attitude_message(0, 0.01, -0.02, 1.5, 0, 0, 0), 10),
+    (apm2.MAVLink_vfr_hud_message(0, 0, 0, 50, 0, -10), 10),
+    (apm2.MAVLink_gps_raw_int_message(0, 3, 476078860, -1223443240, 0, 100, 100, 0, 0, 10), 5),
+    (apm2.MAVLink_sys_status_message(0, 0, 0, 500, 12000, 100, 90, 0, 0, 0, 0, 0, 0), 2),
+    (apm2.MAVLink_heartbeat_message(apm2.MAV_TYPE_SUBMARINE, apm2.MAV_AUTOPILOT_ARDUPILOTMEGA, 0, 21, 0, 3), 1),
+    (apm2.MAVLink_vibration_message(0, 0.1, 0.1, 0.1, 0, 0, 0), 10),
+    (apm2.MAVLink_ekf_status_report_message(0, 0.1, 0.1, 0.1, 0.1, 0.1), 10),
+    (apm2.MAVLink_servo_output_raw_message(0, 0, *[1500] * 8), 10),
+    (apm2.MAVLink_rc_channels_message(0, 16, *[1500] * 18, 255), 10),
+]
+HANDLED = {apm2.MAVLINK_MSG_ID_GLOBAL_POSITION_INT, apm2.MAVLINK_MSG_ID_SYSTEM_TIME, apm2.MAVLINK_MSG_ID_ATTITUDE}
+RECV_TYPES = ['GLOBAL_POSITION_INT', 'SYSTEM_TIME', 'ATTITUDE', 'STATUSTEXT', 'TIMESYNC']
+
+
+class Link:
+    """
+    Just enough of a mavfile for MsgDispatcher.parse()
+    """
+
+    def __init__(self):
+        self.mav = apm2.MAVLink(None, srcSystem=1, srcComponent=1)
+
+
+def make_traffic(seconds: int, trimmed: bool) -> bytes:
+    mav = apm2.MAVLink(None, srcSystem=1, srcComponent=1)
+    data = bytearray()
+    for tick in range(seconds * 20):
+        for msg, rate in STREAMS:
+            if trimmed and msg.get_msgId() not in HANDLED and msg.get_msgId() != apm2.MAVLINK_MSG_ID_HEARTBEAT:
+                continue
+            if tick % (20 // rate) == 0:
+                data += msg.pack(mav)
+    return bytes(data)
+
+
+def time_recv_match(data: bytes, chunk: int) -> tuple[float, int]:
+    """
+    What recv_match(type=...) does: decode everything, then compare type names
+    """
+    mav = apm2.MAVLink(None)
+    handled = 0
+    start = time.perf_counter()
+    for i in range(0, len(data), chunk):
+        for msg in mav.parse_buffer(data[i:i + chunk]) or []:
+            if msg.get_type() in RECV_TYPES:
+                handled += 1
+    return time.perf_counter() - start, handled
+
+
+def time_dispatcher(data: bytes, chunk: int) -> tuple[float, int]:
+    dispatcher = mavutil2.MsgDispatcher(Link(), {msg_id: lambda msg: None for msg_id in HANDLED})
+    handled = 0
+    start = time.perf_counter()
+    for i in range(0, len(data), chunk):
+        dispatcher.buf += data[i:i + chunk]
+        handled += dispatcher.parse(0.0)
+    return time.perf_counter() - start, handled
+
+
+def sum_rate(trimmed: bool) -> int:
+    return sum(rate for msg, rate in STREAMS
+               if not trimmed or msg.get_msgId() in HANDLED or msg.get_msgId() == apm2.MAVLINK_MSG_ID_HEARTBEAT)
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('--seconds', type=int, default=600, help='Sim seconds of traffic, default 600')
+    parser.add_argument('--chunk', type=int, default=4096, help='Bytes per socket read, default 4096')
+    args = parser.parse_args()
+
+    print(f'{"traffic" :>10}{"msgs/s" :>8}{"path" :>14}{"handled" :>9}{"us/handled" :>12}{"CPU %" :>7}')
+    for trimmed in [False, True]:
+        data = make_traffic(args.seconds, trimmed)
+        for name, fn in [('recv_match', time_recv_match), ('dispatcher', time_dispatcher)]:
+            elapsed, handled = fn(data, args.chunk)
+            print(f'{"trimmed" if trimmed else "full" :>10}{sum_rate(trimmed) :8d}{name :>14}{handled :9d}'
+                  f'{elapsed / handled * 1e6 :12.1f}{elapsed / args.seconds * 100 :7.2f}')
+
+
+if __name__ == '__main__':
+    main()
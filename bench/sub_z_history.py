@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmark SubZHistory: lookup cost should stay flat as the simulation runs for hours.
+
+Run from the repo root:
+    python -m bench.sub_z_history
+"""
+
+import argparse
+import time
+
+from sitl_runner import SubZHistory
+
+# GLOBAL_POSITION_INT rate requested by SimRunner
+RATE_HZ = 5.0
+
+
+def time_lookups(history: SubZHistory, now: float, delay: float, lookups: int) -> float:
+    """
+    Return the average cost of a get() call in ns
+    """
+    start = time.perf_counter_ns()
+    for i in range(lookups):
+        history.get(now - delay - (i % 10) * 0.01)
+    return (time.perf_counter_ns() - start) / lookups
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('--delay', type=float, default=0.3, help='Sensor delay in seconds, default 0.3')
+    parser.add_argument('--hours', type=float, default=4.0, help='Length of the simulated run, default 4 hours')
+    parser.add_argument('--lookups', type=int, default=100000, help='Lookups per checkpoint')
+    args = parser.parse_args()
+
+    history = SubZHistory(args.delay, RATE_HZ)
+    checkpoints = [60.0, 600.0, 3600.0, args.hours * 3600.0]
+    samples = int(checkpoints[-1] * RATE_HZ)
+
+    print(f'{"elapsed (s)" :>12}{"readings kept" :>15}{"add (ns)" :>10}{"get (ns)" :>10}')
+    t = 0.0
+    i = 0
+    for checkpoint in sorted(set(checkpoints)):
+        add_start = time.perf_counter_ns()
+        added = 0
+        while i < samples and t < checkpoint:
+            t = i / RATE_HZ
+            history.add(t, -10.0 + 0.001 * (i % 1000))
+            i += 1
+            added += 1
+        add_ns = (time.perf_counter_ns() - add_start) / max(added, 1)
+        get_ns = time_lookups(history, t, args.delay, args.lookups)
+        print(f'{t :12.0f}{len(history) :15d}{add_ns :10.0f}{get_ns :10.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the Python simulation and analysis stack: the delay line, the rangefinder model, terrain loading,
+parameters, mission upload, log merging and graphing.
+
+The inputs are synthetic and fixed, and large enough to show scaling problems: hours of position history, a 10^6-row
+terrain, thousands of parameters and waypoints, and a 10 hour merged log. The parameter and mission benchmarks talk
+to fake_sub.py over a loopback TCP link, no ArduPilot build required.
+
+Each benchmark runs --repeat times and the results (best and median time) are written to --out. Save a baseline,
+make a change, then compare; a benchmark that is more than --tolerance slower than the baseline fails the run:
+    python -m bench.suite --out bench/baseline.json
+    python -m bench.suite --baseline bench/baseline.json
+
+Run a subset, with smaller inputs:
+    python -m bench.suite --only terrain calc_rf --scale 0.1
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import runpy
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, Optional
+
+import numpy as np
+import pandas as pd
+from pymavlink.dialects.v20 import ardupilotmega as apm2
+
+# Use MAVLink2 wire protocol, must include this before importing pymavlink.mavutil
+os.environ['MAVLINK20'] = '1'
+
+from pymavlink import mavutil
+
+import mavutil2
+import mission_protocol
+from noise import SensorNoise
+from sitl_runner import SubZHistory, calc_rf, calc_rf_array, mavlink_port, start_fake_sub, stop_process
+from terrain import Terrain, npy_path, write_npy
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Instance for the loopback fake_sub.py, far from the instances that sweeps use
+INSTANCE = 37
+
+# Input sizes at --scale 1
+HISTORY_HOURS = 4.0
+HISTORY_RATE_HZ = 5.0
+LOOKUPS = 100000
+TERRAIN_ROWS = 1000000
+PARAMS = 5000
+PARAMS_SET = 2000
+WAYPOINTS = 1000
+LOG_HOURS = 10.0
+
+
+class Context:
+    """
+    Work directory and shared resources, e.g., the loopback link
+    """
+
+    def __init__(self, work_dir: str, scale: float):
+        self.work_dir = work_dir
+        self.scale = scale
+        self.fake_sub = None
+        self.conn = None
+
+    def size(self, n: float) -> int:
+        return max(1, int(n * self.scale))
+
+    def link(self) -> mavutil.mavfile:
+        """
+        Start fake_sub.py and connect to it, once
+        """
+        if self.conn is None:
+            self.fake_sub = start_fake_sub(1.0, INSTANCE, cwd=self.work_dir)
+            # Quiet the connection refused messages while fake_sub.py starts
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.conn = mavutil.mavlink_connection(f'tcp:127.0.0.1:{mavlink_port(INSTANCE)}', source_system=255,
+                                                       source_component=0, retries=20, reconnect_delay=0.2)
+            self.conn.wait_heartbeat(timeout=10)
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        if self.fake_sub is not None:
+            stop_process(self.fake_sub)
+            self.fake_sub = None
+
+
+# Each benchmark does its setup and returns (run, ops): run() is the part that is timed, ops is what it does
+
+def sub_z_history_add(ctx: Context):
+    n = ctx.size(HISTORY_HOURS * 3600 * HISTORY_RATE_HZ)
+    t = (np.arange(n) / HISTORY_RATE_HZ).tolist()
+    z = (-10.0 + 0.001 * (np.arange(n) % 1000)).tolist()
+
+    def run():
+        history = SubZHistory(0.3, HISTORY_RATE_HZ)
+        for ti, zi in zip(t, z):
+            history.add(ti, zi)
+
+    return run, n
+
+
+def sub_z_history_get(ctx: Context):
+    n = ctx.size(HISTORY_HOURS * 3600 * HISTORY_RATE_HZ)
+    history = SubZHistory(0.3, HISTORY_RATE_HZ)
+    for i in range(n):
+        history.add(i / HISTORY_RATE_HZ, -10.0 + 0.001 * (i % 1000))
+    now = (n - 1) / HISTORY_RATE_HZ
+    times = (now - 0.3 - (np.arange(ctx.size(LOOKUPS)) % 10) * 0.01).tolist()
+
+    def run():
+        for t in times:
+            history.get(t)
+
+    return run, len(times)
+
+
+def calc_rf_scalar(ctx: Context):
+    noise = SensorNoise(None, seed=0)
+    sub_z = (-10.0 + np.sin(np.arange(ctx.size(LOOKUPS)) * 0.01)).tolist()
+
+    def run():
+        for z in sub_z:
+            calc_rf(-20.0, z, noise)
+
+    return run, len(sub_z)
+
+
+def calc_rf_vector(ctx: Context):
+    noise = SensorNoise(None, seed=0)
+    n = ctx.size(TERRAIN_ROWS)
+    terrain_z = -20.0 + np.sin(np.arange(n) * 0.001)
+    sub_z = np.full(n, -10.0)
+
+    def run():
+        calc_rf_array(terrain_z, sub_z, noise)
+
+    return run, n
+
+
+def write_terrain(ctx: Context) -> str:
+    path = os.path.join(ctx.work_dir, 'terrain.csv')
+    if not os.path.exists(path):
+        z = -20.0 + np.round(np.sin(np.arange(ctx.size(TERRAIN_ROWS)) * 0.001), 3)
+        with open(path, 'w') as f:
+            f.write('0.1\n')
+            np.savetxt(f, z, fmt='%.3f')
+        write_npy(npy_path(path), 0.1, z)
+    return path
+
+
+def terrain_load_csv(ctx: Context):
+    path = write_terrain(ctx)
+
+    def run():
+        Terrain.load_csv(path)
+
+    return run, ctx.size(TERRAIN_ROWS)
+
+
+def terrain_load_npy(ctx: Context):
+    path = write_terrain(ctx)
+
+    def run():
+        terrain = Terrain.load(path)
+        sum(terrain.z[start:start + 4096].sum() for start in range(0, len(terrain), 4096))
+
+    return run, ctx.size(TERRAIN_ROWS)
+
+
+def terrain_getitem(ctx: Context):
+    terrain = Terrain.load(write_terrain(ctx))
+    n = len(terrain)
+
+    def run():
+        for i in range(n):
+            terrain[i]
+
+    return run, n
+
+
+def write_params(ctx: Context, n: int) -> str:
+    path = os.path.join(ctx.work_dir, f'bench{n}.params')
+    with open(path, 'w') as f:
+        f.write('# Synthetic parameters\n')
+        for i in range(n):
+            f.write(f'1\t1\tBENCH_P{i :05d}\t{i * 0.5}\t{apm2.MAV_PARAM_TYPE_REAL32}\n')
+    return path
+
+
+def params_parse(ctx: Context):
+    path = write_params(ctx, ctx.size(PARAMS))
+
+    def run():
+        mavutil2.ParameterList(path)
+
+    return run, ctx.size(PARAMS)
+
+
+def params_set_all(ctx: Context):
+    conn = ctx.link()
+    param_list = mavutil2.ParameterList(write_params(ctx, ctx.size(PARAMS_SET)))
+
+    def run():
+        param_list.set_all(conn)
+
+    return run, ctx.size(PARAMS_SET)
+
+
+def mission_upload(ctx: Context):
+    conn = ctx.link()
+    items = [apm2.MAVLink_mission_item_int_message(
+        1, 1, seq, apm2.MAV_FRAME_GLOBAL_RELATIVE_ALT_INT, apm2.MAV_CMD_NAV_WAYPOINT, 0, 1, 0, 0, 0, 0,
+        476078860 + 100 * (seq % 100), -1223443240 + 100 * (seq // 100), -10.0) for seq in range(ctx.size(WAYPOINTS))]
+
+    def run():
+        if not mission_protocol.upload_using_mission_protocol(conn, apm2.MAV_MISSION_TYPE_MISSION, items):
+            raise RuntimeError('Mission upload failed')
+
+    return run, len(items)
+
+
+def synthetic_run(n: int) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    CTUN and stamped_terrain tables for a run over a trapezoid terrain, both at 10Hz, interleaved
+    """
+    rng = np.random.default_rng(0)
+    t = np.arange(n) * 0.1
+    terrain = -20.0 + np.clip(2.5 - np.abs((t % 100.0) - 50.0) * 0.2, 0.0, 1.0) * 5.0
+    sub = np.minimum(terrain + 10.0 + rng.normal(0, 0.05, n).cumsum() * 0.01, -0.5)
+    rf = sub - terrain + rng.normal(0, 0.05, n)
+    ctun = pd.DataFrame({
+        'TimeUS': (t * 1e6).astype(np.int64) + 8000000,
+        'timestamp': 1705603234.3 + t,
+        'DAlt': sub, 'Alt': sub + rng.normal(0, 0.02, n), 'TAlt': sub,
+        'DSAlt': np.full(n, 10.0), 'SAlt': rf,
+        'DCRt': rng.normal(0, 5, n).round(), 'CRt': rng.normal(0, 5, n).round(),
+    })
+    stamped = pd.DataFrame({
+        'TimeUS': (t * 1e6).astype(np.int64) + 8050000,
+        'terrain_cm': terrain * 100.0, 'sub_cm': sub * 100.0,
+        'rf_cm': (rf * 100.0).astype(np.int64), 'signal_quality': np.full(n, 100),
+    })
+    return ctun, stamped
+
+
+def merge_logs(ctx: Context):
+    n = ctx.size(LOG_HOURS * 36000)
+    log_dir = os.path.join(ctx.work_dir, 'merge')
+    os.makedirs(log_dir, exist_ok=True)
+    ctun, stamped = synthetic_run(n)
+    ctun.to_csv(os.path.join(log_dir, 'ctun.csv'), index=False)
+    stamped.to_csv(os.path.join(log_dir, 'stamped_terrain.csv'), index=False)
+
+    def run():
+        os.environ['LOG_DIR'] = log_dir
+        runpy.run_path(os.path.join(REPO_DIR, 'merge_logs.py'), run_name='__main__')
+
+    return run, 2 * n
+
+
+def graph_sitl(ctx: Context):
+    # Import here, graph_sitl sets the matplotlib backend
+    import graph_sitl
+
+    n = ctx.size(LOG_HOURS * 36000)
+    log_dir = os.path.join(ctx.work_dir, 'graph')
+    os.makedirs(log_dir, exist_ok=True)
+    ctun, stamped = synthetic_run(n)
+    merged = pd.merge_ordered(ctun, stamped, on='TimeUS', fill_method='ffill')
+
+    def run():
+        graph_sitl.graph_sitl(log_dir, merged)
+
+    return run, len(merged)
+
+
+BENCHMARKS: dict[str, Callable] = {
+    'sub_z_history.add': sub_z_history_add,
+    'sub_z_history.get': sub_z_history_get,
+    'calc_rf': calc_rf_scalar,
+    'calc_rf_array': calc_rf_vector,
+    'terrain.load_csv': terrain_load_csv,
+    'terrain.load_npy': terrain_load_npy,
+    'terrain.getitem': terrain_getitem,
+    'params.parse': params_parse,
+    'params.set_all': params_set_all,
+    'mission.upload': mission_upload,
+    'merge_logs': merge_logs,
+    'graph_sitl': graph_sitl,
+}
+
+
+def time_benchmark(ctx: Context, setup: Callable, repeat: int) -> dict:
+    run, ops = setup(ctx)
+    times = []
+    for _ in range(repeat):
+        # The code under test prints progress, that's part of its cost but not of our output
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+    median = statistics.median(times)
+    return {
+        'ops': ops,
+        'best_s': min(times),
+        'median_s': median,
+        'per_op_us': median / ops * 1e6,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Print the median time of each benchmark against the baseline, return the ones that got slower
+    """
+    slower = []
+    print(f'{"benchmark" :20}{"baseline s" :>12}{"now s" :>12}{"change" :>9}')
+    for name, result in results['results'].items():
+        base = baseline['results'].get(name)
+        if base is None or base['ops'] != result['ops']:
+            print(f'{name :20}{"-" :>12}{result["median_s"] :12.4f}{"new" :>9}')
+            continue
+        change = result['median_s'] / base['median_s'] - 1.0
+        flag = ''
+        if change > tolerance:
+            flag = '  SLOWER'
+            slower.append(name)
+        elif change < -tolerance:
+            flag = '  faster'
+        print(f'{name :20}{base["median_s"] :12.4f}{result["median_s"] :12.4f}{change :+9.1%}{flag}')
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('--only', type=str, nargs='+', default=None,
+                        help='Run the benchmarks whose names contain any of these strings')
+    parser.add_argument('--scale', type=float, default=1.0, help='Scale all input sizes, default 1')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per benchmark, default 5')
+    parser.add_argument('--out', type=str, default=None, help='Write the results to this json file')
+    parser.add_argument('--baseline', type=str, default=None, help='Compare against this results file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Fail if a benchmark is more than this much slower than the baseline, default 0.2')
+    args = parser.parse_args()
+
+    names = [name for name in BENCHMARKS if args.only is None or any(s in name for s in args.only)]
+    if not names:
+        print(f'No benchmarks match, choose from {", ".join(BENCHMARKS)}')
+        sys.exit(1)
+
+    baseline: Optional[dict] = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'scale': args.scale,
+        'repeat': args.repeat,
+        'results': {},
+    }
+
+    print(f'{"benchmark" :20}{"ops" :>10}{"best s" :>10}{"median s" :>10}{"us/op" :>10}')
+    with tempfile.TemporaryDirectory() as work_dir:
+        ctx = Context(work_dir, args.scale)
+        try:
+            for name in names:
+                result = time_benchmark(ctx, BENCHMARKS[name], args.repeat)
+                results['results'][name] = result
+                print(f'{name :20}{result["ops"] :10d}{result["best_s"] :10.4f}{result["median_s"] :10.4f}'
+                      f'{result["per_op_us"] :10.3f}')
+        finally:
+            ctx.close()
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'{args.out} written')
+
+    if baseline is not None:
+        print()
+        slower = compare(results, baseline, args.tolerance)
+        if slower:
+            print(f'{len(slower)} benchmarks slower than the baseline: {", ".join(slower)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Shape-preserving downsampling for plots.
+
+A multi-thousand-second run has far more samples than a page has pixel columns. Both methods reduce a series to about
+n points, so the render time and PDF size don't depend on the length of the run:
+* minmax: split the series into n/2 buckets and keep the min and max of each, in time order. Spikes always survive.
+* lttb: Largest-Triangle-Three-Buckets (Steinarsson 2013), keep the point of each bucket that forms the largest
+  triangle with the previous kept point and the mean of the next bucket. Looks closest to the original.
+
+NaNs (e.g., the terrain columns before the first reading) split a series into segments, which are downsampled
+separately and joined with a NaN, so gaps stay gaps.
+"""
+
+import numpy as np
+
+METHODS = ['minmax', 'lttb']
+
+
+def minmax(x: np.ndarray, y: np.ndarray, n: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Keep the min and max of each of n/2 equal-count buckets, plus the first and last points
+    """
+    buckets = max(1, (n - 2) // 2)
+    size = -(-len(x) // buckets)
+    if len(x) <= n or size < 2:
+        return x, y
+
+    # Pad the last bucket with its last value, so all buckets have the same size
+    padded = np.pad(y, (0, buckets * size - len(y)), mode='edge').reshape(buckets, size)
+    starts = np.arange(buckets) * size
+    keep = np.concatenate([[0], starts + padded.argmin(axis=1), starts + padded.argmax(axis=1), [len(x) - 1]])
+    keep = np.unique(np.minimum(keep, len(x) - 1))
+    return x[keep], y[keep]
+
+
+def lttb(x: np.ndarray, y: np.ndarray, n: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Largest-Triangle-Three-Buckets: the first and last points plus one point from each of n-2 buckets
+    """
+    if len(x) <= n or n < 3:
+        return x, y
+
+    # Bucket edges for the points between the first and the last
+    edges = np.linspace(1, len(x) - 1, n - 1).astype(np.int64)
+
+    # The mean of each bucket, and of the last point as the bucket after the last bucket
+    counts = np.diff(edges)
+    mean_x = np.append(np.add.reduceat(x[:-1], edges[:-1]) / counts, x[-1])
+    mean_y = np.append(np.add.reduceat(y[:-1], edges[:-1]) / counts, y[-1])
+
+    keep = np.empty(n, dtype=np.int64)
+    keep[0], keep[-1] = 0, len(x) - 1
+    a = 0
+    for i in range(n - 2):
+        # Each point depends on the previous choice, but the search within a bucket is vectorized
+        bx, by = x[edges[i]:edges[i + 1]], y[edges[i]:edges[i + 1]]
+        area = np.abs((x[a] - mean_x[i + 1]) * (by - y[a]) - (x[a] - bx) * (mean_y[i + 1] - y[a]))
+        a = edges[i] + int(area.argmax())
+        keep[i + 1] = a
+    return x[keep], y[keep]
+
+
+def downsample(x: np.ndarray, y: np.ndarray, n: int, method: str = 'minmax') -> tuple[np.ndarray, np.ndarray]:
+    """
+    Reduce (x, y) to about n points, n <= 0 keeps all of them
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if n <= 0 or len(x) <= n:
+        return x, y
+    fn = {'minmax': minmax, 'lttb': lttb}[method]
+
+    # Split into runs of finite values
+    finite = np.isfinite(x) & np.isfinite(y)
+    edges = np.flatnonzero(np.diff(np.concatenate([[False], finite, [False]]).astype(np.int8)))
+    segments = list(zip(edges[::2], edges[1::2]))
+    if len(segments) == 1 and segments[0] == (0, len(x)):
+        return fn(x, y, n)
+
+    # Each segment gets its share of the points
+    xs, ys = [], []
+    for start, end in segments:
+        share = max(3, int(round(n * (end - start) / np.count_nonzero(finite))))
+        sx, sy = fn(x[start:end], y[start:end], share)
+        xs += [sx, [np.nan]]
+        ys += [sy, [np.nan]]
+    if not xs:
+        return x[:0], y[:0]
+    return np.concatenate(xs[:-1]), np.concatenate(ys[:-1])
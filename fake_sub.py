@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+
+"""
+A stand-in for ArduSub SITL, used to exercise and benchmark sitl_runner.py without an ArduPilot build.
+
+The fake sub speaks just enough MAVLink to get through SimRunner startup and a run:
+  * listens for a GCS on TCP port 5760 + 10 * instance, and for RC input on UDP port 5501 + 10 * instance
+  * streams HEARTBEAT, GLOBAL_POSITION_INT, VFR_HUD, GPS_RAW_INT, ATTITUDE and SYS_STATUS, honors SET_MESSAGE_INTERVAL
+  * streams SYSTEM_TIME on request, and answers TIMESYNC requests with time-since-boot
+  * answers PARAM_SET, PARAM_REQUEST_READ and PARAM_REQUEST_LIST, counts reboots in STAT_BOOTCNT
+  * keeps parameters in eeprom.json in the working directory, like eeprom.bin; --wipe starts from the defaults
+  * arms, disarms, changes modes and reboots on COMMAND_LONG
+  * accepts missions using the mission protocol
+  * accepts DISTANCE_SENSOR messages, and uses them to track the seafloor in mode 21 (surftrak)
+
+Vertical motion is either a simple model driven by the RC throttle and the flight mode, or a replay of the Alt column
+from a previous run (e.g., results/sitl/surftrak/trapezoid/merged.csv). Sim time runs at --speedup X wall time.
+
+Statistics about the DISTANCE_SENSOR messages are written to fake_sub_stats.json when the fake sub exits.
+"""
+
+import argparse
+import json
+import os
+import select
+import signal
+import socket
+import struct
+import time
+from typing import Optional
+
+import numpy as np
+from pymavlink.dialects.v20 import ardupilotmega as apm2
+
+# Home location, same as start_ardusub
+HOME_LAT = 47.607886
+HOME_LON = -122.344324
+
+# Simple vertical model
+MAX_CLIMB = 1.0         # Max climb rate at full throttle, m/s
+DEADZONE = 50           # Throttle deadzone around 1500, pwm
+POS_P = 1.0             # Depth hold gain, 1/s
+VEL_TAU = 0.3           # Time constant of the velocity response, s
+SURFTRAK_GAIN = 0.2     # Fraction of the rangefinder error removed per reading
+SURFACE_Z = -0.05       # The sub floats at this depth
+
+# Streams that are on at boot, msg_id: rate in Hz
+DEFAULT_STREAMS = {
+    apm2.MAVLINK_MSG_ID_HEARTBEAT: 1,
+    apm2.MAVLINK_MSG_ID_SYS_STATUS: 2,
+    apm2.MAVLINK_MSG_ID_ATTITUDE: 10,
+    apm2.MAVLINK_MSG_ID_GLOBAL_POSITION_INT: 4,
+    apm2.MAVLINK_MSG_ID_VFR_HUD: 4,
+    apm2.MAVLINK_MSG_ID_GPS_RAW_INT: 2,
+}
+
+# Parameters that exist at boot, name: (value, type)
+DEFAULT_PARAMS = {
+    'STAT_BOOTCNT': (0.0, apm2.MAV_PARAM_TYPE_UINT16),
+    'SYSID_THISMAV': (1.0, apm2.MAV_PARAM_TYPE_UINT8),
+    'RNGFND1_TYPE': (0.0, apm2.MAV_PARAM_TYPE_INT8),
+    'RNGFND1_MIN_CM': (20.0, apm2.MAV_PARAM_TYPE_INT16),
+    'RNGFND1_MAX_CM': (700.0, apm2.MAV_PARAM_TYPE_INT16),
+}
+
+
+class SocketWriter:
+    """
+    A file-like object for apm2.MAVLink: send to the current TCP client, if any
+    """
+
+    def __init__(self):
+        self.client: Optional[socket.socket] = None
+
+    def write(self, buf: bytes):
+        if self.client is not None:
+            try:
+                self.client.sendall(buf)
+            except OSError:
+                pass
+
+
+class ReplayProfile:
+    """
+    Replay the Alt column from a CTUN or merged csv file, looping forever
+    """
+
+    def __init__(self, path: str):
+        import pandas as pd
+        df = pd.read_csv(path, usecols=['TimeUS', 'Alt']).dropna()
+        self.t = (df['TimeUS'].to_numpy() - df['TimeUS'].iloc[0]) * 1e-6
+        self.z = df['Alt'].to_numpy()
+
+    def z_at(self, t: float) -> float:
+        return float(np.interp(t % self.t[-1], self.t, self.z))
+
+
+class DistanceSensorStats:
+    """
+    Keep track of the DISTANCE_SENSOR messages we receive
+    """
+
+    def __init__(self):
+        self.sim_times: list[float] = []
+        self.wall_times: list[float] = []
+        self.response_times: list[float] = []
+
+    def add(self, sim_time: float, wall_time: float, last_position_wall_time: float):
+        self.sim_times.append(sim_time)
+        self.wall_times.append(wall_time)
+        if last_position_wall_time > 0:
+            self.response_times.append(wall_time - last_position_wall_time)
+
+    def summary(self) -> dict:
+        result = {'count': len(self.sim_times)}
+        if len(self.sim_times) < 2:
+            return result
+
+        sim_gaps = np.diff(self.sim_times)
+        sim_span = self.sim_times[-1] - self.sim_times[0]
+        wall_span = self.wall_times[-1] - self.wall_times[0]
+        result.update({
+            'rate_sim_hz': (len(self.sim_times) - 1) / sim_span if sim_span > 0 else 0.0,
+            'rate_wall_hz': (len(self.wall_times) - 1) / wall_span if wall_span > 0 else 0.0,
+            'interval_mean_s': float(np.mean(sim_gaps)),
+            'interval_stdev_s': float(np.std(sim_gaps)),
+            'interval_max_s': float(np.max(sim_gaps)),
+        })
+        if self.response_times:
+            response_ms = np.array(self.response_times) * 1000.0
+            result.update({
+                'response_p50_ms': float(np.percentile(response_ms, 50)),
+                'response_p99_ms': float(np.percentile(response_ms, 99)),
+                'response_max_ms': float(np.max(response_ms)),
+            })
+        return result
+
+
+class FakeSub:
+    EEPROM = 'eeprom.json'
+
+    def __init__(self, speedup: float, instance: int, replay: Optional[str], wipe: bool = True):
+        self.speedup = speedup
+        self.replay = ReplayProfile(replay) if replay else None
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', 5760 + 10 * instance))
+        self.server.listen(1)
+
+        self.rc_in = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.rc_in.bind(('127.0.0.1', 5501 + 10 * instance))
+
+        self.writer = SocketWriter()
+        self.mav = apm2.MAVLink(self.writer, srcSystem=1, srcComponent=1)
+        self.parser = apm2.MAVLink(None)
+
+        self.params = dict(DEFAULT_PARAMS)
+        if not wipe and os.path.exists(FakeSub.EEPROM):
+            with open(FakeSub.EEPROM) as f:
+                self.params.update({name: tuple(value) for name, value in json.load(f).items()})
+        self.stats = DistanceSensorStats()
+        self.last_position_wall_time = 0.0
+        self.quit = False
+
+        self.boot()
+
+    def boot(self):
+        """
+        Reset everything but the parameters
+        """
+        value, param_type = self.params['STAT_BOOTCNT']
+        self.params['STAT_BOOTCNT'] = (value + 1, param_type)
+        self.save_params()
+
+        self.boot_wall_time = time.time()
+        self.last_step_s = 0.0
+        self.armed = False
+        self.arm_time_s = 0.0
+        self.mode = 0
+        self.channels = [1500] * 6 + [1000] * 10
+        self.z = SURFACE_Z
+        self.vz = 0.0
+        self.target_z = SURFACE_Z
+        self.rf_target: Optional[float] = None
+        self.mission_count = 0
+        self.mission_received = 0
+        self.intervals = {msg_id: 1.0 / rate for msg_id, rate in DEFAULT_STREAMS.items()}
+        self.next_send = {msg_id: 0.0 for msg_id in self.intervals}
+
+    def sim_time_s(self) -> float:
+        return (time.time() - self.boot_wall_time) * self.speedup
+
+    def time_boot_ms(self) -> int:
+        return int(self.sim_time_s() * 1000)
+
+    def statustext(self, severity: int, text: str):
+        self.mav.statustext_send(severity, text.encode())
+
+    # Vertical motion
+
+    def step(self):
+        now = self.sim_time_s()
+        dt = now - self.last_step_s
+        self.last_step_s = now
+        if dt <= 0:
+            return
+
+        if self.replay is not None:
+            z = self.replay.z_at(now - self.arm_time_s) if self.armed else SURFACE_Z
+            self.vz = (z - self.z) / dt
+            self.z = z
+            return
+
+        throttle = self.channels[2]
+        if not self.armed:
+            desired_vz = 0.0
+        elif abs(throttle - 1500) > DEADZONE:
+            # Pilot is in control
+            desired_vz = (throttle - 1500) / 500.0 * MAX_CLIMB
+            self.target_z = self.z
+            self.rf_target = None
+        else:
+            desired_vz = max(-MAX_CLIMB, min(MAX_CLIMB, POS_P * (self.target_z - self.z)))
+
+        self.vz += (desired_vz - self.vz) * min(1.0, dt / VEL_TAU)
+        self.z = min(SURFACE_Z, self.z + self.vz * dt)
+
+    def track_seafloor(self, rf: float):
+        """
+        A very rough imitation of surftrak: adjust the target depth to hold the rangefinder target
+        """
+        if self.rf_target is None:
+            self.rf_target = rf
+            self.statustext(apm2.MAV_SEVERITY_INFO, f'rangefinder target is {rf :.2f} meters')
+        else:
+            self.target_z = min(SURFACE_Z, self.target_z - SURFTRAK_GAIN * (rf - self.rf_target))
+
+    # Outgoing messages
+
+    def send_stream(self, msg_id: int):
+        lat = int(HOME_LAT * 1e7)
+        lon = int(HOME_LON * 1e7)
+        if msg_id == apm2.MAVLINK_MSG_ID_HEARTBEAT:
+            base_mode = apm2.MAV_MODE_FLAG_CUSTOM_MODE_ENABLED
+            if self.armed:
+                base_mode |= apm2.MAV_MODE_FLAG_SAFETY_ARMED
+            self.mav.heartbeat_send(apm2.MAV_TYPE_SUBMARINE, apm2.MAV_AUTOPILOT_ARDUPILOTMEGA, base_mode, self.mode,
+                                    apm2.MAV_STATE_ACTIVE if self.armed else apm2.MAV_STATE_STANDBY)
+        elif msg_id == apm2.MAVLINK_MSG_ID_SYS_STATUS:
+            self.mav.sys_status_send(0, 0, 0, 500, 16000, -1, -1, 0, 0, 0, 0, 0, 0)
+        elif msg_id == apm2.MAVLINK_MSG_ID_ATTITUDE:
+            self.mav.attitude_send(self.time_boot_ms(), 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+        elif msg_id == apm2.MAVLINK_MSG_ID_GLOBAL_POSITION_INT:
+            self.last_position_wall_time = time.time()
+            self.mav.global_position_int_send(self.time_boot_ms(), lat, lon, int(self.z * 1000),
+                                              int(self.z * 1000), 0, 0, int(-self.vz * 100), 0)
+        elif msg_id == apm2.MAVLINK_MSG_ID_VFR_HUD:
+            self.mav.vfr_hud_send(0.0, 0.0, 0, 0, self.z, self.vz)
+        elif msg_id == apm2.MAVLINK_MSG_ID_GPS_RAW_INT:
+            self.mav.gps_raw_int_send(int(self.sim_time_s() * 1e6), 3, lat, lon, int(self.z * 1000),
+                                      100, 100, 0, 0, 10)
+        elif msg_id == apm2.MAVLINK_MSG_ID_SYSTEM_TIME:
+            self.mav.system_time_send(int(time.time() * 1e6), self.time_boot_ms())
+
+    def send_due_streams(self) -> float:
+        """
+        Send the streams that are due, return the sim time of the next one
+        """
+        now = self.sim_time_s()
+        for msg_id, interval in self.intervals.items():
+            if now >= self.next_send[msg_id]:
+                self.send_stream(msg_id)
+                # Don't try to catch up if we fell behind
+                self.next_send[msg_id] = max(self.next_send[msg_id] + interval, now)
+        return min(self.next_send.values()) if self.next_send else now + 1.0
+
+    def save_params(self):
+        """
+        Write eeprom.json, called at boot and at exit
+        """
+        with open(FakeSub.EEPROM, 'w') as f:
+            json.dump(self.params, f)
+
+    def send_param(self, name: str):
+        value, param_type = self.params[name]
+        names = list(self.params.keys())
+        self.mav.param_value_send(name.encode(), value, param_type, len(names), names.index(name))
+
+    # Incoming messages
+
+    def handle_command(self, msg):
+        result = apm2.MAV_RESULT_ACCEPTED
+        if msg.command == apm2.MAV_CMD_COMPONENT_ARM_DISARM:
+            self.armed = msg.param1 == 1
+            if self.armed:
+                self.arm_time_s = self.sim_time_s()
+                self.target_z = self.z
+            self.statustext(apm2.MAV_SEVERITY_INFO, 'Armed' if self.armed else 'Disarmed')
+        elif msg.command == apm2.MAV_CMD_DO_SET_MODE:
+            self.mode = int(msg.param2)
+            self.target_z = self.z
+            self.rf_target = None
+        elif msg.command == apm2.MAV_CMD_SET_MESSAGE_INTERVAL:
+            msg_id = int(msg.param1)
+            if msg.param2 < 0:
+                self.intervals.pop(msg_id, None)
+                self.next_send.pop(msg_id, None)
+            elif msg.param2 > 0:
+                self.intervals[msg_id] = msg.param2 * 1e-6
+                self.next_send[msg_id] = self.sim_time_s()
+        elif msg.command == apm2.MAV_CMD_PREFLIGHT_REBOOT_SHUTDOWN:
+            self.mav.command_ack_send(msg.command, result)
+            self.reboot()
+            return
+        else:
+            result = apm2.MAV_RESULT_UNSUPPORTED
+        self.mav.command_ack_send(msg.command, result)
+
+    def reboot(self):
+        """
+        Drop the GCS connection, just like a real reboot
+        """
+        self.writer.client.close()
+        self.writer.client = None
+        self.boot()
+
+    def handle_msg(self, msg):
+        msg_type = msg.get_type()
+        if msg_type == 'COMMAND_LONG':
+            self.handle_command(msg)
+        elif msg_type == 'TIMESYNC':
+            if msg.tc1 == 0:
+                self.mav.timesync_send(int(self.sim_time_s() * 1e9), msg.ts1)
+        elif msg_type == 'PARAM_SET':
+            self.params[msg.param_id] = (msg.param_value, msg.param_type)
+            self.send_param(msg.param_id)
+        elif msg_type == 'PARAM_REQUEST_READ':
+            if msg.param_id in self.params:
+                self.send_param(msg.param_id)
+        elif msg_type == 'PARAM_REQUEST_LIST':
+            for name in self.params:
+                self.send_param(name)
+        elif msg_type == 'MISSION_COUNT':
+            self.mission_count = msg.count
+            self.mission_received = 0
+            self.mav.mission_request_send(255, 0, 0, msg.mission_type)
+        elif msg_type in ['MISSION_ITEM_INT', 'MISSION_ITEM']:
+            if msg.seq == self.mission_received:
+                self.mission_received += 1
+            if self.mission_received < self.mission_count:
+                self.mav.mission_request_send(255, 0, self.mission_received, msg.mission_type)
+            else:
+                self.mav.mission_ack_send(255, 0, apm2.MAV_MISSION_ACCEPTED, msg.mission_type)
+        elif msg_type == 'MISSION_CLEAR_ALL':
+            self.mission_count = 0
+            self.mav.mission_ack_send(255, 0, apm2.MAV_MISSION_ACCEPTED, msg.mission_type)
+        elif msg_type == 'DISTANCE_SENSOR':
+            self.stats.add(self.sim_time_s(), time.time(), self.last_position_wall_time)
+            if self.mode == 21 and self.armed and msg.signal_quality > 20 and \
+                    msg.min_distance < msg.current_distance < msg.max_distance:
+                self.track_seafloor(msg.current_distance * 0.01)
+
+    def recv_tcp(self):
+        try:
+            data = self.writer.client.recv(4096)
+        except OSError:
+            data = b''
+        if len(data) == 0:
+            self.writer.client.close()
+            self.writer.client = None
+            return
+
+        for msg in self.parser.parse_buffer(data) or []:
+            if msg.get_type() != 'BAD_DATA':
+                self.handle_msg(msg)
+
+    def recv_rc(self):
+        data = self.rc_in.recv(64)
+        if len(data) in [16, 32]:
+            self.channels = list(struct.unpack(f'<{len(data) // 2}H', data)) + self.channels[len(data) // 2:]
+
+    # Main loop
+
+    def run(self, duration: Optional[float]):
+        while not self.quit:
+            self.step()
+            next_s = self.send_due_streams()
+
+            if duration is not None and self.sim_time_s() > duration:
+                break
+
+            sockets = [self.server, self.rc_in]
+            if self.writer.client is not None:
+                sockets.append(self.writer.client)
+
+            timeout = max(0.0, (next_s - self.sim_time_s()) / self.speedup)
+            readable, _, _ = select.select(sockets, [], [], min(timeout, 0.1))
+
+            for s in readable:
+                if s is self.server:
+                    client, _ = self.server.accept()
+                    client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    if self.writer.client is not None:
+                        self.writer.client.close()
+                    self.writer.client = client
+                elif s is self.rc_in:
+                    self.recv_rc()
+                elif s is self.writer.client:
+                    self.recv_tcp()
+
+    def write_stats(self, path: str):
+        summary = self.stats.summary()
+        summary['speedup'] = self.speedup
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('--speedup', type=float, default=1.0, help='Sim time runs at this multiple of wall time')
+    parser.add_argument('--instance', type=int, default=0, help='Instance number, offsets all ports, default 0')
+    parser.add_argument('--replay', type=str, default=None, help='Replay the Alt column from this csv file')
+    parser.add_argument('--time', type=float, default=None, help='Exit after this many sim seconds')
+    parser.add_argument('--stats', type=str, default='fake_sub_stats.json', help='Write DISTANCE_SENSOR stats here')
+    parser.add_argument('-w', '--wipe', action='store_true', help='Start with the default parameters')
+    args = parser.parse_args()
+
+    fake_sub = FakeSub(args.speedup, args.instance, args.replay, args.wipe)
+
+    def stop(signum, frame):
+        fake_sub.quit = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    fake_sub.run(args.time)
+    fake_sub.save_params()
+    fake_sub.write_stats(args.stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,21 @@
 #!/usr/bin/env python3
 
 """
-Generate csv files with terrain readings
+Generate csv files with terrain readings.
+
+Profiles are built from segments, each a numpy array of terrain_z values, one every INTERVAL seconds:
+    z = np.concatenate([flat_segment(0.0, 10.0), ramp_segment(0.0, 2.0, 0.2), sine_segment(0.5, 8.0, 30.0)])
+
+The stream_* generators yield blocks of terrain_z values forever, for profiles that never repeat, see TerrainStream
+in terrain.py.
 """
 
-import csv
+import os
+from typing import Iterator, Optional
+
+import numpy as np
+
+from terrain import npy_path, write_npy
 
 # Interval between messages, in seconds
 # Note: 0.5 will trigger the timeout in ArduSub.
@@ -23,135 +34,223 @@ def csv_path(prefix):
     return 'terrain/' + prefix + '.csv'
 
 
-def write_flat_segment(writer, adj: float, t: float):
-    for i in range(int(t / INTERVAL)):
-        writer.writerow([SEAFLOOR_Z + adj])
+def num_readings(t: float) -> int:
+    return int(t / INTERVAL)
 
 
-def write_ramp_segment(writer, start: float, stop: float, rate: float):
-    step = rate * INTERVAL
-    num = int((stop - start) / step)
-    for i in range(num):
-        adj = round(start + i * step, 2)
-        writer.writerow([SEAFLOOR_Z + adj])
+def write_terrain(prefix, z: np.ndarray):
+    """
+    Write the csv file and its .npy sidecar
+    """
+    path = csv_path(prefix)
 
+    # Same format as csv.writer: the interval, then one repr(float) per row. Do not translate newlines.
+    with open(path, mode='w', newline='') as csvfile:
+        csvfile.write(f'{INTERVAL}\n')
+        if len(z):
+            csvfile.write('\n'.join(map(repr, z.tolist())))
+            csvfile.write('\n')
 
-def write_dropouts(writer, t: float):
-    for i in range(int(t / INTERVAL)):
-        writer.writerow([DROPOUT])
+    write_npy(npy_path(path), INTERVAL, z)
 
 
-def write_low_signal_quality(writer, t: float):
-    for i in range(int(t / INTERVAL)):
-        writer.writerow([LOW_SIGNAL_QUALITY])
+# Segments
 
+def flat_segment(adj: float, t: float) -> np.ndarray:
+    return np.full(num_readings(t), SEAFLOOR_Z + adj)
 
-def gen_zeros():
-    # Open for writing. Do not translate newlines.
-    with open(csv_path('zeros'), mode='w', newline='') as csvfile:
-        datawriter = csv.writer(csvfile, delimiter=',', quotechar='|', lineterminator='\n')
 
-        # Write the interval
-        datawriter.writerow([INTERVAL])
+def ramp_segment(start: float, stop: float, rate: float) -> np.ndarray:
+    step = rate * INTERVAL
+    num = int((stop - start) / step)
+    return SEAFLOOR_Z + np.round(start + np.arange(num) * step, 2)
+
+
+def step_segment(before: float, after: float, t: float) -> np.ndarray:
+    """
+    Flat at before for t/2 seconds, then flat at after for t/2 seconds
+    """
+    return np.concatenate((flat_segment(before, t / 2), flat_segment(after, t / 2)))
+
+
+def sine_segment(amplitude: float, period: float, t: float, adj=0.0) -> np.ndarray:
+    return SEAFLOOR_Z + adj + amplitude * np.sin(2 * np.pi / period * INTERVAL * np.arange(num_readings(t)))
+
+
+def fractal_noise(n: int, beta: float, rng: np.random.Generator) -> np.ndarray:
+    """
+    n samples of 1/f^beta noise with zero mean and unit standard deviation, by spectral synthesis. beta=0 is white
+    noise, beta=2 is Brownian; 1.5-2.5 looks like a natural seabed.
+    """
+    spectrum = np.fft.rfft(rng.standard_normal(n))
+    f = np.fft.rfftfreq(n)
+    f[0] = f[1] if n > 1 else 1.0
+    spectrum *= f ** (-beta / 2)
+    spectrum[0] = 0.0
+    noise = np.fft.irfft(spectrum, n)
+    std = noise.std()
+    return noise / std if std > 0 else noise
+
+
+def fractal_segment(sigma: float, t: float, beta=2.0, adj=0.0, rng: Optional[np.random.Generator] = None) -> np.ndarray:
+    """
+    Fractal seabed with standard deviation sigma around SEAFLOOR_Z + adj
+    """
+    rng = rng or np.random.default_rng()
+    return SEAFLOOR_Z + adj + sigma * fractal_noise(num_readings(t), beta, rng)
+
+
+def dropout_segment(t: float) -> np.ndarray:
+    return np.full(num_readings(t), DROPOUT)
+
+
+def low_signal_quality_segment(t: float) -> np.ndarray:
+    return np.full(num_readings(t), LOW_SIGNAL_QUALITY)
+
+
+def add_bursts(z: np.ndarray, value: float, rate: float, t: float, rng: Optional[np.random.Generator] = None):
+    """
+    Overwrite random bursts of z with value (DROPOUT or LOW_SIGNAL_QUALITY), in place. Bursts start at random at
+    rate bursts per second and last t seconds.
+    """
+    rng = rng or np.random.default_rng()
+    length = max(1, num_readings(t))
+    starts = np.flatnonzero(rng.random(len(z)) < rate * INTERVAL)
+    if len(starts) == 0:
+        return z
+
+    # Mark the first reading of each burst and the first reading after it, a running sum covers the bursts
+    marks = np.zeros(len(z) + length + 1, dtype=np.int32)
+    np.add.at(marks, starts, 1)
+    np.add.at(marks, starts + length, -1)
+    z[np.cumsum(marks)[:len(z)] > 0] = value
+    return z
+
+
+# Streams
+
+def stream_fractal(sigma: float, beta=2.0, block_t=100.0, seed: Optional[int] = None) -> Iterator[np.ndarray]:
+    """
+    Fractal seabed that never repeats. Blocks are overlapped with a sin^2 window, which sums to 1, so the profile is
+    continuous across blocks.
+    """
+    rng = np.random.default_rng(seed)
+    n = max(1, num_readings(block_t))
+    window = np.sin(np.pi * (np.arange(2 * n) + 0.5) / (2 * n)) ** 2
+    tail = np.zeros(n)
+    while True:
+        block = fractal_noise(2 * n, beta, rng) * window
+        yield SEAFLOOR_Z + sigma * (tail + block[:n])
+        tail = block[n:]
+
+
+def stream_course(max_bump=2.0, max_rate=0.5, t=10.0, dropout_rate=0.0, seed: Optional[int] = None) \
+        -> Iterator[np.ndarray]:
+    """
+    An endless obstacle course: random flats, ramps, steps and sines, each t seconds long, with optional dropout bursts
+    """
+    rng = np.random.default_rng(seed)
+    adj = 0.0
+    while True:
+        kind = rng.integers(4)
+        target = rng.uniform(-max_bump, max_bump)
+        if kind == 0:
+            segment = flat_segment(adj, t)
+        elif kind == 1:
+            # Ramp to target at a random rate, the ramp ends at target
+            rate = rng.uniform(0.1, max_rate) * np.sign(target - adj)
+            segment = ramp_segment(adj, target, rate) if rate != 0 else flat_segment(adj, t)
+            adj = target if rate != 0 else adj
+        elif kind == 2:
+            segment = step_segment(adj, target, t)
+            adj = target
+        else:
+            segment = sine_segment(rng.uniform(0.1, max_bump), rng.uniform(2.0, 2 * t), t, adj)
+        if dropout_rate > 0:
+            add_bursts(segment, DROPOUT, dropout_rate, 1.0, rng)
+        yield segment
+
+
+# name -> (stream function, keyword argument types), see TerrainStream.open
+STREAMS = {
+    'fractal': (stream_fractal, {'sigma': float, 'beta': float, 'block_t': float, 'seed': int}),
+    'course': (stream_course, {'max_bump': float, 'max_rate': float, 't': float, 'dropout_rate': float, 'seed': int}),
+}
+
+
+# Profiles
 
-        # Write some zeros
-        write_flat_segment(datawriter, 0.0, 10.0)
+def gen_zeros():
+    write_terrain('zeros', flat_segment(0.0, 10.0))
 
 
 def gen_trapezoid(tallest_bump: float, rate: float, t=10.0):
-    # Open for writing. Do not translate newlines.
-    with open(csv_path('trapezoid'), mode='w', newline='') as csvfile:
-        datawriter = csv.writer(csvfile, delimiter=',', quotechar='|', lineterminator='\n')
-
-        # Write the interval
-        datawriter.writerow([INTERVAL])
-
-        # Write a trapezoid
-        write_flat_segment(datawriter, 0.0, t)
-        write_ramp_segment(datawriter, 0.0, tallest_bump, rate)
-        write_flat_segment(datawriter, tallest_bump, t)
-        write_ramp_segment(datawriter, tallest_bump, 0.0, -rate)
+    write_terrain('trapezoid', np.concatenate([
+        flat_segment(0.0, t),
+        ramp_segment(0.0, tallest_bump, rate),
+        flat_segment(tallest_bump, t),
+        ramp_segment(tallest_bump, 0.0, -rate),
+    ]))
 
 
 def gen_sawtooth(tallest_bump: float, rate: float, t=10.0):
-    # Open for writing. Do not translate newlines.
-    with open(csv_path('sawtooth'), mode='w', newline='') as csvfile:
-        datawriter = csv.writer(csvfile, delimiter=',', quotechar='|', lineterminator='\n')
-
-        # Write the interval
-        datawriter.writerow([INTERVAL])
-
-        # Write a sawtooth
-        write_flat_segment(datawriter, 0.0, t)
-        write_flat_segment(datawriter, tallest_bump, t)
-        write_ramp_segment(datawriter, tallest_bump, 0.0, -rate)
+    write_terrain('sawtooth', np.concatenate([
+        flat_segment(0.0, t),
+        flat_segment(tallest_bump, t),
+        ramp_segment(tallest_bump, 0.0, -rate),
+    ]))
 
 
 def gen_square(tallest_bump: float, t=10.0):
-    # Open for writing. Do not translate newlines.
-    with open(csv_path('square'), mode='w', newline='') as csvfile:
-        datawriter = csv.writer(csvfile, delimiter=',', quotechar='|', lineterminator='\n')
-
-        # Write the interval
-        datawriter.writerow([INTERVAL])
-
-        # Write a square wave
-        write_flat_segment(datawriter, 0.0, t)
-        write_flat_segment(datawriter, tallest_bump, t)
+    write_terrain('square', np.concatenate([
+        flat_segment(0.0, t),
+        flat_segment(tallest_bump, t),
+    ]))
 
 
 # Stress PID controllers, test dropout handling
 def gen_stress(tallest_bump=4.0, t=2.0):
-    # Open for writing. Do not translate newlines.
-    with open(csv_path('stress'), mode='w', newline='') as csvfile:
-        datawriter = csv.writer(csvfile, delimiter=',', quotechar='|', lineterminator='\n')
-
-        # Write the interval
-        datawriter.writerow([INTERVAL])
-
+    write_terrain('stress', np.concatenate([
         # Start with a long low segment
-        write_flat_segment(datawriter, 0.0, 4 * t)
+        flat_segment(0.0, 4 * t),
 
         # Dropout, then resume
-        write_dropouts(datawriter, t)
-        write_flat_segment(datawriter, tallest_bump, t)
+        dropout_segment(t),
+        flat_segment(tallest_bump, t),
 
         # Jump to very high segment, with dropout
-        write_flat_segment(datawriter, tallest_bump, t)
+        flat_segment(tallest_bump, t),
 
         # Dropout, then resume
-        write_dropouts(datawriter, t)
-        write_flat_segment(datawriter, tallest_bump, t)
+        dropout_segment(t),
+        flat_segment(tallest_bump, t),
 
         # Dropout, then resume at a very different height
-        write_dropouts(datawriter, t)
-        write_flat_segment(datawriter, 0.0, t)
-        write_flat_segment(datawriter, tallest_bump, t)
+        dropout_segment(t),
+        flat_segment(0.0, t),
+        flat_segment(tallest_bump, t),
+    ]))
 
 
 # Test low signal_quality
 def gen_test_signal_quality():
-    # Open for writing. Do not translate newlines.
-    with open(csv_path('test_signal_quality'), mode='w', newline='') as csvfile:
-        datawriter = csv.writer(csvfile, delimiter=',', quotechar='|', lineterminator='\n')
-
-        # Write the interval
-        datawriter.writerow([INTERVAL])
-
+    write_terrain('test_signal_quality', np.concatenate([
         # Start "on the dock"
-        write_low_signal_quality(datawriter, t=4)
+        low_signal_quality_segment(t=4),
 
         # Normal, in the water
-        write_flat_segment(datawriter, adj=0.0, t=4)
+        flat_segment(adj=0.0, t=4),
 
         # Bad readings
-        write_low_signal_quality(datawriter, t=4)
+        low_signal_quality_segment(t=4),
 
         # Resume, jump
-        write_flat_segment(datawriter, adj=2.0, t=4)
+        flat_segment(adj=2.0, t=4),
+    ]))
 
 
 def main():
+    os.makedirs('terrain', exist_ok=True)
     gen_zeros()
     gen_trapezoid(5.0, 0.2, 20.0)
     gen_sawtooth(1.0, 0.2)
@@ -1,6 +1,18 @@
 #!/usr/bin/env python3
 
+"""
+Graph the merged table for one run and save it as merged.pdf.
+
+Reads merged.csv in $LOG_DIR, or takes the table in memory from ingest.py --graph. The KPIs in metrics.py are
+written to metrics.json; with --metrics-only that is all, nothing is plotted.
+
+Each series is downsampled to --fidelity points before plotting (see downsample.py), so the graph of a long run
+renders as quickly and is as small as the graph of a short one. Use --fidelity 0 to plot every sample.
+"""
+
+import argparse
 import os
+from typing import Optional
 
 import matplotlib
 
@@ -10,9 +22,24 @@ matplotlib.use('pdf')
 import matplotlib.pyplot as plt
 import pandas as pd
 
+from downsample import METHODS, downsample
+from metrics import compute_metrics, write_metrics
+
+# Points per series, about 1 per pixel column at 300 dpi
+DEFAULT_FIDELITY = 2500
 
-def graph_sitl(log_dir):
-    df = pd.read_csv(os.path.join(log_dir, 'merged.csv'))
+
+def graph_sitl(log_dir: str, df: Optional[pd.DataFrame] = None, metrics_only: bool = False,
+               fidelity: int = DEFAULT_FIDELITY, method: str = 'minmax'):
+    if df is None:
+        df = pd.read_csv(os.path.join(log_dir, 'merged.csv'))
+    else:
+        df = df.copy()
+
+    metrics = compute_metrics(df)
+    write_metrics(log_dir, metrics)
+    if metrics_only:
+        return
 
     # Rebase timestamp to start at 0
     start = df['timestamp'][0]
@@ -26,22 +53,26 @@ def graph_sitl(log_dir):
     # Create 1 figure with 3 subplots
     fig, (ax_alt, ax_rf, ax_crt) = plt.subplots(3)
 
+    # Plot a downsampled series, the metrics above use all of the samples
+    def plot(ax, column, label):
+        ax.plot(*downsample(df['timestamp'], df[column], fidelity, method), label=label)
+
     # Add CTUN fields
-    ax_alt.plot('timestamp', 'DAlt', data=df, label='CTUN.DAlt')
-    ax_alt.plot('timestamp', 'Alt', data=df, label='CTUN.Alt')
-    ax_alt.plot('timestamp', 'TAlt', data=df, label='CTUN.TAlt')
+    plot(ax_alt, 'DAlt', 'CTUN.DAlt')
+    plot(ax_alt, 'Alt', 'CTUN.Alt')
+    plot(ax_alt, 'TAlt', 'CTUN.TAlt')
 
-    ax_rf.plot('timestamp', 'DSAlt', data=df, label='CTUN.DSAlt')
-    ax_rf.plot('timestamp', 'SAlt', data=df, label='CTUN.SAlt')
+    plot(ax_rf, 'DSAlt', 'CTUN.DSAlt')
+    plot(ax_rf, 'SAlt', 'CTUN.SAlt')
 
-    ax_crt.plot('timestamp', 'DCRt', data=df, label='CTUN.DCRt')
-    ax_crt.plot('timestamp', 'CRt', data=df, label='CTUN.CRt')
+    plot(ax_crt, 'DCRt', 'CTUN.DCRt')
+    plot(ax_crt, 'CRt', 'CTUN.CRt')
 
     # Add stamped_terrain.csv fields
-    ax_alt.plot('timestamp', 'sub', data=df, label='Older sub pos')
-    ax_alt.plot('timestamp', 'terrain', data=df, label='Older terrain pos')
+    plot(ax_alt, 'sub', 'Older sub pos')
+    plot(ax_alt, 'terrain', 'Older terrain pos')
 
-    ax_rf.plot('timestamp', 'rf', data=df, label='Injected rangefinder')
+    plot(ax_rf, 'rf', 'Injected rangefinder')
 
     ax_alt.legend()
     ax_rf.legend()
@@ -51,15 +82,9 @@ def graph_sitl(log_dir):
     ax_rf.grid(axis='x')
     ax_crt.grid(axis='x')
 
-    def rf_error(row):
-        return abs(row['SAlt'] - row['DSAlt'])
-    df['rf_error'] = df.apply(rf_error, axis=1)
-
-    cr_var = df['CRt'].var()
-    rf_error_sum = df['rf_error'].sum()
-
-    plt.suptitle(f'{log_dir}, CRt var: {cr_var :.2f}, RF error sum: {rf_error_sum :.3f}')
+    plt.suptitle(f'{log_dir}, CRt var: {metrics["crt_var"] :.2f}, RF error sum: {metrics["rf_error_sum_m"] :.3f}')
     plt.savefig(os.path.join(log_dir, 'merged.pdf'))
+    plt.close(fig)
 
 
 # Set defaults
@@ -67,6 +92,22 @@ plt.rcParams['figure.figsize'] = [8.5, 11.0]
 plt.rcParams['font.size'] = 9
 plt.rcParams['lines.linewidth'] = 0.5
 
-log_dir = os.getenv('LOG_DIR')
 
-graph_sitl(log_dir)
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('log_dir', nargs='?', default=os.getenv('LOG_DIR'),
+                        help='directory with merged.csv, default $LOG_DIR')
+    parser.add_argument('--metrics-only', action='store_true', help='write metrics.json, do not plot')
+    parser.add_argument('--fidelity', type=int, default=DEFAULT_FIDELITY,
+                        help=f'points per series, 0 for all, default {DEFAULT_FIDELITY}')
+    parser.add_argument('--downsample', choices=METHODS, default='minmax', help='downsampling method, default minmax')
+    args = parser.parse_args()
+
+    if args.log_dir is None:
+        parser.error('log_dir is required if LOG_DIR is not set')
+
+    graph_sitl(args.log_dir, metrics_only=args.metrics_only, fidelity=args.fidelity, method=args.downsample)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+"""
+Read a dataflash log and the stamped terrain log straight into memory, and merge them on TimeUS.
+
+This replaces `mavlogdump.py --types CTUN --format csv` followed by merge_logs.py. Each message type is decoded into
+numpy columns in one pass: DFReader indexes the log, then all messages of a type are gathered from the memory-mapped
+file and viewed as a structured array.
+
+The first type (CTUN by default) is the base table. The stamped terrain log and any other types (e.g., RFND) are
+joined onto it "as of" each row: the most recent row at or before that TimeUS, if it is no older than the tolerance.
+Otherwise the joined columns are NaN, so a gap in the data shows up as a gap in the graph.
+
+Columns of the other types are prefixed with the type, e.g., RFND.Dist.
+
+Example, with LOG_DIR set as for process_sitl.bash:
+    ingest.py --graph
+
+Example, write metrics.json and skip the graph:
+    ingest.py --metrics-only
+
+Example, also join RFND:
+    ingest.py results/sitl/surftrak/trapezoid --types CTUN RFND
+"""
+
+import argparse
+import glob
+import os
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from pymavlink import DFReader
+
+# Same health check as AP_RangeFinder_MAVLink: a reading older than 500ms is stale
+DEFAULT_TOLERANCE_S = 0.5
+
+# DFReader struct codes to little-endian numpy types
+STRUCT_TO_DTYPE = {
+    'b': 'i1', 'B': 'u1', 'h': '<i2', 'H': '<u2', 'i': '<i4', 'I': '<u4', 'q': '<i8', 'Q': '<u8',
+    'e': '<f2', 'f': '<f4', 'd': '<f8', '4s': 'S4', '16s': 'S16', '64s': 'S64',
+}
+
+
+def message_dtype(fmt: DFReader.DFFormat) -> np.dtype:
+    """
+    A packed structured dtype matching the body of a message
+    """
+    names, formats = [], []
+    for column, c in zip(fmt.columns, fmt.msg_fmts):
+        names.append(column)
+        formats.append(STRUCT_TO_DTYPE[DFReader.FORMAT_TO_STRUCT[c][0]])
+    return np.dtype({'names': names, 'formats': formats})
+
+
+def read_columns(reader: DFReader.DFReader_binary, msg_type: str) -> Optional[dict[str, np.ndarray]]:
+    """
+    Decode all messages of one type into columns, or return None if the log doesn't have any
+
+    Scaled fields (e.g., centi-degrees) are multiplied out, as DFReader does. A 'timestamp' column (seconds since the
+    epoch, as in mavlogdump.py output) is added if the type has a TimeUS column.
+    """
+    if msg_type not in reader.name_to_id:
+        return None
+    type_id = reader.name_to_id[msg_type]
+    fmt = reader.formats[type_id]
+
+    # Skip a message cut off at the end of the log
+    offsets = np.asarray(reader.offsets[type_id], dtype=np.int64)
+    offsets = offsets[offsets + fmt.len <= reader.data_len]
+    if len(offsets) == 0:
+        return None
+
+    # Gather the message bodies (without the 3 byte header) and view them as records
+    data = np.frombuffer(reader.data_map, dtype=np.uint8)
+    bodies = data[offsets[:, np.newaxis] + np.arange(3, fmt.len)]
+    records = bodies.view(message_dtype(fmt)).ravel()
+
+    columns = {}
+    for column, mult in zip(fmt.columns, fmt.msg_mults):
+        values = records[column]
+        if values.dtype.kind == 'S':
+            values = np.char.decode(values, 'ascii', 'replace')
+        elif mult is not None:
+            values = values * mult
+        elif values.dtype.kind == 'f':
+            values = values.astype(np.float64)
+        columns[column] = values
+
+    if 'TimeUS' in columns:
+        # DFReader works out the time base (e.g., from GPS), use it to stamp the first message and carry it forward
+        reader.rewind()
+        first = reader.recv_match(type=msg_type)
+        base = first._timestamp - first.TimeUS * 1e-6 if first is not None else 0.0
+        columns = {'timestamp': base + columns['TimeUS'] * 1e-6, **columns}
+
+    return columns
+
+
+def read_dataflash(path: str, msg_types: list[str]) -> dict[str, pd.DataFrame]:
+    """
+    Read several message types from a dataflash log, types that aren't in the log are left out
+    """
+    reader = DFReader.DFReader_binary(path)
+    try:
+        frames = {}
+        for msg_type in msg_types:
+            columns = read_columns(reader, msg_type)
+            if columns is not None:
+                frames[msg_type] = pd.DataFrame(columns)
+        return frames
+    finally:
+        reader.filehandle.close()
+
+
+def read_stamped_terrain(log_dir: str) -> pd.DataFrame:
+    """
+    Read stamped_terrain.npz if sitl_runner.py --npz wrote one, otherwise stamped_terrain.csv
+    """
+    csv_path = os.path.join(log_dir, 'stamped_terrain.csv')
+    npz_path = os.path.join(log_dir, 'stamped_terrain.npz')
+    if os.path.exists(npz_path) and (not os.path.exists(csv_path) or
+                                     os.path.getmtime(npz_path) >= os.path.getmtime(csv_path)):
+        with np.load(npz_path) as data:
+            return pd.DataFrame({name: data[name] for name in data.files})
+    return pd.read_csv(csv_path)
+
+
+def join_asof(left: pd.DataFrame, right: pd.DataFrame, tolerance_s: float, prefix: str = '') -> pd.DataFrame:
+    """
+    For each row of left, take the most recent row of right (on TimeUS) that is no older than tolerance_s
+    """
+    right = right.drop(columns=['timestamp'], errors='ignore')
+    if prefix:
+        right = right.rename(columns={name: prefix + name for name in right.columns if name != 'TimeUS'})
+
+    # The log has unsigned TimeUS, the terrain log signed, the keys must match
+    left = left.astype({'TimeUS': np.int64}).sort_values('TimeUS', kind='stable')
+    right = right.astype({'TimeUS': np.int64}).sort_values('TimeUS', kind='stable')
+    return pd.merge_asof(left, right, on='TimeUS', direction='backward', tolerance=int(tolerance_s * 1e6))
+
+
+def ingest(log_dir: str, bin_file: Optional[str] = None, msg_types: Optional[list[str]] = None,
+           tolerance_s: float = DEFAULT_TOLERANCE_S, write_csv: bool = True) -> pd.DataFrame:
+    """
+    Build the merged table for one run, optionally also write merged.csv
+    """
+    if bin_file is None:
+        bin_files = glob.glob(os.path.join(log_dir, '*.BIN'))
+        if len(bin_files) != 1:
+            raise FileNotFoundError(f'{log_dir}: expected 1 dataflash log, found {len(bin_files)}')
+        bin_file = bin_files[0]
+    msg_types = msg_types or ['CTUN']
+
+    frames = read_dataflash(bin_file, msg_types)
+    if msg_types[0] not in frames:
+        raise ValueError(f'{bin_file}: no {msg_types[0]} messages')
+
+    merged = join_asof(frames[msg_types[0]], read_stamped_terrain(log_dir), tolerance_s)
+    for msg_type in msg_types[1:]:
+        if msg_type in frames:
+            merged = join_asof(merged, frames[msg_type], tolerance_s, prefix=f'{msg_type}.')
+        else:
+            print(f'{bin_file}: no {msg_type} messages')
+
+    if write_csv:
+        merged.to_csv(os.path.join(log_dir, 'merged.csv'), index=False)
+        print('merged.csv written')
+
+    return merged
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('log_dir', nargs='?', default=os.getenv('LOG_DIR'),
+                        help='directory with the dataflash log and stamped_terrain.csv, default $LOG_DIR')
+    parser.add_argument('--bin', type=str, default=None, help='dataflash log, default the only *.BIN in log_dir')
+    parser.add_argument('--types', nargs='+', default=['CTUN'], help='message types, the first is the base table')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE_S,
+                        help=f'as-of join tolerance in seconds, default {DEFAULT_TOLERANCE_S}')
+    parser.add_argument('--no-csv', action='store_true', help='do not write merged.csv')
+    parser.add_argument('--graph', action='store_true', help='graph the merged table, see graph_sitl.py')
+    parser.add_argument('--metrics-only', action='store_true',
+                        help='write metrics.json without importing matplotlib, see metrics.py')
+    args = parser.parse_args()
+
+    if args.log_dir is None:
+        parser.error('log_dir is required if LOG_DIR is not set')
+
+    merged = ingest(args.log_dir, args.bin, args.types, args.tolerance, not args.no_csv)
+
+    if args.metrics_only:
+        from metrics import compute_metrics, write_metrics
+        write_metrics(args.log_dir, compute_metrics(merged))
+    elif args.graph:
+        from graph_sitl import graph_sitl
+        graph_sitl(args.log_dir, merged)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""
+Opt-in latency instrumentation for the rangefinder injection loop, see sitl_runner.py --profile
+
+Stage timers split each iteration into laps:
+    lap = profiler.start()
+    ...
+    lap = profiler.lap('recv', lap)
+    ...
+    lap = profiler.lap('send', lap)
+
+Each stage and each latency gets an HDR-style histogram: log-linear buckets with a fixed relative error, so a
+histogram is small and record() is cheap whether the values are 100ns or 10s. Latencies can be negative, e.g., a
+reading that used a position newer than requested, so the histograms are signed. A disabled Profiler does nothing.
+"""
+
+import json
+import time
+from typing import Iterator, Optional
+
+
+class Histogram:
+    """
+    Count integer values (ns) in buckets that are never wider than 1 / SUB_BUCKETS of their value.
+
+    Values below SUB_BUCKETS get a bucket each. Above that, each power of 2 is split into SUB_BUCKETS buckets.
+    Negative values are bucketed by magnitude in a second list.
+    """
+
+    SUB_BITS = 6
+    SUB_BUCKETS = 1 << SUB_BITS
+
+    def __init__(self):
+        self.counts: list[int] = []
+        self.negative_counts: list[int] = []
+        self.count = 0
+        self.total = 0
+        self.min: Optional[int] = None
+        self.max: Optional[int] = None
+
+    @staticmethod
+    def index(value: int) -> int:
+        e = value.bit_length() - Histogram.SUB_BITS
+        if e <= 0:
+            return value
+        return e * Histogram.SUB_BUCKETS + (value >> (e - 1)) - Histogram.SUB_BUCKETS
+
+    @staticmethod
+    def lowest(i: int) -> int:
+        """
+        Smallest value in bucket i
+        """
+        e, m = divmod(i, Histogram.SUB_BUCKETS)
+        if e == 0:
+            return i
+        return (m + Histogram.SUB_BUCKETS) << (e - 1)
+
+    @staticmethod
+    def middle(i: int) -> int:
+        """
+        Middle value in bucket i
+        """
+        return (Histogram.lowest(i) + Histogram.lowest(i + 1) - 1) // 2
+
+    def record(self, value: int):
+        counts = self.counts if value >= 0 else self.negative_counts
+        i = Histogram.index(abs(value))
+        if i >= len(counts):
+            counts.extend([0] * (i + 1 - len(counts)))
+        counts[i] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def buckets(self) -> Iterator[tuple[int, int]]:
+        """
+        Yield (middle value, count) for each bucket, lowest value first
+        """
+        for i in range(len(self.negative_counts) - 1, -1, -1):
+            yield -Histogram.middle(i), self.negative_counts[i]
+        for i, n in enumerate(self.counts):
+            yield Histogram.middle(i), n
+
+    def percentile(self, p: float) -> int:
+        """
+        Smallest value that at least p percent of the values are less than or equal to, within a bucket width
+        """
+        if self.count == 0:
+            return 0
+        target = max(1, int(p / 100.0 * self.count + 0.5))
+        seen = 0
+        for value, n in self.buckets():
+            seen += n
+            if seen >= target:
+                # Report the middle of the bucket, but never outside the values we saw
+                return min(self.max, max(self.min, value))
+        return self.max
+
+    def summary(self, scale: float = 1e-3) -> dict:
+        """
+        Count, mean, min, percentiles and max, in ns * scale (default us)
+        """
+        if self.count == 0:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean': self.total / self.count * scale,
+            'min': self.min * scale,
+            'p50': self.percentile(50) * scale,
+            'p90': self.percentile(90) * scale,
+            'p99': self.percentile(99) * scale,
+            'p99.9': self.percentile(99.9) * scale,
+            'max': self.max * scale,
+        }
+
+
+class Profiler:
+    """
+    Stage timers (wall time, us) and latencies (sim time, ms), each in a Histogram
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.stages: dict[str, Histogram] = {}
+        self.latencies: dict[str, Histogram] = {}
+
+        # Cost of a lap(), not subtracted from the stages but reported, so the readers can judge the short ones
+        self.overhead_ns = self.measure_overhead() if enabled else 0
+
+    def measure_overhead(self, n: int = 10000) -> int:
+        stages, self.stages = self.stages, {}
+        lap = self.start()
+        begin = time.perf_counter_ns()
+        for _ in range(n):
+            lap = self.lap('overhead', lap)
+        overhead = (time.perf_counter_ns() - begin) // n
+        self.stages = stages
+        return overhead
+
+    def start(self) -> int:
+        return time.perf_counter_ns() if self.enabled else 0
+
+    def lap(self, stage: str, start: int) -> int:
+        """
+        Record the time since start as stage, return the new start
+        """
+        if not self.enabled:
+            return 0
+        now = time.perf_counter_ns()
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = Histogram()
+        histogram.record(now - start)
+        return now
+
+    def latency(self, name: str, seconds: float):
+        if not self.enabled:
+            return
+        histogram = self.latencies.get(name)
+        if histogram is None:
+            histogram = self.latencies[name] = Histogram()
+        histogram.record(int(seconds * 1e9))
+
+    def summary(self) -> dict:
+        return {
+            'overhead_us': self.overhead_ns * 1e-3,
+            'stages_us': {name: h.summary() for name, h in self.stages.items()},
+            'latencies_ms': {name: h.summary(1e-6) for name, h in self.latencies.items()},
+        }
+
+    def write(self, path: str, **extra):
+        if not self.enabled:
+            return
+        with open(path, 'w') as f:
+            json.dump({**extra, **self.summary()}, f, indent=2)
+
+    def report(self) -> list[str]:
+        """
+        One line per stage and latency
+        """
+        lines = [f'{"stage (us)" :24}{"count" :>8}{"mean" :>10}{"p50" :>10}{"p99" :>10}{"max" :>10}']
+        for name, h in self.stages.items():
+            s = h.summary()
+            lines.append(f'{name :24}{s["count"] :8d}{s["mean"] :10.1f}{s["p50"] :10.1f}{s["p99"] :10.1f}'
+                         f'{s["max"] :10.1f}')
+        lines.append(f'{"latency (ms)" :24}{"count" :>8}{"mean" :>10}{"p50" :>10}{"p99" :>10}{"max" :>10}')
+        for name, h in self.latencies.items():
+            s = h.summary(1e-6)
+            if s['count']:
+                lines.append(f'{name :24}{s["count"] :8d}{s["mean"] :10.1f}{s["p50"] :10.1f}{s["p99"] :10.1f}'
+                             f'{s["max"] :10.1f}')
+        return lines
@@ -2,10 +2,15 @@
 More MAVLink Python utility functions
 """
 
+import collections
+import json
+import math
 import os
+import select
 import struct
 import threading
 import time
+from typing import Callable, Optional
 
 from pymavlink.dialects.v20 import ardupilotmega as apm2
 
@@ -25,18 +30,197 @@ def set_message_interval(conn: mavutil.mavfile, msg_id: int, msg_rate: int):
         msg_id, int(1e6 / msg_rate), 0, 0, 0, 0, 0))
 
 
+def disable_message(conn: mavutil.mavfile, msg_id: int):
+    """
+    Turn off a message stream, an interval of -1 means never send it
+    """
+    conn.mav.send(apm2.MAVLink_command_long_message(
+        1, 1, apm2.MAV_CMD_SET_MESSAGE_INTERVAL, 0,
+        msg_id, -1, 0, 0, 0, 0, 0))
+
+
+class MsgDispatcher:
+    """
+    Receive messages and dispatch them by message id, decoding only the messages that have a handler.
+
+    recv_match() decodes every message on the link and compares type names, so the receive cost follows the link
+    traffic. This class frames the raw bytes itself and reads the message id from the header: messages without a
+    handler are counted and skipped without being decoded. The link is TCP, so only decoded messages are CRC checked.
+
+    This reads the socket directly and does not update conn.messages or conn.motors_armed(). Use it as a context
+    manager after startup: the bytes that the mavfile has buffered are taken over on entry and handed back on exit.
+    """
+
+    # Don't turn these off, even if nobody is listening
+    NEVER_TRIM = {apm2.MAVLINK_MSG_ID_HEARTBEAT, apm2.MAVLINK_MSG_ID_COMMAND_ACK, apm2.MAVLINK_MSG_ID_STATUSTEXT}
+
+    # The longest header we peek at
+    HEADER_LEN = 10
+
+    def __init__(self, conn: mavutil.mavfile, handlers: dict[int, Callable]):
+        self.conn = conn
+        self.handlers = handlers
+        self.buf = bytearray()
+
+        # msg_id: [count, bytes, decoded, decode seconds]
+        self.counts: dict[int, list] = {}
+        self.junk_bytes = 0
+        self.bad_msgs = 0
+        self.trimmed: list[int] = []
+
+    def __enter__(self):
+        mav = self.conn.mav
+        self.buf += mav.buf[mav.buf_index:]
+        mav.buf = bytearray()
+        mav.buf_index = 0
+        mav.expected_length = apm2.HEADER_LEN_V1 + 2
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        mav = self.conn.mav
+        mav.buf = self.buf + mav.buf[mav.buf_index:]
+        mav.buf_index = 0
+        self.buf = bytearray()
+
+    def parse(self, wall_time: float) -> int:
+        """
+        Dispatch the complete messages in the buffer, return the number of messages handled
+        """
+        buf = self.buf
+        n = len(buf)
+        i = 0
+        handled = 0
+        while n - i >= MsgDispatcher.HEADER_LEN:
+            marker = buf[i]
+            if marker == apm2.PROTOCOL_MARKER_V2:
+                size = buf[i + 1] + 12 + (apm2.MAVLINK_SIGNATURE_BLOCK_LEN if buf[i + 2] & apm2.MAVLINK_IFLAG_SIGNED
+                                          else 0)
+                msg_id = buf[i + 7] | buf[i + 8] << 8 | buf[i + 9] << 16
+            elif marker == apm2.PROTOCOL_MARKER_V1:
+                size = buf[i + 1] + 8
+                msg_id = buf[i + 5]
+            else:
+                # Out of sync, skip to the next marker
+                j = buf.find(apm2.PROTOCOL_MARKER_V2, i + 1)
+                k = buf.find(apm2.PROTOCOL_MARKER_V1, i + 1)
+                j = n if j < 0 else j
+                k = n if k < 0 else k
+                self.junk_bytes += min(j, k) - i
+                i = min(j, k)
+                continue
+
+            if n - i < size:
+                break
+
+            counts = self.counts.get(msg_id)
+            if counts is None:
+                counts = self.counts[msg_id] = [0, 0, 0, 0.0]
+            counts[0] += 1
+            counts[1] += size
+
+            handler = self.handlers.get(msg_id)
+            if handler is not None:
+                start = time.perf_counter()
+                try:
+                    msg = self.conn.mav.decode(buf[i:i + size])
+                except apm2.MAVError:
+                    # Not a message after all, look for the next marker
+                    self.bad_msgs += 1
+                    self.junk_bytes += 1
+                    i += 1
+                    continue
+                counts[2] += 1
+                counts[3] += time.perf_counter() - start
+                msg._timestamp = wall_time
+                handler(msg)
+                handled += 1
+            i += size
+
+        del buf[:i]
+        return handled
+
+    def poll(self) -> int:
+        """
+        Dispatch everything that has arrived, don't block. Return the number of messages handled.
+        """
+        handled = 0
+        while data := self.conn.recv(65536):
+            self.buf += data
+            handled += self.parse(time.time())
+        return handled
+
+    def wait(self, timeout: Optional[float] = None) -> int:
+        """
+        Block until at least 1 message has been handled or timeout seconds have passed
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            handled = self.poll()
+            if handled:
+                return handled
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                return 0
+            # The port is None while reconnecting, poll() reconnects
+            if self.conn.port is not None:
+                select.select([self.conn.port], [], [], 0.1 if remaining is None else min(0.1, remaining))
+
+    def trim_streams(self, min_count: int = 2) -> list[str]:
+        """
+        Turn off the streams that we've seen at least min_count times but don't handle, return their names
+        """
+        names = []
+        for msg_id, counts in self.counts.items():
+            if (counts[0] >= min_count and msg_id not in self.handlers and msg_id not in MsgDispatcher.NEVER_TRIM
+                    and msg_id not in self.trimmed):
+                disable_message(self.conn, msg_id)
+                self.trimmed.append(msg_id)
+                names.append(MsgDispatcher.msg_name(msg_id))
+        return names
+
+    @staticmethod
+    def msg_name(msg_id: int) -> str:
+        msg_type = apm2.mavlink_map.get(msg_id)
+        return msg_type.msgname if msg_type is not None else str(msg_id)
+
+    def stats(self) -> dict:
+        received = sum(counts[0] for counts in self.counts.values())
+        decoded = sum(counts[2] for counts in self.counts.values())
+        decode_s = sum(counts[3] for counts in self.counts.values())
+        return {
+            'received': received,
+            'decoded': decoded,
+            'decode_us': decode_s / decoded * 1e6 if decoded else 0.0,
+            'junk_bytes': self.junk_bytes,
+            'bad_msgs': self.bad_msgs,
+            'trimmed': [MsgDispatcher.msg_name(msg_id) for msg_id in self.trimmed],
+            'types': {
+                MsgDispatcher.msg_name(msg_id): {
+                    'count': count,
+                    'bytes': size,
+                    'decoded': decoded,
+                    'decode_us': decode_s / decoded * 1e6 if decoded else 0.0,
+                } for msg_id, (count, size, decoded, decode_s) in sorted(self.counts.items(), key=lambda kv: -kv[1][0])
+            },
+        }
+
+    def write_stats(self, path: str):
+        with open(path, 'w') as f:
+            json.dump(self.stats(), f, indent=2)
+
+
 class RCThread(threading.Thread):
     """
-    Send RC input to ArduSub on port 127.0.0.1:5501.
+    Send RC input to ArduSub on port 127.0.0.1:5501 (or 5501 + 10 * instance).
     """
 
-    def __init__(self, speedup: float):
+    def __init__(self, speedup: float, port: int = 5501):
         threading.Thread.__init__(self)
         self.lock = threading.Lock()
         self.thead_should_quit = False
         self.speedup = speedup
         self.channels = [1500] * 6 + [1000] * 10
-        self.udp_port = mavutil.mavudp('127.0.0.1:5501', input=False)
+        self.udp_port = mavutil.mavudp(f'127.0.0.1:{port}', input=False)
 
     def run(self):
         while True:
@@ -69,6 +253,20 @@ def move_to_depth(conn: mavutil.mavfile, rc_thread: RCThread, target: float):
     rc_thread.set_rc_channels(1500)
 
 
+def force_disarm(conn: mavutil.mavfile, timeout: float = 5.0):
+    """
+    Disarm even if the vehicle is moving, and wait for a HEARTBEAT that confirms it
+    """
+    conn.mav.command_long_send(conn.target_system, conn.target_component, apm2.MAV_CMD_COMPONENT_ARM_DISARM, 0,
+                               0, 21196, 0, 0, 0, 0, 0)
+    start = time.time()
+    while time.time() - start < timeout:
+        msg = conn.recv_match(type='HEARTBEAT', blocking=True, timeout=1)
+        if msg is not None and not conn.motors_armed():
+            return
+    print('Timeout waiting for disarm')
+
+
 def get_boot_count(conn: mavutil.mavfile):
     """
     Get the value of the STAT_BOOTCNT parameter
@@ -154,14 +352,193 @@ class SimClock:
     def sleep(self, d: float):
         time.sleep(d / self.speedup)
 
+    def wall_time_until(self, t: float) -> float:
+        """Wall time until time-since-boot reaches t, 0 if we're already past t"""
+        return max(0.0, (t - self.rough_time_s()) / self.speedup)
 
-def get_sim_clock(conn: mavutil.mavfile, speedup: float) -> SimClock:
+    def sleep_until(self, t: float):
+        """Sleep until time-since-boot reaches t, return immediately if we're already past t"""
+        d = self.wall_time_until(t)
+        if d > 0:
+            time.sleep(d)
+
+    def stats(self) -> dict:
+        return {'requested_speedup': self.speedup}
+
+
+class LockedSimClock(SimClock):
     """
-    Wait for a GLOBAL_POSITION_INT message and use it to create a SimClock object
+    A SimClock that is locked to the ArduSub clock by fitting a line through (wall time, sim time) samples.
+
+    Samples come from time_boot_ms fields (SYSTEM_TIME, GLOBAL_POSITION_INT) and from TIMESYNC round trips. The fit is
+    an exponentially weighted least squares fit, so the estimated rate follows the SITL as it speeds up or slows down.
+    The rate is the actual speedup, which may be quite different from the requested speedup if the SITL can't keep up.
     """
-    sim_clock = SimClock(speedup)
+
+    # Each new sample multiplies the weight of the older samples by this
+    FORGET = 0.98
+
+    # Use the requested speedup until we have this many samples
+    MIN_SAMPLES = 5
+
+    # Send a TIMESYNC request this often, in seconds of wall time
+    TIMESYNC_INTERVAL = 0.2
+
+    # Reject samples that are further than this from the fit, e.g., messages that sat in the socket buffer
+    MIN_GATE_S = 0.1
+    GATE_SIGMAS = 6.0
+
+    # Start a new fit if samples have been rejected for this long, in seconds of wall time: the SITL has changed speed.
+    # A backlog of messages is drained much faster than this.
+    MAX_REJECT_S = 1.0
+
+    def __init__(self, speedup: float):
+        super().__init__(speedup)
+
+        # Fit sim - sim0 = offset + rate * (wall - wall0), wall0 and sim0 keep the sums small
+        self.wall0: Optional[float] = None
+        self.sim0: float = 0.0
+        self.rate: float = speedup
+        self.offset: float = 0.0
+        self.residual_var: float = 0.0
+        self.samples = 0
+
+        # Exponentially weighted sums
+        self.sw = self.sx = self.sy = self.sxx = self.sxy = self.syy = 0.0
+        self.first_reject_wall_time: Optional[float] = None
+
+        # Wall time of the last TIMESYNC request
+        self.timesync_wall_time: float = 0.0
+
+    def reset_fit(self, sim_s: float, wall_s: float):
+        self.wall0 = wall_s
+        self.sim0 = sim_s
+        self.sw = self.sx = self.sy = self.sxx = self.sxy = self.syy = 0.0
+        self.samples = 0
+        self.first_reject_wall_time = None
+
+    def add_sample(self, sim_s: float, wall_s: float):
+        if self.wall0 is None:
+            self.reset_fit(sim_s, wall_s)
+
+        x = wall_s - self.wall0
+        y = sim_s - self.sim0
+
+        # Until we have MIN_SAMPLES the prediction uses the requested speedup
+        if self.samples > 0:
+            gate = max(LockedSimClock.MIN_GATE_S, LockedSimClock.GATE_SIGMAS * self.error_s())
+            if abs(y - (self.offset + self.rate * x)) > gate:
+                if self.first_reject_wall_time is None:
+                    self.first_reject_wall_time = wall_s
+                if wall_s - self.first_reject_wall_time < LockedSimClock.MAX_REJECT_S:
+                    return
+                self.reset_fit(sim_s, wall_s)
+                x = y = 0.0
+            self.first_reject_wall_time = None
+
+        f = LockedSimClock.FORGET
+        self.sw = self.sw * f + 1.0
+        self.sx = self.sx * f + x
+        self.sy = self.sy * f + y
+        self.sxx = self.sxx * f + x * x
+        self.sxy = self.sxy * f + x * y
+        self.syy = self.syy * f + y * y
+        self.samples += 1
+
+        x_bar = self.sx / self.sw
+        y_bar = self.sy / self.sw
+        var_x = self.sxx / self.sw - x_bar * x_bar
+        cov_xy = self.sxy / self.sw - x_bar * y_bar
+        var_y = self.syy / self.sw - y_bar * y_bar
+
+        if self.samples >= LockedSimClock.MIN_SAMPLES and var_x > 1e-9:
+            self.rate = cov_xy / var_x
+            self.offset = y_bar - self.rate * x_bar
+            self.residual_var = max(0.0, var_y - self.rate * cov_xy)
+        else:
+            # Not enough samples, extrapolate from the latest sample at the requested speedup
+            self.rate = self.speedup
+            self.offset = y - self.rate * x
+
+    def update(self, msg_time_boot_ms: int, wall_time: Optional[float] = None):
+        """
+        Add a sample from a time_boot_ms field, wall_time is when the message arrived
+        """
+        self.msg_time_boot_ms = max(self.msg_time_boot_ms, msg_time_boot_ms)
+        self.wall_time = time.time() if wall_time is None else wall_time
+        self.add_sample(msg_time_boot_ms / 1000.0, self.wall_time)
+
+    def send_timesync(self, conn: mavutil.mavfile):
+        """
+        Send a TIMESYNC request if one is due. ArduSub responds with tc1 = time-since-boot in ns.
+        """
+        now = time.time()
+        if now - self.timesync_wall_time > LockedSimClock.TIMESYNC_INTERVAL:
+            self.timesync_wall_time = now
+            conn.mav.timesync_send(0, int(now * 1e9))
+
+    def handle_timesync(self, msg) -> Optional[float]:
+        """
+        Add a sample from a TIMESYNC response, assume the request and response took the same time.
+        Return the round trip in seconds of wall time, None if the message was not used.
+        """
+        if msg.tc1 == 0:
+            # This is a request, not a response
+            return None
+        now = time.time()
+        sent = msg.ts1 * 1e-9
+        if 0 < now - sent < 1.0:
+            self.add_sample(msg.tc1 * 1e-9, (sent + now) / 2)
+            return now - sent
+        return None
+
+    def error_s(self) -> float:
+        """RMS error of the fit, in seconds of sim time"""
+        return math.sqrt(self.residual_var)
+
+    def time_at_s(self, wall_time: float) -> float:
+        """Best estimate of time-since-boot at a wall time, e.g., when a message arrived"""
+        if self.wall0 is None:
+            return 0.0
+        return self.sim0 + self.offset + self.rate * (wall_time - self.wall0)
+
+    def rough_time_s(self) -> float:
+        """Best estimate of time-since-boot"""
+        return self.time_at_s(time.time())
+
+    def conservative_time_s(self) -> float:
+        """Best estimate of time-since-boot minus 2 sigma"""
+        return self.rough_time_s() - 2 * self.error_s()
+
+    def monotonic_time_s(self) -> float:
+        """Best estimate of time-since-boot, guaranteed to be monotonic"""
+        # The fit moves a little with each new sample, hold the clock still rather than go backwards
+        self.last_monotonic_time_s = max(self.rough_time_s(), self.last_monotonic_time_s)
+        return self.last_monotonic_time_s
+
+    def sleep(self, d: float):
+        time.sleep(d / self.rate)
+
+    def wall_time_until(self, t: float) -> float:
+        """Wall time until time-since-boot reaches t, 0 if we're already past t"""
+        return max(0.0, (t - self.rough_time_s()) / self.rate)
+
+    def stats(self) -> dict:
+        return {
+            'requested_speedup': self.speedup,
+            'estimated_speedup': self.rate,
+            'error_s': self.error_s(),
+            'samples': self.samples,
+        }
+
+
+def get_sim_clock(conn: mavutil.mavfile, speedup: float) -> LockedSimClock:
+    """
+    Wait for a GLOBAL_POSITION_INT message and use it to create a LockedSimClock object
+    """
+    sim_clock = LockedSimClock(speedup)
     gpi_msg = conn.recv_match(type='GLOBAL_POSITION_INT', blocking=True)
-    sim_clock.update(gpi_msg.time_boot_ms)
+    sim_clock.update(gpi_msg.time_boot_ms, gpi_msg._timestamp)
     return sim_clock
 
 
@@ -173,15 +550,118 @@ class RebootFailedException(Exception):
     pass
 
 
+def fetch_param_list(conn: mavutil.mavfile, timeout: float = 10.0) -> dict[str, float]:
+    """
+    Send PARAM_REQUEST_LIST and collect all parameters. Request missing parameters by index if the stream stalls.
+    """
+    values: dict[int, tuple[str, float]] = {}
+    count = None
+    deadline = time.time() + timeout
+
+    conn.mav.param_request_list_send(conn.target_system, conn.target_component)
+    while count is None or len(values) < count:
+        if time.time() > deadline:
+            raise TimeoutError(f'PARAM_REQUEST_LIST got {len(values)} of {count} parameters')
+
+        msg = conn.recv_match(type='PARAM_VALUE', blocking=True, timeout=0.2)
+        if msg is None:
+            if count is None:
+                conn.mav.param_request_list_send(conn.target_system, conn.target_component)
+            else:
+                # Stay inside ArduPilot's request queue, see ParamExchange
+                missing = [i for i in range(count) if i not in values][:ParamExchange.WINDOW]
+                for i in missing:
+                    conn.mav.param_request_read_send(conn.target_system, conn.target_component, b'', i)
+            continue
+
+        # Replies to PARAM_SET and PARAM_REQUEST_READ by name may have index 65535
+        if msg.param_index < msg.param_count:
+            count = msg.param_count
+            values[msg.param_index] = (msg.param_id, msg.param_value)
+
+    return dict(values.values())
+
+
 class Parameter:
     def __init__(self, param_id: str, param_value: float, param_type: int):
         self.param_id = param_id
         self.param_value = param_value
         self.param_type = param_type
         self.verified = False  # True if we saw a PARAM_VALUE message with this id and value
+        self.actual: Optional[float] = None  # Value in the most recent PARAM_VALUE message with this id
+
+    def matches(self, param_value: float) -> bool:
+        # Values travel as float32, allow for rounding at both ends
+        return abs(self.param_value - param_value) <= max(ParameterList.TOLERANCE, 1e-6 * abs(self.param_value))
+
+
+class ParamExchange:
+    """
+    Send a request (PARAM_SET or PARAM_REQUEST_READ) for each unverified parameter and verify the PARAM_VALUE replies.
+
+    At most WINDOW requests are in flight: ArduPilot queues PARAM_REQUEST_READ messages in a small buffer and drops
+    the rest. A request that isn't answered within TIMEOUT seconds is re-sent, up to RETRIES times.
+
+    This class doesn't send or receive on its own, see ParameterList.exchange() and async_runner.py.
+    """
+
+    WINDOW = 10
+    TIMEOUT = 0.5
+    RETRIES = 3
+
+    def __init__(self, param_list: 'ParameterList', send, window: int = WINDOW, timeout: float = TIMEOUT,
+                 retries: int = RETRIES):
+        self.param_list = param_list
+        self.send = send
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries
+
+        param_list.reset_verified()
+        self.pending = collections.deque(param_list.params.values())
+
+        # param_id -> (wall time sent, attempts)
+        self.in_flight: dict[str, tuple[float, int]] = {}
+
+    def pump(self, now: float):
+        """
+        Re-send requests that timed out, give up on requests that ran out of retries, then fill the window
+        """
+        for param_id, (sent, attempts) in list(self.in_flight.items()):
+            if now - sent > self.timeout:
+                if attempts < self.retries:
+                    self.send(self.param_list.params[param_id])
+                    self.in_flight[param_id] = (now, attempts + 1)
+                else:
+                    del self.in_flight[param_id]
+
+        while self.pending and len(self.in_flight) < self.window:
+            p = self.pending.popleft()
+            self.send(p)
+            self.in_flight[p.param_id] = (now, 1)
+
+    def handle(self, msg):
+        """
+        Handle a PARAM_VALUE message. A mismatch might be a stale value, so keep waiting for that one.
+        """
+        if self.param_list.verify(msg.param_id, msg.param_value):
+            self.in_flight.pop(msg.param_id, None)
+
+    def done(self) -> bool:
+        return not self.pending and not self.in_flight
+
+    def next_timeout(self, now: float) -> float:
+        """
+        How long to wait for a PARAM_VALUE message before calling pump() again
+        """
+        if not self.in_flight:
+            return 0.0
+        return max(0.01, min(sent for sent, _ in self.in_flight.values()) + self.timeout - now)
 
 
 class ParameterList:
+    TOLERANCE = 0.001
+
     @staticmethod
     def parse_param(line: str) -> Parameter or None:
         # Split on whitespace (tabs, spaces)
@@ -189,74 +669,112 @@ class ParameterList:
         return Parameter(fields[2], float(fields[3]), int(fields[4]))
 
     @staticmethod
-    def parse_params(path) -> list[Parameter]:
-        result = []
+    def parse_params(path) -> dict[str, Parameter]:
+        result = {}
         with open(path) as file:
             for line in file:
                 if len(line) < 2 or line.startswith('#'):
                     continue
                 param = ParameterList.parse_param(line)
                 if param is not None:
-                    result.append(param)
+                    result[param.param_id] = param
         return result
 
-    def __init__(self, path: str):
+    def __init__(self, path: Optional[str] = None):
         """
         Read a set of parameters from a file
         """
-        self.params = ParameterList.parse_params(path)
+        self.params = ParameterList.parse_params(path) if path else {}
+
+    def select(self, param_ids) -> 'ParameterList':
+        """
+        Return a new list with just these parameters
+        """
+        result = ParameterList()
+        result.params = {param_id: self.params[param_id] for param_id in param_ids}
+        return result
+
+    def compare(self, values: dict[str, float]) -> 'ParameterList':
+        """
+        Verify the parameters against values, e.g., from fetch_param_list(), and return the ones that differ
+        """
+        self.reset_verified()
+        for param_id, param_value in values.items():
+            self.verify(param_id, param_value)
+        return self.select(p.param_id for p in self.params.values() if not p.verified)
 
     def set_all(self, conn: mavutil.mavfile):
         """
-        Send PARAM_SET messages
+        Send PARAM_SET messages and verify the replies
         """
-        for p in self.params:
-            print(f'Set {p.param_id} to {p.param_value}')
-            conn.param_set_send(p.param_id, p.param_value)
+        self.exchange(conn, lambda p: conn.param_set_send(p.param_id, p.param_value))
 
     def fetch_all(self, conn: mavutil.mavfile):
         """
-        Send PARAM_REQUEST_READ messages
+        Send PARAM_REQUEST_READ messages and verify the replies
         """
-        for p in self.params:
-            conn.param_fetch_one(p.param_id)
+        self.exchange(conn, lambda p: conn.param_fetch_one(p.param_id))
 
-    def verify(self, param_id: str, param_value: float):
+    def exchange(self, conn: mavutil.mavfile, send):
         """
-        Mark a parameter as verified
+        Run a ParamExchange, raise BadParameterValueException if any parameter could not be verified
         """
-        for p in self.params:
-            if p.param_id == param_id:
-                if p.param_value - param_value < 0.001:
-                    p.verified = True
-                    return
-                else:
-                    raise BadParameterValueException(f'{p.param_id} expecting {p.param_value} but got {param_value}')
+        start = time.time()
+        exchange = ParamExchange(self, send)
+        while not exchange.done():
+            exchange.pump(time.time())
+            msg = conn.recv_match(type='PARAM_VALUE', blocking=True, timeout=exchange.next_timeout(time.time()))
+            if msg is not None:
+                exchange.handle(msg)
+        verified = sum(p.verified for p in self.params.values())
+        print(f'Verified {verified} of {len(self.params)} parameters in {time.time() - start :.3f} seconds')
+        self.check()
+
+    def verify(self, param_id: str, param_value: float) -> bool:
+        """
+        Mark a parameter as verified, return True if the value matches. Other parameters are ignored.
+        """
+        p = self.params.get(param_id)
+        if p is None:
+            return False
+        p.actual = param_value
+        if p.matches(param_value):
+            p.verified = True
+        return p.verified
 
     def all_verified(self) -> bool:
         """
         Return True if all parameters have been verified
         """
-        for p in self.params:
-            if not p.verified:
-                return False
-        return True
+        return all(p.verified for p in self.params.values())
 
     def reset_verified(self):
         """
         Reset the verified flags
         """
-        for p in self.params:
+        for p in self.params.values():
             p.verified = False
+            p.actual = None
 
-    def verify_all(self, conn: mavutil.mavfile):
+    def diff(self) -> list[str]:
         """
-        Listen for PARAM_VALUE messages, and wait until all parameters have been verified
+        Describe each parameter that hasn't been verified
+        """
+        result = []
+        for p in self.params.values():
+            if not p.verified:
+                if p.actual is None:
+                    result.append(f'{p.param_id} expecting {p.param_value} but got no reply')
+                else:
+                    result.append(f'{p.param_id} expecting {p.param_value} but got {p.actual}')
+        return result
 
-        TODO add a timeout
+    def check(self):
         """
-        self.reset_verified()
-        while msg := conn.recv_match(type='PARAM_VALUE', blocking=True):
-            self.verify(msg.param_id, msg.param_value)
-            if self.all_verified():
-                return
+        Print the diff report and raise BadParameterValueException if there are any differences
+        """
+        report = self.diff()
+        if report:
+            for line in report:
+                print(line)
+            raise BadParameterValueException(f'{len(report)} of {len(self.params)} parameters not verified')
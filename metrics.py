@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+"""
+Tracking KPIs for one run, computed from the merged table (see ingest.py).
+
+All metrics are computed on whole columns, there are no per-row Python calls:
+* rf_error_rms_m, rf_error_max_m: |CTUN.SAlt - CTUN.DSAlt| while SURFTRAK has a rangefinder target (DSAlt > 0)
+  and a rangefinder reading (SAlt > 0)
+* rf_error_sum_m: |CTUN.SAlt - CTUN.DSAlt| summed over all rows, as shown in the merged.pdf title
+* crt_var: variance of CTUN.CRt, also shown in the title
+* steps, settling_time_mean_s, settling_time_max_s, unsettled: for each terrain step of at least STEP_M, the time
+  until the rangefinder error stays within SETTLE_BAND_M for SETTLE_HOLD_S. A step that doesn't settle before the next
+  step (or the end of the run) is unsettled.
+* overshoot_max_m, overshoot_max_pct: how far the error crosses zero after a step, in m and % of the step
+* time_tracking_s, time_reset_s: time with and without a rangefinder target (DSAlt < 0 while SURFTRAK is reset)
+* time_dropout_s: time with no reading injected, or a reading with signal_quality below 100
+
+Example:
+    metrics.py results/sitl/surftrak/*
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from gen_terrain import DROPOUT, LOW_SIGNAL_QUALITY
+
+METRICS_FILE = 'metrics.json'
+
+# A terrain change of at least this much between 2 readings is a step
+STEP_M = 0.25
+
+# The rangefinder error has settled once it stays within this band for this long. The band is 4 sigma of the
+# default noise, see noise.py.
+SETTLE_BAND_M = 0.2
+SETTLE_HOLD_S = 2.0
+
+# Readings with a lower signal_quality are dropouts, see sitl_runner.calc_rf()
+GOOD_SIGNAL_QUALITY = 100
+
+
+def column(df: pd.DataFrame, name: str) -> np.ndarray:
+    """
+    A float column, all NaN if the merged table doesn't have it
+    """
+    if name in df:
+        return df[name].to_numpy(dtype=np.float64)
+    return np.full(len(df), np.nan)
+
+
+def step_metrics(t: np.ndarray, error: np.ndarray, terrain: np.ndarray) -> dict:
+    """
+    Settling time and overshoot after each terrain step
+    """
+    # Ignore the DROPOUT and LOW_SIGNAL_QUALITY markers, hold the previous terrain height instead
+    terrain = pd.Series(np.where(np.isin(terrain, [DROPOUT, LOW_SIGNAL_QUALITY]), np.nan, terrain)).ffill().to_numpy()
+    change = np.diff(terrain, prepend=np.nan)
+    steps = np.flatnonzero(np.abs(change) >= STEP_M)
+
+    # settled[i] is true if the error stays within the band from t[i] to t[i] + SETTLE_HOLD_S.
+    # NaN (not tracking) counts as outside the band.
+    outside = np.concatenate([[0], np.cumsum(~(np.abs(error) <= SETTLE_BAND_M))])
+    hold_end = np.searchsorted(t, t + SETTLE_HOLD_S, side='right')
+    settled = (outside[hold_end] - outside[:-1] == 0) & (t + SETTLE_HOLD_S <= t[-1])
+
+    settling = np.full(len(steps), np.nan)
+    overshoot = np.zeros(len(steps))
+    bounds = np.append(steps, len(t))
+    for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        # The hold must also end before the next step
+        candidates = np.flatnonzero(settled[start:end] & (hold_end[start:end] <= end))
+        if len(candidates):
+            settling[i] = t[start + candidates[0]] - t[start]
+
+        # Rising terrain shortens the rangefinder reading (negative error), overshoot is a positive error after that
+        overshoot[i] = np.nanmax(error[start:end] * np.sign(change[steps[i]]), initial=0.0)
+
+    settled_steps = settling[~np.isnan(settling)]
+    return {
+        'steps': int(len(steps)),
+        'settling_time_mean_s': float(settled_steps.mean()) if len(settled_steps) else None,
+        'settling_time_max_s': float(settled_steps.max()) if len(settled_steps) else None,
+        'unsettled': int(len(steps) - len(settled_steps)),
+        'overshoot_max_m': float(overshoot.max()) if len(steps) else None,
+        'overshoot_max_pct': float((overshoot / np.abs(change[steps])).max() * 100.0) if len(steps) else None,
+    }
+
+
+def compute_metrics(df: pd.DataFrame) -> dict:
+    """
+    Compute the KPIs for one merged table, with CTUN rows (and terrain rows, for older merged.csv files)
+    """
+    df = df.sort_values('TimeUS', kind='stable')
+    t = column(df, 'TimeUS') * 1e-6
+    t -= t[0]
+
+    # Each row lasts until the next one
+    dt = np.diff(t, append=t[-1])
+
+    salt = column(df, 'SAlt')
+    dsalt = column(df, 'DSAlt')
+    tracking = (dsalt > 0) & (salt > 0)
+    reset = dsalt < 0
+    error = np.where(tracking, salt - dsalt, np.nan)
+    abs_error = np.abs(error[tracking])
+
+    rf_cm = column(df, 'rf_cm')
+    signal_quality = column(df, 'signal_quality')
+    dropout = (rf_cm < 0) | (signal_quality < GOOD_SIGNAL_QUALITY)
+
+    metrics = {
+        'duration_s': float(t[-1]),
+        'rf_error_rms_m': float(np.sqrt(np.mean(abs_error ** 2))) if len(abs_error) else None,
+        'rf_error_max_m': float(abs_error.max()) if len(abs_error) else None,
+        'rf_error_sum_m': float(np.nansum(np.abs(salt - dsalt))),
+        'crt_var': float(np.nanvar(column(df, 'CRt'), ddof=1)),
+        'time_tracking_s': float(dt[tracking].sum()),
+        'time_reset_s': float(dt[reset].sum()),
+        'time_dropout_s': float(dt[dropout].sum()),
+    }
+    metrics.update(step_metrics(t, error, column(df, 'terrain_cm') * 0.01))
+    return metrics
+
+
+def write_metrics(log_dir: str, metrics: dict):
+    with open(os.path.join(log_dir, METRICS_FILE), 'w') as f:
+        json.dump(metrics, f, indent=2)
+    print(f'{METRICS_FILE} written')
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('log_dirs', nargs='+', help='directories with merged.csv')
+    args = parser.parse_args()
+
+    for log_dir in args.log_dirs:
+        metrics = compute_metrics(pd.read_csv(os.path.join(log_dir, 'merged.csv')))
+        write_metrics(log_dir, metrics)
+        print(f'{log_dir}: ' + ', '.join(f'{name}={value :.3f}' if isinstance(value, float) else f'{name}={value}'
+                                         for name, value in metrics.items()))
+
+
+if __name__ == '__main__':
+    main()
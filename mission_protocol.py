@@ -142,3 +142,17 @@ def mission_from_path(path):
 def upload_mission(conn, path) -> bool:
     waypoints = mission_from_path(path)
     return upload_using_mission_protocol(conn, apm2.MAV_MISSION_TYPE_MISSION, waypoints)
+
+
+def clear_mission(conn, timeout: float = 5.0) -> bool:
+    conn.mav.mission_clear_all_send(1, 1, apm2.MAV_MISSION_TYPE_MISSION)
+    m = conn.recv_match(type='MISSION_ACK', blocking=True, timeout=timeout)
+    if m is None:
+        print('Timeout clearing mission')
+        return False
+
+    if m.type != mavutil.mavlink.MAV_MISSION_ACCEPTED:
+        print(f'Mission clear failed {mavutil.mavlink.enums["MAV_MISSION_RESULT"][m.type].name}')
+        return False
+
+    return True
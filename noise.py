@@ -0,0 +1,153 @@
+"""
+Rangefinder noise for the simulated sonar.
+
+SensorNoise owns a numpy Generator seeded once per run, and draws the noise for BLOCK readings at a time. A run can be
+reproduced exactly by passing the same seed and noise models; sitl_runner.py records both in run.json.
+
+The noise is built from one or more models, applied in order. Each model is a spec with optional keyword arguments:
+    gaussian,sigma=0.05         additive Gaussian noise, the default
+    outliers,p=0.01,scale=1.0   with probability p add heavy-tailed (Student-t, df) noise times scale
+    ghosts,p=0.005,factor=2.0   with probability p report a multipath ghost at factor times the true range
+    quantize,resolution=0.01    round the reading to the sonar resolution
+
+Example:
+    sitl_runner.py --seed 42 --noise gaussian,sigma=0.05 --noise ghosts,p=0.01 --noise quantize,resolution=0.025
+"""
+
+from typing import Optional
+
+import numpy as np
+
+DEFAULT_SPECS = ['gaussian,sigma=0.05']
+
+
+class Gaussian:
+    def __init__(self, sigma: float = 0.05):
+        self.sigma = sigma
+
+    def draw(self, rng: np.random.Generator, offset: np.ndarray, factor: np.ndarray):
+        offset += rng.normal(scale=self.sigma, size=len(offset))
+
+
+class Outliers:
+    def __init__(self, p: float = 0.01, scale: float = 1.0, df: float = 2.0):
+        self.p = p
+        self.scale = scale
+        self.df = df
+
+    def draw(self, rng: np.random.Generator, offset: np.ndarray, factor: np.ndarray):
+        mask = rng.random(len(offset)) < self.p
+        offset[mask] += self.scale * rng.standard_t(self.df, size=np.count_nonzero(mask))
+
+
+class Ghosts:
+    def __init__(self, p: float = 0.005, factor: float = 2.0):
+        self.p = p
+        self.factor = factor
+
+    def draw(self, rng: np.random.Generator, offset: np.ndarray, factor: np.ndarray):
+        factor[rng.random(len(factor)) < self.p] *= self.factor
+
+
+class Quantize:
+    def __init__(self, resolution: float = 0.01):
+        assert resolution > 0
+        self.resolution = resolution
+
+    def draw(self, rng: np.random.Generator, offset: np.ndarray, factor: np.ndarray):
+        pass
+
+    def finish(self, rf: float) -> float:
+        return round(rf / self.resolution) * self.resolution
+
+    def finish_array(self, rf: np.ndarray) -> np.ndarray:
+        return np.round(rf / self.resolution) * self.resolution
+
+
+# name: (model class, {argument: type})
+MODELS = {
+    'gaussian': (Gaussian, {'sigma': float}),
+    'outliers': (Outliers, {'p': float, 'scale': float, 'df': float}),
+    'ghosts': (Ghosts, {'p': float, 'factor': float}),
+    'quantize': (Quantize, {'resolution': float}),
+}
+
+
+def parse_model(spec: str):
+    """
+    Build a model from a spec, e.g., outliers,p=0.02
+    """
+    name, *kwargs = spec.split(',')
+    if name not in MODELS:
+        raise ValueError(f'Unknown noise model {name}, choose from {", ".join(MODELS)}')
+    cls, arg_types = MODELS[name]
+
+    parsed = {}
+    for kwarg in kwargs:
+        key, _, value = kwarg.partition('=')
+        if key not in arg_types:
+            raise ValueError(f'Unknown argument {key} for noise model {name}, choose from {", ".join(arg_types)}')
+        parsed[key] = arg_types[key](value)
+
+    return cls(**parsed)
+
+
+class SensorNoise:
+    """
+    Turn a true range into a noisy reading: rf = true_rf * factor + offset, then quantize
+    """
+
+    BLOCK = 4096
+
+    def __init__(self, specs: Optional[list[str]] = None, seed: Optional[int] = None):
+        self.specs = list(specs or DEFAULT_SPECS)
+        self.models = [parse_model(spec) for spec in self.specs]
+        self.finishers = [model for model in self.models if hasattr(model, 'finish')]
+
+        # Pick a seed if there isn't one, so the run can still be reproduced from run.json
+        self.seed = seed if seed is not None else int(np.random.SeedSequence().entropy % 2 ** 32)
+        self.rng = np.random.default_rng(self.seed)
+
+        self.offset = None
+        self.factor = None
+        self.index = SensorNoise.BLOCK
+
+    def draw(self, n: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Draw the offsets and factors for n readings
+        """
+        offset = np.zeros(n)
+        factor = np.ones(n)
+        for model in self.models:
+            model.draw(self.rng, offset, factor)
+        return offset, factor
+
+    def refill(self):
+        offset, factor = self.draw(SensorNoise.BLOCK)
+
+        # Python floats are faster than numpy scalars one at a time
+        self.offset = offset.tolist()
+        self.factor = factor.tolist()
+        self.index = 0
+
+    def apply(self, rf: float) -> float:
+        if self.index == SensorNoise.BLOCK:
+            self.refill()
+        rf = rf * self.factor[self.index] + self.offset[self.index]
+        self.index += 1
+        for model in self.finishers:
+            rf = model.finish(rf)
+        return rf
+
+    def apply_array(self, rf: np.ndarray) -> np.ndarray:
+        """
+        Same as apply() for many readings at once, e.g., one for each simulation in surrogate.py
+        """
+        offset, factor = self.draw(len(rf))
+        rf = rf * factor + offset
+        for model in self.finishers:
+            rf = model.finish_array(rf)
+        return rf
+
+    def metadata(self) -> dict:
+        return {'seed': self.seed, 'noise': self.specs}
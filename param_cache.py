@@ -0,0 +1,79 @@
+"""
+Cache a snapshot of the vehicle parameters, so that warm starts can skip the set/reboot/fetch cycle.
+
+ArduSub keeps its parameters in eeprom.bin in the working directory. After a successful cold start (ArduSub started
+with -w, parameters set, reboot, parameters verified) SimRunner saves the full parameter list to param_cache.json,
+keyed by the content hash of the params file and the identity (path, size, mtime) of the ArduSub binary and its
+default params file.
+
+If the key still matches on the next run, ArduSub is started without -w and a single PARAM_REQUEST_LIST is compared
+to the params file. Only if something differs are those parameters set and ArduSub rebooted. If the key doesn't match
+(e.g., a parameter was removed from the params file, or ArduSub was rebuilt) we fall back to a cold start.
+"""
+
+import hashlib
+import json
+import os
+from typing import Optional
+
+SNAPSHOT_FILE = 'param_cache.json'
+
+# These change on every boot
+IGNORE_PREFIXES = ('STAT_',)
+
+
+def file_hash(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def file_id(path: str) -> list:
+    return [os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path)]
+
+
+class ParamCache:
+    def __init__(self, params_file: str, binary_files: list[str], eeprom_file: str, cwd: Optional[str] = None):
+        self.path = os.path.join(cwd or '.', SNAPSHOT_FILE)
+        self.eeprom_path = os.path.join(cwd or '.', eeprom_file)
+        self.key = {
+            'params': file_hash(params_file),
+            'binary': [file_id(path) for path in binary_files],
+        }
+        self.snapshot: Optional[dict[str, float]] = None
+
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    data = json.load(f)
+                if data.get('key') == self.key:
+                    self.snapshot = data['params']
+            except (OSError, ValueError, KeyError):
+                pass
+
+    def is_warm(self) -> bool:
+        """
+        True if the snapshot matches and the eeprom is still there
+        """
+        return self.snapshot is not None and os.path.exists(self.eeprom_path)
+
+    def invalidate(self):
+        """
+        Remove the snapshot before a cold start, so a failed start is never mistaken for a good one
+        """
+        self.snapshot = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def save(self, params: dict[str, float]):
+        self.snapshot = params
+        with open(self.path, 'w') as f:
+            json.dump({'key': self.key, 'params': params}, f, indent=2, sort_keys=True)
+
+    def drift(self, params: dict[str, float]) -> list[str]:
+        """
+        Return the ids of parameters that changed since the snapshot, other than the STAT_ parameters
+        """
+        if self.snapshot is None:
+            return []
+        return sorted(param_id for param_id, value in params.items()
+                      if not param_id.startswith(IGNORE_PREFIXES) and self.snapshot.get(param_id) != value)
@@ -10,7 +10,5 @@ mkdir -p $LOG_DIR
 
 cp logs/$BIN_FILE $LOG_DIR
 
-mavlogdump.py --types CTUN --format csv $LOG_DIR/$BIN_FILE > $LOG_DIR/ctun.csv
-mv stamped_terrain.csv $LOG_DIR
-python merge_logs.py
-python graph_sitl.py
+mv stamped_terrain.* $LOG_DIR
+python ingest.py --bin $LOG_DIR/$BIN_FILE --graph
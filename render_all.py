@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+"""
+Render the graphs and metrics for every run under a results directory, in parallel.
+
+A run directory has a dataflash log and stamped_terrain.csv, or a merged.csv from an older run. Runs are rendered in
+a process pool; each worker imports pandas and matplotlib once and renders many runs. If a run has a dataflash log it
+is ingested first (see ingest.py), otherwise its merged.csv is graphed.
+
+A run is skipped if its inputs and the rendering code (graph_sitl.py, metrics.py, ingest.py, downsample.py) haven't
+changed since it was last rendered, and its outputs are still there. The inputs are recorded in render.json in each
+run directory. Changing --fidelity or --downsample (see graph_sitl.py) renders the graphs again.
+
+Example, render everything that changed:
+    render_all.py
+
+Example, recompute all metrics, without graphs:
+    render_all.py --force --metrics-only
+"""
+
+import argparse
+import concurrent.futures
+import glob
+import json
+import os
+import sys
+import time
+
+from param_cache import file_id
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+RENDER_FILE = 'render.json'
+
+CODE_FILES = [os.path.join(REPO_DIR, name) for name in ['graph_sitl.py', 'metrics.py', 'ingest.py', 'downsample.py']]
+
+# Imported once per worker, see init_worker()
+graph_sitl = None
+ingest = None
+
+
+def find_runs(results_dir: str) -> list[str]:
+    """
+    Directories with a dataflash log or a merged.csv, but not the SITL working directories inside them
+    """
+    runs = []
+    for dir_path, dir_names, file_names in os.walk(results_dir):
+        dir_names[:] = sorted(name for name in dir_names if name != 'logs')
+        if 'merged.csv' in file_names or any(name.endswith('.BIN') for name in file_names):
+            runs.append(dir_path)
+    return runs
+
+
+def input_files(log_dir: str) -> list[str]:
+    bin_files = sorted(glob.glob(os.path.join(log_dir, '*.BIN')))
+    if len(bin_files) == 1:
+        return bin_files + glob.glob(os.path.join(log_dir, 'stamped_terrain.*'))
+    return [os.path.join(log_dir, 'merged.csv')]
+
+
+def render_key(log_dir: str) -> dict:
+    return {
+        'inputs': [file_id(path) for path in sorted(input_files(log_dir))],
+        'code': [file_id(path) for path in CODE_FILES],
+    }
+
+
+def is_current(log_dir: str, metrics_only: bool, fidelity: list) -> bool:
+    """
+    True if the run was rendered from the same inputs and code, and the outputs are still there
+    """
+    outputs = ['metrics.json'] if metrics_only else ['metrics.json', 'merged.pdf']
+    if not all(os.path.exists(os.path.join(log_dir, name)) for name in outputs):
+        return False
+    try:
+        with open(os.path.join(log_dir, RENDER_FILE)) as f:
+            data = json.load(f)
+        # A metrics-only render leaves an older graph behind
+        graph_current = data['graph'] and data['fidelity'] == fidelity
+        return data['key'] == render_key(log_dir) and (metrics_only or graph_current)
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def init_worker():
+    global graph_sitl, ingest
+    import graph_sitl
+    import ingest
+
+
+def render(log_dir: str, metrics_only: bool, fidelity: list) -> tuple[str, float, str]:
+    """
+    Render one run in a worker, return the run, the time it took and an error message (empty if it worked)
+    """
+    start = time.time()
+    try:
+        bin_files = glob.glob(os.path.join(log_dir, '*.BIN'))
+        df = ingest.ingest(log_dir) if len(bin_files) == 1 else None
+        graph_sitl.graph_sitl(log_dir, df, metrics_only, *fidelity)
+
+        # Record the key after rendering, ingest() rewrites merged.csv
+        with open(os.path.join(log_dir, RENDER_FILE), 'w') as f:
+            json.dump({'key': render_key(log_dir), 'graph': not metrics_only, 'fidelity': fidelity}, f, indent=2)
+        return log_dir, time.time() - start, ''
+    except Exception as e:
+        return log_dir, time.time() - start, f'{type(e).__name__}: {e}'
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('results', nargs='?', default='results/sitl', help='Results directory, default results/sitl')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='Worker processes, default #cores')
+    parser.add_argument('--force', action='store_true', help='Render all runs, even if nothing changed')
+    parser.add_argument('--metrics-only', action='store_true', help='Write metrics.json, skip the graphs')
+    parser.add_argument('--fidelity', type=int, default=2500, help='Points per series, 0 for all, default 2500')
+    parser.add_argument('--downsample', choices=['minmax', 'lttb'], default='minmax',
+                        help='Downsampling method, default minmax')
+    args = parser.parse_args()
+    fidelity = [args.fidelity, args.downsample]
+
+    runs = find_runs(args.results)
+    todo = [log_dir for log_dir in runs if args.force or not is_current(log_dir, args.metrics_only, fidelity)]
+    print(f'Found {len(runs)} runs, {len(runs) - len(todo)} up to date, rendering {len(todo)}')
+    if not todo:
+        return
+
+    start = time.time()
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(args.jobs, len(todo)),
+                                                initializer=init_worker) as executor:
+        futures = [executor.submit(render, log_dir, args.metrics_only, fidelity) for log_dir in todo]
+        for future in concurrent.futures.as_completed(futures):
+            log_dir, seconds, error = future.result()
+            if error:
+                failed += 1
+                print(f'{log_dir}: FAILED, {error}')
+            else:
+                print(f'{log_dir}: {seconds :.1f}s')
+
+    print(f'Rendered {len(todo) - failed} of {len(todo)} runs in {time.time() - start :.1f}s')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
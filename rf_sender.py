@@ -5,9 +5,9 @@ Simulate rangefinder readings and send to mavproxy. QGC must be running.
 """
 
 import argparse
-import csv
 import os
 import time
+from typing import Optional
 
 # Use MAVLink2 wire protocol, must include this before importing pymavlink.mavutil
 os.environ['MAVLINK20'] = '1'
@@ -15,16 +15,20 @@ os.environ['MAVLINK20'] = '1'
 from pymavlink import mavutil
 
 from gen_terrain import DROPOUT, LOW_SIGNAL_QUALITY
+from noise import SensorNoise
 from sitl_runner import send_distance_sensor_msg, calc_rf, SubZHistory
+from terrain import open_terrain
 
 
 class RFSender:
-    def __init__(self, terrain: str, delay: float):
+    def __init__(self, terrain: str, delay: float, noise: Optional[list[str]] = None, seed: Optional[int] = None):
         print(f'Sending rangefinder readings, {terrain}, delay {delay}')
 
-        self.terrain = terrain
+        self.terrain = open_terrain(terrain)
+        self.noise = SensorNoise(noise, seed)
+        print(f'Noise {", ".join(self.noise.specs)}, seed {self.noise.seed}')
         self.delay = delay
-        self.sub_z_history = SubZHistory()
+        self.sub_z_history = SubZHistory(delay)
 
         print('Connect to mavproxy')
         self.conn = mavutil.mavlink_connection(
@@ -44,56 +48,46 @@ class RFSender:
         Send rf readings until we reach the time limit
         """
 
-        # Continue until interrupted
-        while True:
+        for terrain_z in self.terrain.readings():
+            # Drain all GLOBAL_POSITION_INT messages
+            while msg := self.conn.recv_match(type='GLOBAL_POSITION_INT', blocking=False):
+                self.process_msg(msg)
 
-            # Re-open the input file so the sequence repeats forever
-            with open(self.terrain, newline='') as infile:
-                datareader = csv.reader(infile, delimiter=',', quotechar='|')
+            # Bootstrap: if we don't have enough history, wait for more
+            while self.sub_z_history.length_s() <= self.delay:
+                self.process_msg(self.conn.recv_match(type='GLOBAL_POSITION_INT', blocking=True))
 
-                # The first input row is the interval
-                row = next(datareader)
-                interval = float(row[0])
+            # terrain_z is above/below seafloor depth
+            if terrain_z == DROPOUT:
+                print('Drop reading')
+                pass
 
-                for row in datareader:
-                    # Drain all GLOBAL_POSITION_INT messages
-                    while msg := self.conn.recv_match(type='GLOBAL_POSITION_INT', blocking=False):
-                        self.process_msg(msg)
+            elif terrain_z == LOW_SIGNAL_QUALITY:
+                print('Poor signal quality')
+                send_distance_sensor_msg(self.conn, 555, 10)
 
-                    # Bootstrap: if we don't have enough history, wait for more
-                    while self.sub_z_history.length_s() <= self.delay:
-                        self.process_msg(self.conn.recv_match(type='GLOBAL_POSITION_INT', blocking=True))
+            else:
+                # Get the sub.z reading at time t, where t = now - delay
+                sub_z = self.sub_z_history.get(time.time() - self.delay)
+                assert sub_z is not None
 
-                    # terrain_z is above/below seafloor depth
-                    terrain_z = float(row[0])
+                rf, signal_quality = calc_rf(terrain_z, sub_z, self.noise)
 
-                    if terrain_z == DROPOUT:
-                        print('Drop reading')
-                        pass
+                print(f'Terrain {terrain_z :.2f}, Sub {sub_z :.2f}, RF {rf :.2f}, SQ {signal_quality}')
+                send_distance_sensor_msg(self.conn, int(rf * 100), signal_quality)
 
-                    elif terrain_z == LOW_SIGNAL_QUALITY:
-                        print('Poor signal quality')
-                        send_distance_sensor_msg(self.conn, 555, 10)
-
-                    else:
-                        # Get the sub.z reading at time t, where t = now - delay
-                        sub_z = self.sub_z_history.get(time.time() - self.delay)
-                        assert sub_z is not None
-
-                        rf, signal_quality = calc_rf(terrain_z, sub_z)
-
-                        print(f'Terrain {terrain_z :.2f}, Sub {sub_z :.2f}, RF {rf :.2f}, SQ {signal_quality}')
-                        send_distance_sensor_msg(self.conn, int(rf * 100), signal_quality)
-
-                    time.sleep(interval)
+            time.sleep(self.terrain.interval)
 
 
 def main():
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
-    parser.add_argument('--terrain', type=str, default='terrain/zeros.csv', help='terrain file')
+    parser.add_argument('--terrain', type=str, default='terrain/zeros.csv', help='terrain file or stream:<name>')
     parser.add_argument('--delay', type=float, default=0.8, help='sensor delay in seconds')
+    parser.add_argument('--noise', type=str, action='append', default=None,
+                        help='noise model, may be repeated, default gaussian,sigma=0.05, see noise.py')
+    parser.add_argument('--seed', type=int, default=None, help='noise seed, default random')
     args = parser.parse_args()
-    sender = RFSender(args.terrain, args.delay)
+    sender = RFSender(args.terrain, args.delay, args.noise, args.seed)
     sender.send_rangefinder_readings()
 
 
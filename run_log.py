@@ -0,0 +1,99 @@
+"""
+Buffered logging for stamped_terrain.csv.
+
+Rows are kept in preallocated numpy columns and written in batches, instead of a write and a flush per reading. A
+batch is written when it is full or when it is flush_s seconds old, whichever comes first. In crash-safe mode each
+batch is also fsync'd, so a crash loses at most one batch.
+
+Optionally, all columns are also saved to stamped_terrain.npz when the log is closed:
+    data = np.load('stamped_terrain.npz')
+    data['TimeUS'], data['terrain_cm'], ...
+"""
+
+import csv
+import os
+import time
+
+import numpy as np
+
+
+class RunLog:
+    """
+    Write stamped_terrain.csv, see SimRunner.send_rangefinder_readings()
+    """
+
+    COLUMNS = [
+        ('TimeUS', np.int64),
+        ('terrain_cm', np.float64),
+        ('sub_cm', np.float64),
+        ('rf_cm', np.int32),
+        ('signal_quality', np.int32),
+    ]
+
+    def __init__(self, path='stamped_terrain.csv', batch=100, flush_s=1.0, npz=False, crash_safe=False):
+        assert batch > 0
+        self.path = path
+        self.batch = batch
+        self.flush_s = flush_s
+        self.npz = npz
+        self.crash_safe = crash_safe
+
+        # The current batch
+        self.columns = [np.empty(batch, dtype=dtype) for _, dtype in RunLog.COLUMNS]
+        self.count = 0
+        self.batch_start = time.monotonic()
+
+        # Flushed batches, kept for the npz file
+        self.flushed: list[list[np.ndarray]] = []
+
+        # Open for writing. Do not translate newlines.
+        self.outfile = open(path, mode='w', newline='')
+        self.datawriter = csv.writer(self.outfile, delimiter=',', quotechar='|', lineterminator='\n')
+        self.datawriter.writerow([name for name, _ in RunLog.COLUMNS])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def append(self, time_us: int, terrain_cm: float, sub_cm: float, rf_cm: int, signal_quality: int):
+        if self.count == 0:
+            self.batch_start = time.monotonic()
+
+        for column, value in zip(self.columns, (time_us, terrain_cm, sub_cm, rf_cm, signal_quality)):
+            column[self.count] = value
+        self.count += 1
+
+        if self.count == self.batch or time.monotonic() - self.batch_start > self.flush_s:
+            self.flush()
+
+    def flush(self):
+        if self.count == 0:
+            return
+
+        batch = [column[:self.count].copy() for column in self.columns]
+        self.count = 0
+
+        # Same text as writing one row at a time: tolist() returns Python ints and floats
+        self.datawriter.writerows(zip(*[column.tolist() for column in batch]))
+        self.outfile.flush()
+        if self.crash_safe:
+            os.fsync(self.outfile.fileno())
+
+        if self.npz:
+            self.flushed.append(batch)
+
+    def close(self):
+        if self.outfile.closed:
+            return
+
+        self.flush()
+        self.outfile.close()
+
+        if self.npz:
+            columns = {}
+            for i, (name, dtype) in enumerate(RunLog.COLUMNS):
+                columns[name] = np.concatenate([batch[i] for batch in self.flushed]) if self.flushed \
+                    else np.empty(0, dtype=dtype)
+            np.savez(os.path.splitext(self.path)[0] + '.npz', **columns)
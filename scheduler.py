@@ -0,0 +1,125 @@
+"""
+Run a periodic task on absolute deadlines measured on the sim clock
+"""
+
+import asyncio
+import json
+import math
+
+import mavutil2
+
+
+class DeadlineScheduler:
+    """
+    Schedule iterations at start + n * interval, so processing time doesn't accumulate as drift.
+
+    If an iteration overruns its deadline there are 2 policies:
+      CATCH_UP: run the late iterations back-to-back until we are on schedule again
+      SKIP: drop the deadlines we missed and resume at the next deadline in the future
+    """
+
+    CATCH_UP = 'catch-up'
+    SKIP = 'skip'
+    POLICIES = [CATCH_UP, SKIP]
+
+    def __init__(self, clock: mavutil2.SimClock, interval: float, policy: str = CATCH_UP):
+        if policy not in DeadlineScheduler.POLICIES:
+            raise ValueError(f'unknown overrun policy {policy}')
+
+        self.clock = clock
+        self.interval = interval
+        self.policy = policy
+
+        # Sim time of the next deadline, set by start()
+        self.deadline: float = 0.0
+
+        # Stats
+        self.first_wake: float = 0.0
+        self.last_wake: float = 0.0
+        self.iterations = 0
+        self.missed = 0
+        self.skipped = 0
+        self.lateness_sum = 0.0
+        self.lateness_sum_sq = 0.0
+        self.lateness_max = 0.0
+
+    def start(self):
+        """
+        The first deadline is now
+        """
+        self.deadline = self.clock.rough_time_s()
+        self.first_wake = self.last_wake = self.deadline
+        self.iterations = 1
+
+    def wait(self) -> int:
+        """
+        Wait for the next deadline. Return the number of deadlines skipped, always 0 for CATCH_UP.
+        """
+        skipped = self.advance()
+        self.clock.sleep_until(self.deadline)
+        self.woke()
+        return skipped
+
+    async def wait_async(self) -> int:
+        """
+        Same as wait(), but sleep on the asyncio loop
+        """
+        skipped = self.advance()
+        await asyncio.sleep(self.clock.wall_time_until(self.deadline))
+        self.woke()
+        return skipped
+
+    def advance(self) -> int:
+        """
+        Move to the next deadline, apply the overrun policy and return the number of deadlines skipped
+        """
+        self.deadline += self.interval
+        skipped = 0
+
+        if self.clock.rough_time_s() > self.deadline:
+            # Overrun: we missed this deadline
+            self.missed += 1
+            if self.policy == DeadlineScheduler.SKIP:
+                skipped = math.floor((self.clock.rough_time_s() - self.deadline) / self.interval) + 1
+                self.deadline += skipped * self.interval
+                self.skipped += skipped
+
+        return skipped
+
+    def woke(self):
+        """
+        Record how late we woke up
+        """
+        wake = self.clock.rough_time_s()
+        lateness = wake - self.deadline
+        self.last_wake = wake
+        self.iterations += 1
+        self.lateness_sum += lateness
+        self.lateness_sum_sq += lateness * lateness
+        self.lateness_max = max(self.lateness_max, lateness)
+
+    def stats(self) -> dict:
+        """
+        Achieved rate, jitter (stdev of lateness) and deadline misses, times in seconds of sim time
+        """
+        n = self.iterations - 1
+        span = self.last_wake - self.first_wake
+        mean = self.lateness_sum / n if n > 0 else 0.0
+        variance = self.lateness_sum_sq / n - mean * mean if n > 0 else 0.0
+        return {
+            'policy': self.policy,
+            'interval_s': self.interval,
+            'requested_rate_hz': 1.0 / self.interval,
+            'achieved_rate_hz': n / span if span > 0 else 0.0,
+            'iterations': self.iterations,
+            'missed_deadlines': self.missed,
+            'skipped_deadlines': self.skipped,
+            'lateness_mean_s': mean,
+            'jitter_s': math.sqrt(max(variance, 0.0)),
+            'lateness_max_s': self.lateness_max,
+            'clock': self.clock.stats(),
+        }
+
+    def write_stats(self, path: str):
+        with open(path, 'w') as f:
+            json.dump(self.stats(), f, indent=2)
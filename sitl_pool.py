@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+"""
+A pool of running ArduSub SITL instances that are reused from run to run.
+
+Starting ArduSub, setting parameters, rebooting, waiting for a GPS fix and waiting for the EKF takes most of a minute
+of sim time. The pool starts each instance once; each run attaches to an idle instance with `sitl_runner.py --attach`,
+which resets the vehicle (disarm, clear the mission, return home in GUIDED mode) instead of rebooting it. The first run
+on an instance still sets the parameters and reboots.
+
+An instance is recycled (stopped and started again) if its process died, if it doesn't send a HEARTBEAT, or if a run
+failed on it. All instances are stopped when the pool is closed.
+
+Used by `sweep.py --warm`. To keep a pool running by hand and attach to it from another shell:
+    sitl_pool.py --size 2 --speedup 20
+    sitl_runner.py --attach --instance 0 --speedup 20 --terrain terrain/sawtooth.csv --time 60
+"""
+
+import argparse
+import glob
+import os
+import queue
+import signal
+import threading
+import time
+from typing import Optional
+
+# Use MAVLink2 wire protocol, must include this before importing pymavlink.mavutil
+os.environ['MAVLINK20'] = '1'
+
+from pymavlink import mavutil
+
+from sitl_runner import mavlink_port, start_ardusub, start_fake_sub, stop_process
+
+
+class PooledSitl:
+    """
+    One ArduSub instance, running in its own directory
+    """
+
+    HEARTBEAT_TIMEOUT = 5.0
+
+    def __init__(self, instance: int, work_dir: str, speedup: float, heavy: bool, fake: bool):
+        self.instance = instance
+        self.work_dir = os.path.abspath(work_dir)
+        self.speedup = speedup
+        self.heavy = heavy
+        self.fake = fake
+        self.process = None
+        self.runs = 0
+
+    def start(self):
+        """
+        Start with the default parameters, the first run sets ours
+        """
+        os.makedirs(self.work_dir, exist_ok=True)
+        if self.fake:
+            self.process = start_fake_sub(self.speedup, self.instance, self.work_dir)
+        else:
+            self.process = start_ardusub(self.speedup, self.heavy, self.instance, self.work_dir)
+        self.runs = 0
+
+    def stop(self):
+        if self.process is not None:
+            stop_process(self.process)
+            self.process = None
+
+    def recycle(self):
+        print(f'Recycle instance {self.instance}')
+        self.stop()
+        self.start()
+
+    def healthy(self) -> bool:
+        """
+        True if the process is running and sends a HEARTBEAT
+        """
+        if self.process is None or self.process.poll() is not None:
+            return False
+
+        conn = None
+        deadline = time.time() + PooledSitl.HEARTBEAT_TIMEOUT
+        while time.time() < deadline:
+            try:
+                conn = mavutil.mavlink_connection(f'tcp:127.0.0.1:{mavlink_port(self.instance)}',
+                                                  source_system=255, source_component=0)
+                return conn.wait_heartbeat(timeout=deadline - time.time()) is not None
+            except (ConnectionError, OSError):
+                # Still booting
+                time.sleep(0.5)
+            finally:
+                if conn is not None:
+                    conn.close()
+                    conn = None
+        return False
+
+    def newest_log(self) -> Optional[str]:
+        bin_files = sorted(glob.glob(os.path.join(self.work_dir, 'logs', '*.BIN')), key=os.path.getmtime)
+        return bin_files[-1] if bin_files else None
+
+
+class SitlPool:
+    """
+    Hand out idle instances, take them back, recycle hung ones
+    """
+
+    def __init__(self, size: int, base_dir: str, speedup: float, heavy: bool = False, fake: bool = False,
+                 first_instance: int = 0):
+        self.sitls = [PooledSitl(first_instance + i, os.path.join(base_dir, f'instance{first_instance + i}'),
+                                 speedup, heavy, fake) for i in range(size)]
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+        self.closed = False
+
+        for sitl in self.sitls:
+            sitl.start()
+            self.idle.put(sitl)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def acquire(self) -> PooledSitl:
+        """
+        Wait for an idle instance, recycle it first if it isn't healthy
+        """
+        sitl = self.idle.get()
+        if not sitl.healthy():
+            sitl.recycle()
+        return sitl
+
+    def release(self, sitl: PooledSitl, ok: bool = True):
+        """
+        Return an instance to the pool, recycle it if the run failed (e.g., hung or crashed)
+        """
+        with self.lock:
+            if self.closed:
+                return
+            if ok:
+                sitl.runs += 1
+            else:
+                sitl.recycle()
+        self.idle.put(sitl)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            for sitl in self.sitls:
+                sitl.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('--size', type=int, default=1, help='Number of instances, default 1')
+    parser.add_argument('--first-instance', type=int, default=0, help='First SITL instance number, default 0')
+    parser.add_argument('--speedup', type=float, default=20.0, help='SIM_SPEEDUP value, default 20')
+    parser.add_argument('--heavy', action='store_true', help='Use heavy (6dof) config')
+    parser.add_argument('--fake', action='store_true', help='Run fake_sub.py instead of ArduSub')
+    parser.add_argument('--dir', type=str, default='results/pool', help='Working directory, default results/pool')
+    args = parser.parse_args()
+
+    quit_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: quit_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: quit_event.set())
+
+    with SitlPool(args.size, args.dir, args.speedup, args.heavy, args.fake, args.first_instance) as pool:
+        print(f'Running instances {", ".join(str(sitl.instance) for sitl in pool.sitls)}, Ctrl-C to stop')
+        while not quit_event.wait(1.0):
+            for sitl in pool.sitls:
+                if sitl.process.poll() is not None:
+                    print(f'Instance {sitl.instance} exited')
+                    sitl.recycle()
+
+
+if __name__ == '__main__':
+    main()
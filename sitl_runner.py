@@ -11,12 +11,18 @@ Interesting sub modes:
 """
 
 import argparse
-import csv
-import numpy as np
+import bisect
+import json
+import math
 import os
+import signal
 import subprocess
+import sys
+import time
+from array import array
 from typing import Optional
 
+import numpy as np
 from pymavlink.dialects.v20 import ardupilotmega as apm2
 
 # Use MAVLink2 wire protocol, must include this before importing pymavlink.mavutil
@@ -25,34 +31,147 @@ os.environ['MAVLINK20'] = '1'
 from pymavlink import mavutil
 
 import mavutil2
+from bathymetry import Bathymetry
 import mission_protocol
 from gen_terrain import DROPOUT, LOW_SIGNAL_QUALITY
+from instrument import Profiler
+from noise import SensorNoise
+from param_cache import ParamCache
+from run_log import RunLog
+from scheduler import DeadlineScheduler
+from terrain import open_terrain
 
-PING_NSE = 0.05
 PING_DELAY = 0.3
 
 DVL_NSE = 0.01
 DVL_DELAY = 0.2
 
+# calc_rf() reports readings outside of these limits with a lower signal_quality
+RF_MIN = 0.35
+RF_MAX = 50.0
+RF_TOO_CLOSE = 8.888
+
+
+def mavlink_port(instance: int) -> int:
+    """ArduSub SITL listens for MAVLink on TCP port 5760 + 10 * instance"""
+    return 5760 + 10 * instance
+
+
+def rc_port(instance: int) -> int:
+    """ArduSub SITL listens for RC input on UDP port 5501 + 10 * instance"""
+    return 5501 + 10 * instance
+
+
+# SITL home location
+HOME_LAT = 47.607886
+HOME_LON = -122.344324
 
-def start_ardusub(speedup: float, heavy: bool):
+
+def ardusub_files(heavy: bool) -> tuple[str, str]:
+    """
+    Return the paths to the ArduSub binary and the default params file
+    """
     ardupilot_home = os.environ.get('ARDUPILOT_HOME')
+    return (f'{ardupilot_home}/build/sitl/bin/ardusub',
+            f'{ardupilot_home}/Tools/autotest/default_params/sub{"-6dof" if heavy else ""}.parm')
+
+
+def fake_sub_file() -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_sub.py')
+
+
+def start_ardusub(speedup: float, heavy: bool, instance: int = 0, cwd: Optional[str] = None,
+                  wipe: bool = True) -> subprocess.Popen:
+    """
+    Start ArduSub in cwd (default: the current working directory), which is where eeprom.bin and logs/ will be written
+
+    The instance number offsets all of the SITL ports (MAVLink, RC input, sim ports), so several instances can run at
+    the same time as long as they use different instance numbers and different working directories.
+
+    If wipe is False the parameters in eeprom.bin are kept, see param_cache.py.
+    """
+    binary, default_params = ardusub_files(heavy)
     model = 'vectored_6dof' if heavy else 'vectored'
-    default_params = f'{ardupilot_home}/Tools/autotest/default_params/sub{"-6dof" if heavy else ""}.parm'
 
     # Using --wipe should do the same thing as -w, but the STAT_BOOTCNT parameter always comes back as 1.
     # This seems like a bug somewhere. See mavutil2.reboot_autopilot for usage.
-    subprocess.Popen([
-        f'{ardupilot_home}/build/sitl/bin/ardusub',
+    return subprocess.Popen([
+        binary,
         '--synthetic-clock',
-        '-w',
+        *(['-w'] if wipe else []),
         '--model', model,
         '--speedup', f'{speedup :.2f}',
         '--defaults', default_params,
         '--sim-address=127.0.0.1',
-        '-I0',
-        '--home', f'47.607886,-122.344324,-0.1,0.0',
-    ])
+        f'-I{instance}',
+        '--home', f'{HOME_LAT},{HOME_LON},-0.1,0.0',
+    ], cwd=cwd)
+
+
+def start_fake_sub(speedup: float, instance: int = 0, cwd: Optional[str] = None,
+                   wipe: bool = True) -> subprocess.Popen:
+    """
+    Start fake_sub.py, a stand-in for ArduSub, in cwd (default: the current working directory)
+    """
+    return subprocess.Popen([
+        sys.executable,
+        fake_sub_file(),
+        '--speedup', f'{speedup :.2f}',
+        '--instance', str(instance),
+        *(['-w'] if wipe else []),
+    ], cwd=cwd)
+
+
+def stop_process(process: subprocess.Popen, timeout: float = 5.0):
+    """
+    Terminate a process, kill it if it doesn't exit in time
+    """
+    process.terminate()
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def stop_process_group(process: subprocess.Popen, timeout: float = 5.0):
+    """
+    Terminate a process started with start_new_session=True and everything it started, e.g., sitl_runner.py and its
+    ArduSub, so the SITL ports are free when this returns. Kill the group if it doesn't exit in time.
+    """
+    for sig in [signal.SIGTERM, signal.SIGKILL]:
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            break
+        if group_exited(process, timeout):
+            break
+    process.wait()
+
+
+def group_exited(process: subprocess.Popen, timeout: float) -> bool:
+    """
+    Wait up to timeout seconds for every process in the group to exit
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        # Reap our child, a zombie is still a member of the group
+        process.poll()
+        try:
+            os.killpg(process.pid, 0)
+        except ProcessLookupError:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def distance_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """
+    Approximate horizontal distance in meters, good enough for short distances
+    """
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1) * math.cos(math.radians(lat1))
+    return 6371000.0 * math.hypot(dlat, dlon)
 
 
 def send_distance_sensor_msg(conn, distance_cm: int, signal_quality: int):
@@ -70,74 +189,156 @@ def send_distance_sensor_msg(conn, distance_cm: int, signal_quality: int):
         mavutil.mavlink.MAV_SENSOR_ROTATION_PITCH_270, 0, signal_quality=signal_quality)
 
 
-def calc_rf(terrain_z: float, sub_z: float) -> tuple[float, int]:
+def write_run_metadata(path: str, noise: SensorNoise, **settings):
+    """
+    Write the run settings and the noise seed to run.json, so the readings can be reproduced
+    """
+    with open(path, 'w') as f:
+        json.dump({**settings, **noise.metadata()}, f, indent=2)
+
+
+def calc_rf(terrain_z: float, sub_z: float, noise: SensorNoise) -> tuple[float, int]:
     """
     Calc rangefinder and signal_quality
 
-    Future: look at attitude and adjust rf
+    With --bathymetry, terrain_z is the seafloor z along the beam, see Bathymetry.slant_range()
     """
 
     # Add noise
-    rf = sub_z - terrain_z + np.random.normal(scale=PING_NSE)
+    rf = noise.apply(sub_z - terrain_z)
 
     # Send signal_quality, typically 100
     signal_quality = 100
 
-    if rf < 0.35:
-        rf = 8.888
+    if rf < RF_MIN:
+        rf = RF_TOO_CLOSE
         signal_quality = 50
-    elif rf > 50.0:
-        rf = 50.0
+    elif rf > RF_MAX:
+        rf = RF_MAX
         signal_quality = 60
 
     return rf, signal_quality
 
 
+def calc_rf_array(terrain_z: np.ndarray, sub_z: np.ndarray, noise: SensorNoise) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Same as calc_rf() for many readings at once, see surrogate.py
+    """
+    rf = noise.apply_array(sub_z - terrain_z)
+    signal_quality = np.where(rf < RF_MIN, 50, np.where(rf > RF_MAX, 60, 100))
+    rf = np.where(rf < RF_MIN, RF_TOO_CLOSE, np.minimum(rf, RF_MAX))
+    return rf, signal_quality
+
+
 class SubZHistory:
     """
     Keep track of recent z readings so that we can simulate a delay
+
+    Readings are kept in a fixed-capacity ring buffer sized from the maximum delay. Each reading is written twice,
+    at i and i + capacity, so the live readings are always a contiguous, sorted slice that we can bisect.
     """
 
-    def __init__(self):
-        # History is a list of tuples (t, z)
-        self.history: list[tuple[float, float]] = []
+    # Keep this much history beyond the maximum delay, to allow for clock error
+    MARGIN_S = 1.0
+
+    def __init__(self, max_delay: float, max_rate: float = 50.0):
+        """
+        max_delay is the longest delay (in seconds) that will be requested
+        max_rate is the highest expected rate (in Hz) of calls to add()
+        """
+        self.keep_s = max_delay + SubZHistory.MARGIN_S
+
+        # Room for every reading in the window, plus the reading just before the window
+        self.capacity = math.ceil(self.keep_s * max_rate) + 2
+
+        self.t = array('d', [0.0]) * (2 * self.capacity)
+        self.z = array('d', [0.0]) * (2 * self.capacity)
+
+        # The live readings are self.t[self.start:self.start + self.count]
+        self.start = 0
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
 
     def add(self, t: float, sub_z: float):
-        # Should trim older readings to save time and space in long simulations
-        self.history.append((t, sub_z))
+        end = self.start + self.count
+
+        # Readings must arrive in order, otherwise we can't bisect
+        if self.count > 0 and t < self.t[end - 1]:
+            return
+
+        # Full: drop the oldest reading
+        if self.count == self.capacity:
+            self.start = (self.start + 1) % self.capacity
+            self.count -= 1
+            end = self.start + self.count
+
+        i = end % self.capacity
+        self.t[i] = self.t[i + self.capacity] = t
+        self.z[i] = self.z[i + self.capacity] = sub_z
+        self.count += 1
+
+        # Evict readings older than the window, but keep 1 reading at or before the window so that we can interpolate
+        cutoff = t - self.keep_s
+        while self.count > 1 and self.t[self.start + 1] <= cutoff:
+            self.start = (self.start + 1) % self.capacity
+            self.count -= 1
 
     def get(self, t: float) -> float or None:
         """
         Return the z reading at time t. Return None if there is no good z reading.
         """
-        if len(self.history) == 0:
+        if self.count == 0:
             return None
 
+        lo = self.start
+        hi = self.start + self.count
+
         # We can't get a reading in the past
-        if t < self.history[0][0]:
+        if t < self.t[lo]:
             return None
 
-        if len(self.history) == 1:
-            return self.history[0][1]
+        if self.count == 1:
+            return self.z[lo]
+
+        i = bisect.bisect_right(self.t, t, lo, hi)
+        if i == hi:
+            # We fell off the end, use the last reading
+            return self.z[hi - 1]
+
+        # We're between 2 readings, interpolate
+        t1, d1 = self.t[i - 1], self.z[i - 1]
+        t2, d2 = self.t[i], self.z[i]
+        return d1 + (d2 - d1) * (t - t1) / (t2 - t1)
 
-        for i in range(1, len(self.history)):
-            if t < self.history[i][0]:
-                # We're between 2 readings, interpolate
-                t1, d1 = self.history[i - 1]
-                t2, d2 = self.history[i]
-                return d1 + (d2 - d1) * (t - t1) / (t2 - t1)
+    def bracket(self, t: float) -> tuple[float, float] or None:
+        """
+        Return the times of the readings that get(t) uses, the same time twice if it doesn't interpolate
+        """
+        if self.count == 0:
+            return None
 
-        # We fell off the end, use the last reading
-        return self.history[len(self.history) - 1][1]
+        lo = self.start
+        hi = self.start + self.count
+
+        if t < self.t[lo]:
+            return None
+
+        i = bisect.bisect_right(self.t, t, lo, hi)
+        if i == hi:
+            return self.t[hi - 1], self.t[hi - 1]
+
+        return self.t[i - 1], self.t[i]
 
     def length_s(self) -> float:
         """
         Return length of history in seconds
         """
-        if len(self.history) < 2:
+        if self.count < 2:
             return 0.0
         else:
-            return self.history[len(self.history) - 1][0] - self.history[0][0]
+            return self.t[self.start + self.count - 1] - self.t[self.start]
 
 
 class SimRunner:
@@ -152,56 +353,172 @@ class SimRunner:
         apm2.MAVLINK_MSG_ID_VFR_HUD: 10,
         apm2.MAVLINK_MSG_ID_GPS_RAW_INT: 5,
         apm2.MAVLINK_MSG_ID_GLOBAL_POSITION_INT: 5,
+        apm2.MAVLINK_MSG_ID_SYSTEM_TIME: 20,
     }
 
-    RECV_MSGS = [
-        'GLOBAL_POSITION_INT',
-        'STATUSTEXT'
-    ]
+    # Only needed to compute the slant range to the bathymetry
+    BATHYMETRY_MSGS = {
+        apm2.MAVLINK_MSG_ID_ATTITUDE: 10,
+    }
+
+    # Flight modes
+    MANUAL = 19
+    GUIDED = 4
+
+    # SET_POSITION_TARGET type_mask: ignore everything but the position
+    POSITION_ONLY = 0b110111111000
+
+    # Attached instances: how close to home is close enough, how long to try to get there
+    HOME_RADIUS_M = 2.0
+    RETURN_HOME_TIMEOUT_S = 120.0
+
+    # Attached instances that have been up at least this long (sim time) don't wait for the EKF
+    EKF_WARM_S = 60.0
+
+    # Turn off the streams that nobody reads after this many readings, see mavutil2.MsgDispatcher
+    TRIM_AFTER_READINGS = 20
 
     def __init__(self, speedup: float, duration: int, terrain, delay: float, heavy: bool, depth: float,
-                 mission: Optional[str], mode: int, params_file: str):
+                 mission: Optional[str], mode: int, params_file: str, instance: int = 0,
+                 fake: bool = False, overrun: str = DeadlineScheduler.CATCH_UP, log_batch: int = 100,
+                 npz: bool = False, crash_safe: bool = False, cold: bool = False, attach: bool = False,
+                 noise: Optional[list[str]] = None, seed: Optional[int] = None, bathymetry: Optional[str] = None,
+                 keep_streams: bool = False, profile: bool = False):
         # self.clock is used by self.print, so set this early
         self.clock = None
 
+        # Set by close()
+        self.ardusub = None
+        self.rc_thread = None
+        self.conn = None
+
         self.print(f'Run at {speedup}X wall time for {duration} seconds, terrain {terrain}, sensor delay {delay}')
 
         self.duration = duration
-        self.terrain = terrain
+        self.terrain_spec = terrain
+        self.terrain = open_terrain(terrain)
+        self.noise = SensorNoise(noise, seed)
+        self.print(f'Noise {", ".join(self.noise.specs)}, seed {self.noise.seed}')
         self.delay = delay
         self.depth = depth
         self.mode = mode
-        self.sub_z_history = SubZHistory()
-
-        self.print('Start ArduSub')
-        start_ardusub(speedup, heavy)
+        self.overrun = overrun
+        self.log_batch = log_batch
+        self.npz = npz
+        self.crash_safe = crash_safe
+        self.attach = attach
+        self.rebooted = False
+        self.sub_z_history = SubZHistory(delay)
+
+        # With a bathymetry, the terrain file only supplies the reading times, dropouts and low signal quality
+        self.bathymetry_path = bathymetry
+        self.bathymetry = None
+        if bathymetry is not None:
+            self.bathymetry = Bathymetry(bathymetry)
+            self.print(f'Bathymetry {self.bathymetry}')
+
+        # Delayed pose for the bathymetry lookup, yaw is unwrapped so that we can interpolate
+        self.lat_history = SubZHistory(delay)
+        self.lon_history = SubZHistory(delay)
+        self.roll_history = SubZHistory(delay, max_rate=20.0)
+        self.pitch_history = SubZHistory(delay, max_rate=20.0)
+        self.yaw_history = SubZHistory(delay, max_rate=20.0)
+        self.yaw = None
+
+        # Message id: handler, for process_msg() and mavutil2.MsgDispatcher
+        self.handlers = {
+            apm2.MAVLINK_MSG_ID_GLOBAL_POSITION_INT: self.on_position,
+            apm2.MAVLINK_MSG_ID_SYSTEM_TIME: self.on_system_time,
+            apm2.MAVLINK_MSG_ID_TIMESYNC: self.on_timesync,
+            apm2.MAVLINK_MSG_ID_STATUSTEXT: self.on_statustext,
+        }
+        if self.bathymetry is not None:
+            self.handlers[apm2.MAVLINK_MSG_ID_ATTITUDE] = self.on_attitude
+        self.keep_streams = keep_streams
+
+        # Arrival wall time of the newest GLOBAL_POSITION_INT, and the latest one-way link latency in sim time
+        self.last_position_wall_s = 0.0
+        self.link_s: Optional[float] = None
+        self.profiler = Profiler(profile)
+
+        try:
+            self.start(speedup, heavy, mission, params_file, instance, fake, cold)
+        except BaseException:
+            self.close()
+            raise
+
+    def start(self, speedup: float, heavy: bool, mission: Optional[str], params_file: str, instance: int, fake: bool,
+              cold: bool):
+        """
+        Start ArduSub (or attach to a running instance, see sitl_pool.py), set parameters, upload the mission
+        """
+        if self.attach:
+            # The pool owns the process and the eeprom, always compare the parameters
+            param_cache = None
+            warm = True
+            self.print(f'Attach to instance {instance}')
+        else:
+            # Keep the parameters in eeprom from the last run if they match the snapshot
+            param_cache = ParamCache(params_file, [fake_sub_file()] if fake else list(ardusub_files(heavy)),
+                                     'eeprom.json' if fake else 'eeprom.bin')
+            warm = param_cache.is_warm() and not cold
+            if not warm:
+                param_cache.invalidate()
+
+            if fake:
+                self.print(f'Start fake_sub.py instance {instance}{", warm start" if warm else ""}')
+                self.ardusub = start_fake_sub(speedup, instance, wipe=not warm)
+            else:
+                self.print(f'Start ArduSub instance {instance}{", warm start" if warm else ""}')
+                self.ardusub = start_ardusub(speedup, heavy, instance, wipe=not warm)
 
         self.print('Connect to ArduSub')
         self.conn = mavutil.mavlink_connection(
-            'tcp:127.0.0.1:5760', source_system=255, source_component=0, autoreconnect=True)
+            f'tcp:127.0.0.1:{mavlink_port(instance)}', source_system=255, source_component=0, autoreconnect=True)
 
         self.print('Wait for HEARTBEAT')
         self.conn.wait_heartbeat()
 
-        self.print('Set parameters')
+        if self.attach and self.conn.motors_armed():
+            # Stop whatever the last run was doing
+            self.print('Disarm')
+            self.conn.set_mode(SimRunner.MANUAL)
+            mavutil2.force_disarm(self.conn)
+
         param_list = mavutil2.ParameterList(params_file)
-        param_list.set_all(self.conn)
+        if warm:
+            self.print('Compare parameters')
+            current = mavutil2.fetch_param_list(self.conn)
+            drift = param_cache.drift(current) if param_cache else []
+            if drift:
+                self.print(f'{len(drift)} parameters changed since the snapshot: {", ".join(drift)}')
+            stale = param_list.compare(current)
+        else:
+            stale = param_list
 
-        self.print('Verify parameters')
-        param_list.verify_all(self.conn)
+        if len(stale.params) == 0:
+            self.print(f'All {len(param_list.params)} parameters match, skip reboot')
+        else:
+            self.print(f'Set and verify {len(stale.params)} parameters')
+            stale.set_all(self.conn)
 
-        self.print('Reboot')
-        mavutil2.reboot_autopilot(self.conn)
+            self.print('Reboot')
+            mavutil2.reboot_autopilot(self.conn)
+            self.rebooted = True
 
-        self.print('Fetch parameters')
-        param_list.fetch_all(self.conn)
+            self.print('Fetch and verify parameters')
+            param_list.fetch_all(self.conn)
 
-        self.print('Verify parameters')
-        param_list.verify_all(self.conn)
+            if param_cache:
+                self.print('Save parameter snapshot')
+                param_cache.save(mavutil2.fetch_param_list(self.conn))
 
         # We are the GCS, so we need to ask for the messages we need
         self.print('Set message intervals')
-        for msg_type, msg_rate in SimRunner.REQUEST_MSGS.items():
+        request_msgs = dict(SimRunner.REQUEST_MSGS)
+        if self.bathymetry is not None:
+            request_msgs.update(SimRunner.BATHYMETRY_MSGS)
+        for msg_type, msg_rate in request_msgs.items():
             mavutil2.set_message_interval(self.conn, msg_type, msg_rate)
 
         self.print('Wait for GPS fix')
@@ -210,15 +527,45 @@ class SimRunner:
         if mission and mission != '':
             self.print('Upload mission')
             mission_protocol.upload_mission(self.conn, mission)
+        elif self.attach:
+            self.print('Clear mission')
+            mission_protocol.clear_mission(self.conn)
 
         # Continuously send RC inputs to a UDP port
         self.print('Start RC thread')
-        self.rc_thread = mavutil2.RCThread(speedup)
+        self.rc_thread = mavutil2.RCThread(speedup, rc_port(instance))
         self.rc_thread.start()
 
         self.print('Start sim clock')
         self.clock = mavutil2.get_sim_clock(self.conn, speedup)
 
+        # An attached instance that didn't reboot has been up for a while, so run for duration seconds from now
+        self.time_limit_s = self.duration + (self.clock.rough_time_s() if self.attach and not self.rebooted else 0.0)
+
+    def close(self):
+        """
+        Stop the RC thread and ArduSub. An attached instance is disarmed, which closes the dataflash log, and left
+        running for the next run.
+        """
+        if self.rc_thread is not None:
+            self.rc_thread.stop_thread()
+            self.rc_thread.join()
+            self.rc_thread = None
+
+        if self.attach and self.conn is not None:
+            self.print('Disarm')
+            self.conn.set_mode(SimRunner.MANUAL)
+            mavutil2.force_disarm(self.conn)
+
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+        if self.ardusub is not None:
+            self.print('Stop ArduSub')
+            stop_process(self.ardusub)
+            self.ardusub = None
+
     def print(self, message):
         sim_time = self.clock.rough_time_s() if self.clock else 0.0
         print(f'[{sim_time :.2f}] {message}')
@@ -235,11 +582,71 @@ class SimRunner:
             return 'unknown'
 
     def process_msg(self, msg):
-        if msg.get_type() == 'GLOBAL_POSITION_INT':
-            self.clock.update(msg.time_boot_ms)
-            self.sub_z_history.add(msg.time_boot_ms * 0.001, msg.relative_alt * 0.001)
-        elif msg.get_type() == 'STATUSTEXT':
-            self.print(f'{SimRunner.severity_name(msg.severity)}: {msg.text}')
+        handler = self.handlers.get(msg.get_msgId())
+        if handler is not None:
+            handler(msg)
+
+    def on_position(self, msg):
+        self.clock.update(msg.time_boot_ms, msg._timestamp)
+        self.last_position_wall_s = msg._timestamp
+        self.sub_z_history.add(msg.time_boot_ms * 0.001, msg.relative_alt * 0.001)
+        if self.bathymetry is not None:
+            self.lat_history.add(msg.time_boot_ms * 0.001, msg.lat * 1e-7)
+            self.lon_history.add(msg.time_boot_ms * 0.001, msg.lon * 1e-7)
+
+    def on_attitude(self, msg):
+        yaw = msg.yaw
+        if self.yaw is not None:
+            yaw = self.yaw + math.remainder(yaw - self.yaw, math.tau)
+        self.yaw = yaw
+        self.roll_history.add(msg.time_boot_ms * 0.001, msg.roll)
+        self.pitch_history.add(msg.time_boot_ms * 0.001, msg.pitch)
+        self.yaw_history.add(msg.time_boot_ms * 0.001, yaw)
+
+    def on_system_time(self, msg):
+        self.clock.update(msg.time_boot_ms, msg._timestamp)
+
+    def on_timesync(self, msg):
+        round_trip_s = self.clock.handle_timesync(msg)
+        if round_trip_s is not None and self.profiler.enabled:
+            self.link_s = round_trip_s / 2 * self.clock.rate
+            self.profiler.latency('link', self.link_s)
+
+    def on_statustext(self, msg):
+        self.print(f'{SimRunner.severity_name(msg.severity)}: {msg.text}')
+
+    def slant_range(self, t: float, sub_z: float) -> float:
+        """
+        Distance along the beam to the seafloor at time t, a bit past RF_MAX if the beam doesn't hit
+        """
+        # Attitude may not have arrived yet, assume level
+        roll = self.roll_history.get(t) or 0.0
+        pitch = self.pitch_history.get(t) or 0.0
+        yaw = self.yaw_history.get(t) or 0.0
+        slant = self.bathymetry.slant_range(self.lat_history.get(t), self.lon_history.get(t), sub_z, roll, pitch,
+                                            yaw, RF_MAX)
+        return min(slant, RF_MAX + 1.0)
+
+    def record_latencies(self, delayed_time: float):
+        """
+        Latencies when a DISTANCE_SENSOR goes out, in sim time. None of these use the fitted clock offset, which is
+        fitted to the same GLOBAL_POSITION_INT messages, only its rate:
+          link: half a TIMESYNC round trip (recorded in on_timesync), the SITL, the link and our poll interval
+          position_held: we parsed the newest GLOBAL_POSITION_INT -> we sent the reading
+          position_age: link + position_held
+          delay_error: delayed_time - the time of the nearest position the lookup used; positive if the history
+            ran out and the reading is older than --delay, negative if it leans on a newer position
+          lookup_span: the time between the 2 positions the lookup interpolated
+        """
+        held_s = (time.time() - self.last_position_wall_s) * self.clock.rate
+        self.profiler.latency('position_held', held_s)
+        if self.link_s is not None:
+            self.profiler.latency('position_age', self.link_s + held_s)
+        t1, t2 = self.sub_z_history.bracket(delayed_time)
+        nearest = t1 if delayed_time - t1 <= t2 - delayed_time else t2
+        self.profiler.latency('delay_error', delayed_time - nearest)
+        if t2 > t1:
+            self.profiler.latency('lookup_span', t2 - t1)
 
     def send_rangefinder_readings(self):
         """
@@ -248,111 +655,201 @@ class SimRunner:
         """
 
         count_readings = 0
+        scheduler = None
+
+        # Record what it takes to reproduce the readings
+        write_run_metadata('run.json', self.noise, terrain=self.terrain_spec, duration=self.duration,
+                           delay=self.delay, depth=self.depth, mode=self.mode, bathymetry=self.bathymetry_path)
 
-        # Open stamped_terrain.csv
-        with open('stamped_terrain.csv', mode='w', newline='') as outfile:
+        # Open stamped_terrain.csv, and take over the receive path from recv_match()
+        with RunLog(batch=self.log_batch, npz=self.npz, crash_safe=self.crash_safe) as run_log, \
+                mavutil2.MsgDispatcher(self.conn, self.handlers) as dispatcher:
             # Write a log with the TimeUS, the terrain_z at that time, the sub_z at that time, and the calculated
             # rf reading. Note that rf reading will appear to arrive at the destination a bit later, controlled
             # by self.delay.
-            datawriter = csv.writer(outfile, delimiter=',', quotechar='|', lineterminator='\n')
-            datawriter.writerow(['TimeUS', 'terrain_cm', 'sub_cm', 'rf_cm', 'signal_quality'])
-
-            # Continue until we hit the time limit
-            while True:
-
-                # Re-open the input file so the sequence repeats forever
-                with open(self.terrain, newline='') as infile:
-                    datareader = csv.reader(infile, delimiter=',', quotechar='|')
-
-                    # The first input row is the interval
-                    row = next(datareader)
-                    interval = float(row[0])
-
-                    for row in datareader:
-                        # Drain all GLOBAL_POSITION_INT messages and add (z, time_boot_s) tuples to our z history
-                        while msg := self.conn.recv_match(type=SimRunner.RECV_MSGS, blocking=False):
-                            self.process_msg(msg)
-
-                        # Bootstrap: if we don't have enough history, wait for more
-                        while self.sub_z_history.length_s() <= self.delay:
-                            self.process_msg(self.conn.recv_match(type=SimRunner.RECV_MSGS, blocking=True))
 
-                        current_time = self.clock.monotonic_time_s()
+            # Index of the next terrain reading, skips forward if the scheduler skipped deadlines
+            index = 0
 
-                        # Get the sub.z reading at time t, where t = now - delay
-                        delayed_time = current_time - self.delay
-                        sub_z = self.sub_z_history.get(delayed_time)
-                        assert sub_z is not None
+            # Stage timers and latencies, if --profile
+            profiler = self.profiler
 
-                        # terrain_z is above/below seafloor depth
-                        terrain_z = float(row[0])
-
-                        if terrain_z == DROPOUT:
-                            # Do not send a DISTANCE_SENSOR message; note this in the logs
-                            rf_cm, signal_quality = -1, -1
-
-                        elif terrain_z == LOW_SIGNAL_QUALITY:
-                            rf_cm, signal_quality = 555, 10
-                            send_distance_sensor_msg(self.conn, rf_cm, signal_quality)
-
-                        else:
-                            rf, signal_quality = calc_rf(terrain_z, sub_z)
-                            rf_cm = int(rf * 100.0)
-                            send_distance_sensor_msg(self.conn, rf_cm, signal_quality)
-
-                        # Log using delayed_time
-                        time_us: int = int(delayed_time * 1000000)
-                        datawriter.writerow([time_us, terrain_z * 100.0, sub_z * 100.0, rf_cm, signal_quality])
-                        outfile.flush()
-
-                        # At N readings change modes
-                        count_readings += 1
-                        if count_readings == 10:
-                            self.print(f'Set mode to {self.mode}')
-                            self.conn.set_mode(self.mode)
+            # Continue until we hit the time limit
+            while True:
+                lap = iteration_start = profiler.start()
+
+                # Keep the sim clock locked to the ArduSub clock
+                self.clock.send_timesync(self.conn)
+                lap = profiler.lap('timesync', lap)
+
+                # Drain all messages, GLOBAL_POSITION_INT adds (z, time_boot_s) tuples to our z history
+                dispatcher.poll()
+                lap = profiler.lap('recv', lap)
+
+                # Bootstrap: if we don't have enough history, wait for more
+                while self.sub_z_history.length_s() <= self.delay:
+                    dispatcher.wait()
+                lap = profiler.lap('bootstrap', lap)
+
+                # Deadlines start at the first reading
+                if scheduler is None:
+                    scheduler = DeadlineScheduler(self.clock, self.terrain.interval, self.overrun)
+                    scheduler.start()
+
+                current_time = self.clock.monotonic_time_s()
+
+                # Get the sub.z reading at time t, where t = now - delay
+                delayed_time = current_time - self.delay
+                sub_z = self.sub_z_history.get(delayed_time)
+                assert sub_z is not None
+                lap = profiler.lap('lookup', lap)
+
+                # terrain_z is above/below seafloor depth
+                terrain_z = self.terrain[index]
+
+                if terrain_z == DROPOUT:
+                    # Do not send a DISTANCE_SENSOR message; note this in the logs
+                    rf_cm, signal_quality = -1, -1
+
+                elif terrain_z == LOW_SIGNAL_QUALITY:
+                    rf_cm, signal_quality = 555, 10
+                    send_distance_sensor_msg(self.conn, rf_cm, signal_quality)
+
+                else:
+                    if self.bathymetry is not None:
+                        terrain_z = sub_z - self.slant_range(delayed_time, sub_z)
+                        lap = profiler.lap('bathymetry', lap)
+                    rf, signal_quality = calc_rf(terrain_z, sub_z, self.noise)
+                    rf_cm = int(rf * 100.0)
+                    send_distance_sensor_msg(self.conn, rf_cm, signal_quality)
+
+                lap = profiler.lap('send', lap)
+                if profiler.enabled and signal_quality >= 0:
+                    self.record_latencies(delayed_time)
+                    lap = profiler.start()
+
+                # Log using delayed_time
+                time_us: int = int(delayed_time * 1000000)
+                run_log.append(time_us, terrain_z * 100.0, sub_z * 100.0, rf_cm, signal_quality)
+                lap = profiler.lap('log', lap)
+
+                # At N readings change modes
+                count_readings += 1
+                if count_readings == 10:
+                    self.print(f'Set mode to {self.mode}')
+                    self.conn.set_mode(self.mode)
+                elif count_readings == SimRunner.TRIM_AFTER_READINGS and not self.keep_streams:
+                    trimmed = dispatcher.trim_streams()
+                    if trimmed:
+                        self.print(f'Turn off unused streams {", ".join(trimmed)}')
+                lap = profiler.lap('control', lap)
+
+                index += 1 + scheduler.wait()
+                profiler.lap('sleep', lap)
+                profiler.lap('iteration', iteration_start)
+
+                if self.clock.rough_time_s() > self.time_limit_s:
+                    # Write injection and receive stats next to stamped_terrain.csv
+                    scheduler.write_stats('injection_stats.json')
+                    dispatcher.write_stats('recv_stats.json')
+                    stats = dispatcher.stats()
+                    self.print(f'Received {stats["received"]} messages, decoded {stats["decoded"]} at '
+                               f'{stats["decode_us"] :.1f}us each')
+                    if profiler.enabled:
+                        profiler.write('profile.json', delay=self.delay, clock=self.clock.stats())
+                        for line in profiler.report():
+                            print(line)
+                    return
+
+    def return_home(self):
+        """
+        Drive an attached vehicle back to the home location at the run depth using GUIDED mode
+        """
+        msg = self.conn.recv_match(type='GLOBAL_POSITION_INT', blocking=True, timeout=5)
+        if msg is None or distance_m(msg.lat * 1e-7, msg.lon * 1e-7, HOME_LAT, HOME_LON) < SimRunner.HOME_RADIUS_M:
+            return
 
-                        self.clock.sleep(interval)
+        self.print('Return home')
+        self.conn.set_mode(SimRunner.GUIDED)
+        self.conn.arducopter_arm()
+        self.conn.motors_armed_wait()
 
-                        if self.clock.rough_time_s() > self.duration:
-                            return
+        start = self.clock.rough_time_s()
+        while self.clock.rough_time_s() - start < SimRunner.RETURN_HOME_TIMEOUT_S:
+            self.conn.mav.set_position_target_global_int_send(
+                0, self.conn.target_system, self.conn.target_component, apm2.MAV_FRAME_GLOBAL_RELATIVE_ALT_INT,
+                SimRunner.POSITION_ONLY, int(HOME_LAT * 1e7), int(HOME_LON * 1e7), self.depth, 0, 0, 0, 0, 0, 0, 0, 0)
+            msg = self.conn.recv_match(type='GLOBAL_POSITION_INT', blocking=True, timeout=1)
+            if msg is not None:
+                self.process_msg(msg)
+                if distance_m(msg.lat * 1e-7, msg.lon * 1e-7, HOME_LAT, HOME_LON) < SimRunner.HOME_RADIUS_M:
+                    return
+        self.print('WARNING: did not reach home, continue anyway')
 
     def run(self):
-        self.print('Set mode to DEPTH_HOLD')
-        self.conn.set_mode(2)
+        try:
+            if self.attach:
+                self.return_home()
 
-        self.print('Arm')
-        self.conn.arducopter_arm()
-        self.conn.motors_armed_wait()
+            self.print('Set mode to DEPTH_HOLD')
+            self.conn.set_mode(2)
+
+            self.print('Arm')
+            self.conn.arducopter_arm()
+            self.conn.motors_armed_wait()
 
-        self.print(f'Dive to {self.depth}m')
-        mavutil2.move_to_depth(self.conn, self.rc_thread, self.depth)
+            self.print(f'Dive to {self.depth}m')
+            mavutil2.move_to_depth(self.conn, self.rc_thread, self.depth)
 
-        # Wait for the EKF to produce a good solution (required for CIRCLE and AUTO)
-        self.print('Wait for EKF solution')
-        self.clock.sleep(25)
+            # Wait for the EKF to produce a good solution (required for CIRCLE and AUTO). An attached instance that
+            # didn't reboot has been up for a while and the EKF has already converged.
+            if not self.attach or self.rebooted or self.clock.rough_time_s() < SimRunner.EKF_WARM_S:
+                self.print('Wait for EKF solution')
+                self.clock.sleep(25)
 
-        self.print('Send rangefinder readings')
-        self.send_rangefinder_readings()
+            self.print('Send rangefinder readings')
+            self.send_rangefinder_readings()
 
-        self.print('Time limit reached')
-        self.rc_thread.stop_thread()
-        self.rc_thread.join()
+            self.print('Time limit reached')
+        finally:
+            self.close()
 
 
 def main():
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
     parser.add_argument('--speedup', type=float, default=1.0, help='SIM_SPEEDUP value')
     parser.add_argument('--time', type=int, default=60, help='How long to run the simulation')
-    parser.add_argument('--terrain', type=str, default='terrain/zeros.csv', help='terrain file')
+    parser.add_argument('--terrain', type=str, default='terrain/zeros.csv', help='terrain file or stream:<name>')
     parser.add_argument('--delay', type=float, default=0.3, help='Sensor delay in seconds, default 0.3')
     parser.add_argument('--heavy', action='store_true', help='Use heavy (6dof) config')
     parser.add_argument('--depth', type=float, default=-10.0, help='Run depth, default -10m')
     parser.add_argument('--mission', type=str, default=None, help='Upload mission items')
     parser.add_argument('--mode', type=int, default=21, help='Mode, default 21 (surftrak)')
     parser.add_argument('--params', type=str, default='params/sitl.params', help='Params file')
+    parser.add_argument('--instance', type=int, default=0, help='SITL instance number, offsets all ports, default 0')
+    parser.add_argument('--fake', action='store_true', help='Run against fake_sub.py instead of ArduSub')
+    parser.add_argument('--overrun', type=str, default=DeadlineScheduler.CATCH_UP, choices=DeadlineScheduler.POLICIES,
+                        help='What to do when a reading misses its deadline, default catch-up')
+    parser.add_argument('--log-batch', type=int, default=100, help='Rows per stamped_terrain.csv write, default 100')
+    parser.add_argument('--npz', action='store_true', help='Also write stamped_terrain.npz')
+    parser.add_argument('--crash-safe', action='store_true', help='fsync stamped_terrain.csv after every batch')
+    parser.add_argument('--cold', action='store_true', help='Ignore the parameter snapshot, always wipe and reboot')
+    parser.add_argument('--attach', action='store_true',
+                        help='Use a running instance, see sitl_pool.py')
+    parser.add_argument('--noise', type=str, action='append', default=None,
+                        help='Rangefinder noise model, may be repeated, default gaussian,sigma=0.05, see noise.py')
+    parser.add_argument('--seed', type=int, default=None, help='Noise seed, default random, recorded in run.json')
+    parser.add_argument('--bathymetry', type=str, default=None,
+                        help='Bathymetry directory, the seafloor follows the sub position, see bathymetry.py')
+    parser.add_argument('--keep-streams', action='store_true',
+                        help='Leave the message streams that nobody reads on, see recv_stats.json')
+    parser.add_argument('--profile', action='store_true',
+                        help='Time each stage of the injection loop and the position latency, write profile.json')
     args = parser.parse_args()
     runner = SimRunner(args.speedup, args.time, args.terrain, args.delay, args.heavy, args.depth, args.mission,
-                       args.mode, args.params)
+                       args.mode, args.params, args.instance, args.fake, args.overrun, args.log_batch, args.npz,
+                       args.crash_safe, args.cold, args.attach, args.noise, args.seed, args.bathymetry,
+                       args.keep_streams, args.profile)
     runner.run()
 
 
@@ -0,0 +1,557 @@
+#!/usr/bin/env python3
+
+"""
+A fast offline model of the SURFTRAK loop, for parameter sweeps that would take days in SITL.
+
+Many simulations run at once, one column of each numpy array per (parameter set, terrain) pair:
+* the rangefinder reading is the sub depth delayed by the sensor delay, minus the terrain, with noise, see
+  sitl_runner.calc_rf_array() and noise.py; dropouts and low signal_quality readings are injected as in sitl_runner.py
+* the rangefinder is healthy after 3 good readings in a row, and stays healthy while readings arrive every 500ms
+* SURFTRAK sets the rangefinder target on the first healthy reading, then moves the depth target to keep the
+  rangefinder reading on target, staying below SURFTRAK_DEPTH
+* the depth target offset is shaped like AC_PosControl does it: KPv = 0.5 * jerk / accel, KPa = jerk / accel, limited
+  by PILOT_SPEED_UP/DN, PILOT_ACCEL_Z and PSC_JERK_Z
+* the sub follows the target through the PSC_POSZ_P and PSC_VELZ_P loops; the vehicle responds to the requested
+  acceleration with a first order lag (PLANT_TAU) and a gain (PLANT_GAIN)
+
+The plant constants are fitted to SITL runs with the calibrate command and saved in surrogate.json. Each candidate
+replays the terrain of the run from the moment SURFTRAK started tracking, and the candidate whose depth (CTUN.Alt)
+is closest to the log wins. All candidates x runs are simulated at once.
+
+The surrogate is good for ranking parameter sets and pruning a search, not for final numbers: confirm the best sets
+with sweep.py.
+
+Example, calibrate against the runs in results/sitl:
+    surrogate.py calibrate
+
+Example, rank 64 parameter sets over 2 terrains and 2 sensor delays:
+    surrogate.py sweep --terrain trapezoid sawtooth --delay 0.3 0.8 --set PSC_JERK_Z=2:16:8 \\
+        --set PILOT_ACCEL_Z=100,200,300,500,800,1000,1500,2000 --seed 1
+
+Example, in Python:
+    result = simulate(grid(load_params('params/sitl.params'), {'PSC_JERK_Z': [4, 8]}), [Scenario.from_terrain(...)])
+    result.metrics()['rf_error_rms_m'], result.frame(0)
+"""
+
+import argparse
+import glob
+import itertools
+import json
+import math
+import os
+import time
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+import mavutil2
+from gen_terrain import DROPOUT, LOW_SIGNAL_QUALITY
+from ingest import read_stamped_terrain
+from metrics import compute_metrics
+from noise import SensorNoise
+from sitl_runner import calc_rf_array
+from terrain import open_terrain, STREAM_PREFIX
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CALIBRATION_FILE = os.path.join(REPO_DIR, 'surrogate.json')
+
+# ArduSub parameters used by the surrogate, and the ArduSub defaults
+DEFAULTS = {
+    'PSC_JERK_Z': 8.0,          # m/s/s/s
+    'PILOT_ACCEL_Z': 200.0,     # cm/s/s
+    'PILOT_SPEED_UP': 50.0,     # cm/s
+    'PILOT_SPEED_DN': 0.0,      # cm/s, 0 means the same as PILOT_SPEED_UP
+    'PSC_POSZ_P': 1.0,
+    'PSC_VELZ_P': 5.0,
+    'SURFTRAK_DEPTH': -50.0,    # cm
+    'RNGFND1_MIN_CM': 20.0,
+    'RNGFND1_MAX_CM': 700.0,
+    'RNGFND_SQ_MIN': 0.0,
+}
+
+# Plant constants, see calibrate()
+PLANT_DEFAULTS = {
+    'PLANT_TAU': 0.1,           # s
+    'PLANT_GAIN': 1.0,
+}
+
+# Simulation step and CTUN logging interval in seconds
+DT = 0.01
+LOG_INTERVAL = 0.1
+
+# AP_RangeFinder: readings in a row to become healthy, and the timeout
+RANGEFINDER_HEALTH_MAX = 3
+RANGEFINDER_TIMEOUT_S = 0.5
+
+# Same as sitl_runner.py
+DEFAULT_DELAY = 0.3
+DEFAULT_DEPTH = -10.0
+
+# Logged columns, as in merged.csv
+COLUMNS = ['DAlt', 'Alt', 'DSAlt', 'SAlt', 'TAlt', 'DCRt', 'CRt', 'terrain_cm', 'sub_cm', 'rf_cm', 'signal_quality']
+
+
+def load_params(path: Optional[str] = None) -> dict[str, float]:
+    """
+    The surrogate parameters: DEFAULTS, then the calibrated plant, then the values in a params file
+    """
+    params = dict(DEFAULTS)
+    params.update(PLANT_DEFAULTS)
+    if os.path.exists(CALIBRATION_FILE):
+        with open(CALIBRATION_FILE) as f:
+            params.update({name: value for name, value in json.load(f).items() if name in PLANT_DEFAULTS})
+    if path:
+        params.update({p.param_id: p.param_value for p in mavutil2.ParameterList(path).params.values()
+                       if p.param_id in DEFAULTS})
+    return params
+
+
+def grid(base: dict[str, float], axes: dict[str, list[float]]) -> dict[str, np.ndarray]:
+    """
+    Every combination of the axes, the other parameters from base. Returns {name: array with one value per set}.
+    """
+    for name in axes:
+        if name not in base:
+            raise ValueError(f'Unknown parameter {name}, choose from {", ".join(base)}')
+    combos = list(itertools.product(*axes.values())) or [()]
+    sets = {name: np.full(len(combos), value, dtype=np.float64) for name, value in base.items()}
+    for i, name in enumerate(axes):
+        sets[name] = np.array([combo[i] for combo in combos], dtype=np.float64)
+    return sets
+
+
+def parse_axis(spec: str) -> tuple[str, list[float]]:
+    """
+    Parse NAME=a,b,c (values) or NAME=start:stop:n (n values from start to stop)
+    """
+    name, _, values = spec.partition('=')
+    if values.count(':') == 2:
+        start, stop, n = values.split(':')
+        return name, np.linspace(float(start), float(stop), int(n)).tolist()
+    return name, [float(value) for value in values.split(',')]
+
+
+class Scenario:
+    """
+    One terrain profile with a sensor delay and a starting state
+    """
+
+    def __init__(self, name: str, terrain_z: np.ndarray, interval: float, duration: float,
+                 delay: float = DEFAULT_DELAY, depth: float = DEFAULT_DEPTH, rf_target: Optional[float] = None,
+                 first_reading_s: float = 0.0):
+        self.name = name
+        self.terrain_z = np.asarray(terrain_z, dtype=np.float64)
+        self.interval = interval
+        self.duration = duration
+        self.delay = delay
+        self.depth = depth
+        self.rf_target = rf_target
+        self.first_reading_s = first_reading_s
+
+        # The CTUN log of the SITL run, for calibration
+        self.reference: Optional[pd.DataFrame] = None
+
+    @classmethod
+    def from_terrain(cls, spec: str, duration: float, delay: float = DEFAULT_DELAY, depth: float = DEFAULT_DEPTH):
+        """
+        A terrain name (e.g., trapezoid for terrain/trapezoid.csv), csv file or stream spec, see terrain.py
+        """
+        path = spec
+        if not spec.startswith(STREAM_PREFIX) and not os.path.exists(spec):
+            path = os.path.join(REPO_DIR, 'terrain', f'{spec}.csv')
+        terrain = open_terrain(path)
+        n = math.ceil(duration / terrain.interval) + 1
+        terrain_z = np.fromiter(itertools.islice(terrain.readings(), n), dtype=np.float64, count=n)
+        return cls(f'{os.path.splitext(os.path.basename(spec))[0]}_delay{delay}', terrain_z, terrain.interval,
+                   duration, delay, depth)
+
+    @classmethod
+    def from_run(cls, log_dir: str, delay: Optional[float] = None):
+        """
+        Replay a SITL run from the first CTUN row with a rangefinder target
+        """
+        if delay is None:
+            delay = DEFAULT_DELAY
+            run_path = os.path.join(log_dir, 'run.json')
+            if os.path.exists(run_path):
+                with open(run_path) as f:
+                    delay = json.load(f).get('delay', delay)
+
+        df = pd.read_csv(os.path.join(log_dir, 'merged.csv')).sort_values('TimeUS', kind='stable')
+        df = df[df['DSAlt'].notna()]
+        tracking = np.flatnonzero(df['DSAlt'].to_numpy() > 0)
+        if not len(tracking):
+            raise ValueError(f'{log_dir}: SURFTRAK never tracked')
+        df = df.iloc[tracking[0]:]
+        start_us = df['TimeUS'].iloc[0]
+
+        # stamped_terrain.csv is stamped with the time of the sub depth, the reading was sent delay seconds later
+        stamped = read_stamped_terrain(log_dir).sort_values('TimeUS', kind='stable')
+        sent_s = (stamped['TimeUS'].to_numpy(dtype=np.float64) - start_us) * 1e-6 + delay
+        keep = sent_s >= 0
+        if not keep.any():
+            raise ValueError(f'{log_dir}: no terrain readings after SURFTRAK started tracking')
+        # Older runs logged meters
+        terrain_z = (stamped['terrain_cm'] * 0.01 if 'terrain_cm' in stamped else stamped['terrain_z']).to_numpy()
+
+        # The readings were late now and then, resample on a regular schedule so the terrain stays in step with the log
+        sent_s, terrain_z = sent_s[keep], terrain_z[keep]
+        interval = float(np.median(np.diff(sent_s)))
+        schedule = np.arange(sent_s[0], sent_s[-1], interval)
+        terrain_z = terrain_z[np.searchsorted(sent_s, schedule + 1e-9, side='right') - 1]
+
+        scenario = cls(log_dir, terrain_z, interval, (df['TimeUS'].iloc[-1] - start_us) * 1e-6, delay,
+                       float(df['Alt'].iloc[0]), float(df['DSAlt'].iloc[0]), float(sent_s[0]))
+        scenario.reference = pd.DataFrame({'t': (df['TimeUS'].to_numpy(dtype=np.float64) - start_us) * 1e-6,
+                                           'Alt': df['Alt'].to_numpy(), 'DSAlt': df['DSAlt'].to_numpy()})
+        return scenario
+
+
+def sqrt_controller(error: np.ndarray, p: np.ndarray, second_ord_lim: np.ndarray, dt: float) -> np.ndarray:
+    """
+    AP_Math sqrt_controller(): proportional close to the target, constant deceleration further away
+    """
+    linear_dist = second_ord_lim / (p * p)
+    far = np.sqrt(2.0 * second_ord_lim * np.maximum(np.abs(error) - 0.5 * linear_dist, 0.0))
+    correction = np.where(np.abs(error) > linear_dist, np.sign(error) * far, p * error)
+
+    # Don't overshoot the target in one step
+    limit = np.abs(error) / dt
+    return np.clip(correction, -limit, limit)
+
+
+class SurrogateResult:
+    """
+    The KPIs of every simulation, and the CTUN-like series if they were recorded
+    """
+
+    def __init__(self, param_sets: dict[str, np.ndarray], scenarios: list[Scenario], t: np.ndarray,
+                 series: Optional[dict[str, np.ndarray]], kpis: dict[str, np.ndarray]):
+        self.param_sets = param_sets
+        self.scenarios = scenarios
+        self.t = t
+        self.series = series
+        self.kpis = kpis
+
+    def __len__(self):
+        return len(self.scenarios) * len(next(iter(self.param_sets.values())))
+
+    def index(self, param_set: int, scenario: int) -> int:
+        return param_set * len(self.scenarios) + scenario
+
+    def metrics(self) -> dict[str, np.ndarray]:
+        """
+        The batch KPIs, same definitions as metrics.py, one value per simulation
+        """
+        return self.kpis
+
+    def frame(self, i: int) -> pd.DataFrame:
+        """
+        One simulation as a merged table, ready for metrics.compute_metrics() and graph_sitl.graph_sitl()
+        """
+        if self.series is None:
+            raise ValueError('Series were not recorded, simulate with record=True')
+        df = pd.DataFrame({name: values[:, i].astype(np.float64) for name, values in self.series.items()})
+        df.insert(0, 'TimeUS', (self.t * 1e6).astype(np.int64))
+        df.insert(1, 'timestamp', self.t)
+        return df
+
+
+def simulate(param_sets: dict[str, np.ndarray], scenarios: list[Scenario], noise: Optional[SensorNoise] = None,
+             duration: Optional[float] = None, record: bool = False, dt: float = DT) -> SurrogateResult:
+    """
+    Simulate every parameter set on every scenario, simulation i = param_set * len(scenarios) + scenario
+    """
+    noise = noise or SensorNoise()
+    duration = duration or max(scenario.duration for scenario in scenarios)
+    n_sets = len(next(iter(param_sets.values())))
+    n_scenarios = len(scenarios)
+    b = n_sets * n_scenarios
+    cols = np.arange(b)
+
+    def per_sim(values) -> np.ndarray:
+        return np.tile(np.asarray(values, dtype=np.float64), n_sets)
+
+    # Parameters, one per simulation, in SI units
+    p = {name: np.repeat(values, n_scenarios) for name, values in param_sets.items()}
+    jerk = p['PSC_JERK_Z']
+    accel_max = p['PILOT_ACCEL_Z'] * 0.01
+    speed_up = p['PILOT_SPEED_UP'] * 0.01
+    speed_dn = np.where(p['PILOT_SPEED_DN'] > 0, p['PILOT_SPEED_DN'], p['PILOT_SPEED_UP']) * 0.01
+    kpa = jerk / accel_max
+    kpv = 0.5 * kpa
+    surftrak_depth = p['SURFTRAK_DEPTH'] * 0.01
+    lag = np.minimum(dt / np.maximum(p['PLANT_TAU'], 1e-6), 1.0)
+
+    # Terrain, padded to the longest profile, each profile repeats
+    lengths = np.array([len(s.terrain_z) for s in scenarios])
+    terrain = np.zeros((n_scenarios, lengths.max()))
+    for i, scenario in enumerate(scenarios):
+        terrain[i, :lengths[i]] = scenario.terrain_z
+    scenario_index = np.tile(np.arange(n_scenarios), n_sets)
+    sim_lengths = lengths[scenario_index]
+    interval = per_sim([s.interval for s in scenarios])
+    next_reading = per_sim([s.first_reading_s for s in scenarios])
+    reading = np.zeros(b, dtype=np.int64)
+
+    # Sub depth history for the sensor delay, a ring of steps
+    delay_steps = np.rint(per_sim([s.delay for s in scenarios]) / dt).astype(np.int64)
+    ring = int(delay_steps.max()) + 1
+    z = per_sim([s.depth for s in scenarios])
+    history = np.tile(z, (ring, 1))
+    v = np.zeros(b)
+    a = np.zeros(b)
+
+    # Depth target: a fixed base plus the SURFTRAK offset, which has its own velocity and acceleration
+    base = z.copy()
+    offset = np.zeros(b)
+    offset_vel = np.zeros(b)
+    offset_accel = np.zeros(b)
+    offset_target = np.zeros(b)
+
+    # Rangefinder and SURFTRAK state; scenarios replaying a run start out tracking
+    rf_target = per_sim([-1.0 if s.rf_target is None else s.rf_target for s in scenarios])
+    tracking_start = rf_target > 0
+    valid_count = np.where(tracking_start, RANGEFINDER_HEALTH_MAX, 0)
+    last_msg = np.where(tracking_start, 0.0, -np.inf)
+    rf = np.where(tracking_start, rf_target, 0.0)
+    terrain_est = np.where(tracking_start, z - rf, np.nan)
+    logged = {name: np.full(b, np.nan) for name in ['terrain_cm', 'sub_cm', 'rf_cm', 'signal_quality']}
+
+    steps = int(round(duration / dt))
+    log_every = max(1, int(round(LOG_INTERVAL / dt)))
+    n_logs = steps // log_every + 1
+    series = {name: np.full((n_logs, b), np.nan, dtype=np.float32) for name in COLUMNS} if record else None
+
+    # KPI accumulators, at the CTUN rate
+    error_sq = np.zeros(b)
+    error_max = np.full(b, np.nan)
+    tracking_count = np.zeros(b)
+    crt_sum = np.zeros(b)
+    crt_sq = np.zeros(b)
+    dropout_count = np.zeros(b)
+
+    for step in range(steps + 1):
+        t = step * dt
+        history[step % ring] = z
+
+        # Inject the readings that are due
+        due = np.flatnonzero(t >= next_reading - 1e-9)
+        if len(due):
+            terrain_z = terrain[scenario_index[due], reading[due] % sim_lengths[due]]
+            reading[due] += 1
+            next_reading[due] += interval[due]
+            sub_z = history[(step - delay_steps[due]) % ring, due]
+
+            dropout = terrain_z == DROPOUT
+            low_quality = terrain_z == LOW_SIGNAL_QUALITY
+            rf_cm = np.full(len(due), 555.0)
+            signal_quality = np.full(len(due), 10.0)
+            good = ~(dropout | low_quality)
+            if good.any():
+                rf_good, signal_quality[good] = calc_rf_array(terrain_z[good], sub_z[good], noise)
+                rf_cm[good] = np.trunc(rf_good * 100.0)
+            logged['terrain_cm'][due] = terrain_z * 100.0
+            logged['sub_cm'][due] = sub_z * 100.0
+            logged['rf_cm'][due] = np.where(dropout, -1.0, rf_cm)
+            logged['signal_quality'][due] = np.where(dropout, -1.0, signal_quality)
+
+            # ArduSub receives the messages that were sent
+            sent = due[~dropout]
+            rf_cm, signal_quality = rf_cm[~dropout], signal_quality[~dropout]
+            valid = ((rf_cm >= p['RNGFND1_MIN_CM'][sent]) & (rf_cm <= p['RNGFND1_MAX_CM'][sent]) &
+                     (signal_quality > p['RNGFND_SQ_MIN'][sent]))
+            valid_count[sent] = np.where(valid, np.minimum(valid_count[sent] + 1, RANGEFINDER_HEALTH_MAX), 0)
+            last_msg[sent] = t
+            rf[sent] = rf_cm * 0.01
+
+            # SURFTRAK: set the target on the first healthy reading, then follow the terrain
+            healthy = sent[valid_count[sent] >= RANGEFINDER_HEALTH_MAX]
+            engage = healthy[(rf_target[healthy] < 0) & (z[healthy] < surftrak_depth[healthy])]
+            rf_target[engage] = rf[engage]
+            follow = healthy[rf_target[healthy] > 0]
+            terrain_est[follow] = z[follow] - rf[follow]
+            offset_target[follow] = (np.minimum(terrain_est[follow] + rf_target[follow], surftrak_depth[follow]) -
+                                     base[follow])
+
+        # Shape the offset: position error -> velocity -> acceleration, jerk limited
+        vel_target = np.clip(sqrt_controller(offset_target - offset, kpv, accel_max, dt), -speed_dn, speed_up)
+        accel_target = np.clip(sqrt_controller(vel_target - offset_vel, kpa, jerk, dt), -accel_max, accel_max)
+        offset_accel += np.clip(accel_target - offset_accel, -jerk * dt, jerk * dt)
+        offset += offset_vel * dt + 0.5 * offset_accel * dt * dt
+        offset_vel += offset_accel * dt
+
+        # Position and velocity loops, then the vehicle
+        target = base + offset
+        accel_cmd = offset_accel + p['PSC_VELZ_P'] * (offset_vel + p['PSC_POSZ_P'] * (target - z) - v)
+        a += (p['PLANT_GAIN'] * accel_cmd - a) * lag
+        v += a * dt
+        z += v * dt
+
+        if step % log_every == 0:
+            healthy = (valid_count >= RANGEFINDER_HEALTH_MAX) & (t - last_msg <= RANGEFINDER_TIMEOUT_S)
+            dsalt = np.where(rf_target > 0, rf_target, -0.01)
+            salt = np.where(healthy, rf, 0.0)
+
+            tracking = (dsalt > 0) & (salt > 0)
+            error = np.where(tracking, np.abs(salt - dsalt), 0.0)
+            error_sq += error * error
+            error_max = np.where(tracking, np.fmax(error_max, error), error_max)
+            tracking_count += tracking
+            crt_sum += v
+            crt_sq += v * v
+            dropout_count += (logged['rf_cm'] < 0) | (logged['signal_quality'] < 100)
+
+            if record:
+                row = step // log_every
+                values = {'DAlt': target, 'Alt': z, 'DSAlt': dsalt, 'SAlt': salt,
+                          'TAlt': np.where(healthy, terrain_est, np.nan), 'DCRt': offset_vel * 100.0,
+                          'CRt': v * 100.0}
+                values.update(logged)
+                for name, value in values.items():
+                    series[name][row] = value
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        crt_mean = crt_sum / n_logs
+        kpis = {
+            'rf_error_rms_m': np.sqrt(error_sq / tracking_count),
+            'rf_error_max_m': error_max,
+            'crt_var': (crt_sq - n_logs * crt_mean * crt_mean) / (n_logs - 1) * 1e4,
+            'time_tracking_s': tracking_count * LOG_INTERVAL,
+            'time_dropout_s': dropout_count * LOG_INTERVAL,
+        }
+    return SurrogateResult(param_sets, scenarios, np.arange(n_logs) * log_every * dt, series, kpis)
+
+
+def calibration_score(result: SurrogateResult) -> np.ndarray:
+    """
+    For each parameter set, the RMS difference between the simulated and logged depth, averaged over the runs
+    """
+    n_sets = len(next(iter(result.param_sets.values())))
+    scores = np.zeros(n_sets)
+    for j, scenario in enumerate(result.scenarios):
+        ref = scenario.reference
+        ref = ref[(ref['t'] <= result.t[-1]) & (ref['DSAlt'] > 0)]
+        rows = np.rint(ref['t'].to_numpy() / (result.t[1] - result.t[0])).astype(np.int64)
+        sim_alt = result.series['Alt'][rows][:, [result.index(i, j) for i in range(n_sets)]]
+        scores += np.sqrt(np.mean((sim_alt - ref['Alt'].to_numpy()[:, None]) ** 2, axis=0))
+    return scores / len(result.scenarios)
+
+
+def calibrate(log_dirs: list[str], params_file: Optional[str], rounds: int = 3, n: int = 9,
+              seed: int = 0) -> dict:
+    """
+    Fit PLANT_TAU and PLANT_GAIN with a grid search, zooming in around the best candidate each round
+    """
+    scenarios = [Scenario.from_run(log_dir) for log_dir in log_dirs]
+    base = load_params(params_file)
+
+    # Search log(tau) and log(gain)
+    center = np.log([PLANT_DEFAULTS['PLANT_TAU'], PLANT_DEFAULTS['PLANT_GAIN']])
+    span = np.log([10.0, 10.0])
+    best = None
+    for r in range(rounds):
+        log_tau = np.linspace(center[0] - span[0], center[0] + span[0], n)
+        log_gain = np.linspace(center[1] - span[1], center[1] + span[1], n)
+        param_sets = grid(base, {'PLANT_TAU': np.exp(log_tau).tolist(), 'PLANT_GAIN': np.exp(log_gain).tolist()})
+
+        start = time.time()
+        result = simulate(param_sets, scenarios, SensorNoise(seed=seed), record=True)
+        scores = calibration_score(result)
+        i = int(np.argmin(scores))
+        best = {'PLANT_TAU': float(param_sets['PLANT_TAU'][i]), 'PLANT_GAIN': float(param_sets['PLANT_GAIN'][i]),
+                'score_m': float(scores[i])}
+        print(f'Round {r + 1}: {len(result)} simulations in {time.time() - start :.1f}s, '
+              f'PLANT_TAU {best["PLANT_TAU"] :.3f}, PLANT_GAIN {best["PLANT_GAIN"] :.3f}, '
+              f'depth error {best["score_m"] :.3f}m')
+
+        center = np.log([best['PLANT_TAU'], best['PLANT_GAIN']])
+        span = span * 2.0 / (n - 1)
+
+    best['runs'] = [os.path.relpath(log_dir, REPO_DIR) for log_dir in log_dirs]
+    return best
+
+
+def find_runs(results_dir: str) -> list[str]:
+    return sorted(os.path.dirname(path) for path in glob.glob(os.path.join(results_dir, '*', '*', 'merged.csv'))
+                  if os.path.exists(os.path.join(os.path.dirname(path), 'stamped_terrain.csv')))
+
+
+def rank(result: SurrogateResult, names: list[str]) -> pd.DataFrame:
+    """
+    One row per parameter set, the KPIs averaged over the scenarios, best first
+    """
+    n_sets = len(next(iter(result.param_sets.values())))
+    table = pd.DataFrame({name: result.param_sets[name] for name in names})
+    for kpi, values in result.metrics().items():
+        table[kpi] = values.reshape(n_sets, len(result.scenarios)).mean(axis=1)
+    return table.sort_values(['rf_error_rms_m', 'crt_var'], kind='stable')
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    calibrate_parser = subparsers.add_parser('calibrate', help='fit the plant to SITL runs, write surrogate.json')
+    calibrate_parser.add_argument('log_dirs', nargs='*', help='runs with merged.csv and stamped_terrain.csv, '
+                                                              'default all runs in results/sitl')
+    calibrate_parser.add_argument('--params', type=str, default='params/sitl.params', help='params file of the runs')
+    calibrate_parser.add_argument('--rounds', type=int, default=3, help='grid search rounds, default 3')
+
+    sweep_parser = subparsers.add_parser('sweep', help='simulate a grid of parameter sets, print the best')
+    sweep_parser.add_argument('--terrain', type=str, nargs='+', default=['trapezoid'],
+                              help='terrain names, files or stream specs, default trapezoid')
+    sweep_parser.add_argument('--params', type=str, default='params/sitl.params', help='base params file')
+    sweep_parser.add_argument('--set', type=str, action='append', default=[],
+                              help='NAME=a,b,c or NAME=start:stop:n, may be repeated')
+    sweep_parser.add_argument('--delay', type=float, nargs='+', default=[DEFAULT_DELAY],
+                              help=f'sensor delays in seconds, default {DEFAULT_DELAY}')
+    sweep_parser.add_argument('--time', type=float, default=200.0, help='simulated seconds, default 200')
+    sweep_parser.add_argument('--depth', type=float, default=DEFAULT_DEPTH, help=f'default {DEFAULT_DEPTH}m')
+    sweep_parser.add_argument('--noise', type=str, action='append', default=None, help='noise model, see noise.py')
+    sweep_parser.add_argument('--seed', type=int, default=None, help='noise seed, default random')
+    sweep_parser.add_argument('--top', type=int, default=10, help='print the best n parameter sets, default 10')
+    sweep_parser.add_argument('--csv', type=str, default=None, help='write all parameter sets and KPIs to a file')
+
+    args = parser.parse_args()
+
+    if args.command == 'calibrate':
+        log_dirs = args.log_dirs or find_runs(os.path.join(REPO_DIR, 'results', 'sitl'))
+        print(f'Calibrating against {len(log_dirs)} runs')
+        best = calibrate(log_dirs, args.params, args.rounds)
+        with open(CALIBRATION_FILE, 'w') as f:
+            json.dump(best, f, indent=2)
+        print(f'{CALIBRATION_FILE} written')
+    else:
+        axes = dict(parse_axis(spec) for spec in args.set)
+        param_sets = grid(load_params(args.params), axes)
+        scenarios = [Scenario.from_terrain(terrain, args.time, delay, args.depth)
+                     for terrain, delay in itertools.product(args.terrain, args.delay)]
+        noise = SensorNoise(args.noise, args.seed)
+
+        start = time.time()
+        result = simulate(param_sets, scenarios, noise, args.time)
+        print(f'{len(result)} simulations ({len(param_sets["PSC_JERK_Z"])} parameter sets x {len(scenarios)} '
+              f'scenarios) in {time.time() - start :.1f}s, seed {noise.seed}')
+
+        table = rank(result, list(axes) or ['PSC_JERK_Z', 'PILOT_ACCEL_Z'])
+        if args.csv:
+            table.to_csv(args.csv, index=False)
+            print(f'{args.csv} written')
+        print(table.head(args.top).to_string(index=False, float_format=lambda x: f'{x :.3f}'))
+
+        # The step KPIs need the series, simulate the best set again and record it
+        i = table.index[0]
+        best = simulate({name: values[i:i + 1] for name, values in param_sets.items()}, scenarios,
+                        SensorNoise(args.noise, noise.seed), args.time, record=True)
+        for j, scenario in enumerate(scenarios):
+            metrics = compute_metrics(best.frame(j))
+            print(f'Best on {scenario.name}: ' + ', '.join(f'{name}={metrics[name] :.3f}' if metrics[name] is not None
+                                                           else f'{name}=None'
+                                                           for name in ['settling_time_mean_s', 'overshoot_max_m']))
+
+
+if __name__ == '__main__':
+    main()
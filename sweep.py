@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+"""
+Run a sweep of ArduSub simulations in parallel.
+
+Each run gets its own SITL instance number (and therefore its own MAVLink, RC and sim ports) and its own working
+directory under results/sitl/<version>/<terrain>, so eeprom.bin, logs/*.BIN and stamped_terrain.csv never clash.
+Once a run finishes its CTUN table is read, merged with the terrain log and graphed, just like run_sitl.bash.
+
+Example, the equivalent of run_all.bash:
+    sweep.py --terrain zeros trapezoid sawtooth square stress test_signal_quality
+
+Example, the equivalent of multi_test.bash:
+    sweep.py --terrain trapezoid --params mode0.params mode1.params mode2.params mode3.params
+
+With --warm the runs share a pool of running ArduSub instances instead of starting a fresh one each time, see
+sitl_pool.py. The dataflash logs are then written to the pool directory and copied to the run directory.
+
+With --metrics-only each run writes metrics.json (see metrics.py) but no graph, which is much faster for large sweeps.
+
+With several --seed values each terrain is run once per seed, under results/sitl/<version>_seed<n>/<terrain>. The
+rangefinder noise is drawn from the seed (see noise.py), so a Monte Carlo sweep is reproducible:
+    sweep.py --terrain trapezoid --seed 1 2 3 4 5 6 7 8 --metrics-only
+"""
+
+import argparse
+import concurrent.futures
+import glob
+import itertools
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import time
+from typing import Optional
+
+from sitl_pool import SitlPool
+from sitl_runner import stop_process_group
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Run:
+    """
+    One simulation in the sweep
+    """
+
+    def __init__(self, log_dir: str, terrain: str, params: str, mode: int, seed: Optional[int], args):
+        self.log_dir = os.path.abspath(log_dir)
+        self.terrain = terrain
+        self.params = params
+        self.mode = mode
+        self.seed = seed
+        self.args = args
+
+    def sitl_runner_cmd(self, instance: int, attach: bool = False) -> list[str]:
+        cmd = [
+            sys.executable, os.path.join(REPO_DIR, 'sitl_runner.py'),
+            '--terrain', os.path.join(REPO_DIR, 'terrain', f'{self.terrain}.csv'),
+            '--speedup', str(self.args.speedup),
+            '--time', str(self.args.time),
+            '--depth', str(self.args.depth),
+            '--delay', str(self.args.delay),
+            '--mode', str(self.mode),
+            '--params', os.path.join(REPO_DIR, 'params', self.params),
+            '--instance', str(instance),
+        ]
+        if self.args.mission:
+            cmd += ['--mission', os.path.join(REPO_DIR, 'mission', self.args.mission)]
+        if self.seed is not None:
+            cmd += ['--seed', str(self.seed)]
+        for spec in self.args.noise or []:
+            cmd += ['--noise', spec]
+        if self.args.heavy:
+            cmd.append('--heavy')
+        if self.args.cold:
+            cmd.append('--cold')
+        if self.args.profile:
+            cmd.append('--profile')
+        if attach:
+            cmd.append('--attach')
+        return cmd
+
+    def prepare(self):
+        """
+        Remove the products of a previous run, so that the newest BIN file is ours. Keep eeprom.bin and
+        param_cache.json, so the next run can be a warm start, see param_cache.py.
+        """
+        os.makedirs(self.log_dir, exist_ok=True)
+        shutil.rmtree(os.path.join(self.log_dir, 'logs'), ignore_errors=True)
+        for name in ['stamped_terrain.csv', 'stamped_terrain.npz', 'ctun.csv', 'merged.csv', 'merged.pdf',
+                     'metrics.json', 'run.json', 'profile.json']:
+            path = os.path.join(self.log_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+        for path in glob.glob(os.path.join(self.log_dir, '*.BIN')):
+            os.remove(path)
+
+    def simulate(self, instance: int, attach: bool = False, timeout: Optional[float] = None) -> int:
+        """
+        Run sitl_runner.py, return its exit code, or -1 if it timed out. On a timeout sitl_runner.py and the ArduSub
+        it started are stopped together, so the instance ports are free before the instance is used again.
+        """
+        with open(os.path.join(self.log_dir, 'sitl_runner.log'), 'w') as log:
+            # A session of its own, so a timeout can stop ArduSub too
+            process = subprocess.Popen(self.sitl_runner_cmd(instance, attach), cwd=self.log_dir, stdout=log,
+                                       stderr=subprocess.STDOUT, start_new_session=True)
+            try:
+                return process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                print(f'{self.log_dir}: timeout after {timeout :.0f} seconds')
+                stop_process_group(process)
+                return -1
+
+    def collect_log(self, work_dir: str) -> int:
+        """
+        Copy the newest dataflash log from work_dir/logs to the run directory
+        """
+        bin_files = sorted(glob.glob(os.path.join(work_dir, 'logs', '*.BIN')), key=os.path.getmtime)
+        if len(bin_files) == 0:
+            print(f'{work_dir}: no dataflash log found')
+            return 1
+
+        shutil.copy(bin_files[-1], self.log_dir)
+        return 0
+
+    def process(self) -> int:
+        """
+        Same steps as process_sitl.bash
+        """
+        bin_files = glob.glob(os.path.join(self.log_dir, '*.BIN'))
+        if len(bin_files) != 1:
+            print(f'{self.log_dir}: expected 1 dataflash log, found {len(bin_files)}')
+            return 1
+
+        # Decode the log and graph it in one process, see ingest.py
+        cmd = [sys.executable, os.path.join(REPO_DIR, 'ingest.py'), self.log_dir]
+        cmd.append('--metrics-only' if self.args.metrics_only else '--graph')
+        return subprocess.run(cmd).returncode
+
+
+def plan_runs(args) -> list[Run]:
+    """
+    Build the terrain x params x mode x seed matrix
+    """
+    runs = []
+    for terrain, params, mode, seed in itertools.product(args.terrain, args.params, args.mode, args.seed or [None]):
+        if len(args.params) > 1:
+            # Name the results after the params file, e.g., results/sitl/mode0 for params/mode0.params
+            stem = os.path.splitext(params)[0]
+            version = f'{args.version}_{stem}' if args.version else stem
+        else:
+            version = args.version or 'surftrak'
+        if len(args.mode) > 1:
+            version += f'_mode{mode}'
+        if args.seed and len(args.seed) > 1:
+            version += f'_seed{seed}'
+        runs.append(Run(os.path.join(args.results, version, terrain), terrain, params, mode, seed, args))
+    return runs
+
+
+def add_run_arguments(parser: argparse.ArgumentParser):
+    """
+    Options shared with tune.py
+    """
+    parser.add_argument('--speedup', type=float, default=20.0, help='SIM_SPEEDUP value, default 20')
+    parser.add_argument('--time', type=int, default=200, help='How long to run each simulation, default 200')
+    parser.add_argument('--depth', type=float, default=-10.0, help='Run depth, default -10m')
+    parser.add_argument('--delay', type=float, default=0.3, help='Sensor delay in seconds, default 0.3')
+    parser.add_argument('--mission', type=str, default='fr10.txt', help='Mission file in mission/, default fr10.txt')
+    parser.add_argument('--noise', type=str, action='append', default=None,
+                        help='Noise model, may be repeated, default gaussian,sigma=0.05, see noise.py')
+    parser.add_argument('--heavy', action='store_true', help='Use heavy (6dof) config')
+    parser.add_argument('--cold', action='store_true', help='Ignore parameter snapshots, always wipe and reboot')
+    parser.add_argument('--profile', action='store_true', help='Write profile.json for each run, see instrument.py')
+    parser.add_argument('--warm', action='store_true', help='Reuse running ArduSub instances, see sitl_pool.py')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='Kill a run after this many wall seconds, default 3 * time / speedup + 120')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='Max concurrent simulations, default #cores')
+
+
+def execute(runs: list[Run], args) -> list[Run]:
+    """
+    Simulate and process the runs, up to args.jobs at a time, return the runs that failed
+    """
+    jobs = max(1, min(args.jobs, os.cpu_count(), len(runs)))
+    timeout = args.timeout or 3 * args.time / args.speedup + 120
+    print(f'{len(runs)} runs, {jobs} at a time{", warm pool" if args.warm else ""}')
+
+    if args.warm:
+        pool = SitlPool(jobs, os.path.join(args.results, 'pool'), args.speedup, args.heavy)
+    else:
+        pool = None
+
+        # Hand out SITL instance numbers, a run returns its instance number when it is done
+        instances = queue.Queue()
+        for instance in range(jobs):
+            instances.put(instance)
+
+    def do_run(run: Run) -> tuple[Run, int]:
+        run.prepare()
+
+        if pool:
+            sitl = pool.acquire()
+            result = -1
+            try:
+                print(f'Start {run.log_dir} on instance {sitl.instance}, run {sitl.runs + 1}')
+                result = run.simulate(sitl.instance, attach=True, timeout=timeout)
+                if result == 0:
+                    result = run.collect_log(sitl.work_dir)
+            finally:
+                pool.release(sitl, ok=result == 0)
+        else:
+            instance = instances.get()
+            try:
+                print(f'Start {run.log_dir} on instance {instance}')
+                result = run.simulate(instance, timeout=timeout)
+            finally:
+                instances.put(instance)
+            if result == 0:
+                result = run.collect_log(run.log_dir)
+
+        if result == 0:
+            result = run.process()
+        return run, result
+
+    start = time.time()
+    failed = []
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            for future in concurrent.futures.as_completed([executor.submit(do_run, run) for run in runs]):
+                run, result = future.result()
+                if result == 0:
+                    print(f'Done {run.log_dir}')
+                else:
+                    print(f'Failed {run.log_dir}, see {os.path.join(run.log_dir, "sitl_runner.log")}')
+                    failed.append(run)
+    finally:
+        if pool:
+            pool.close()
+
+    print(f'{len(runs) - len(failed)} of {len(runs)} runs succeeded in {time.time() - start :.0f} seconds')
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('--version', type=str, default=None, help='Results prefix, default surftrak')
+    parser.add_argument('--terrain', type=str, nargs='+', default=['zeros'], help='Terrain names, e.g., trapezoid')
+    parser.add_argument('--params', type=str, nargs='+', default=['sitl.params'], help='Params files in params/')
+    parser.add_argument('--mode', type=int, nargs='+', default=[21], help='Modes, default 21 (surftrak)')
+    parser.add_argument('--seed', type=int, nargs='+', default=None,
+                        help='Noise seeds, several seeds make a Monte Carlo sweep, default random')
+    parser.add_argument('--metrics-only', action='store_true', help='Write metrics.json, skip the graphs')
+    parser.add_argument('--results', type=str, default='results/sitl', help='Results directory')
+    add_run_arguments(parser)
+    args = parser.parse_args()
+
+    if os.environ.get('ARDUPILOT_HOME') is None:
+        print('Error: ARDUPILOT_HOME is not set')
+        sys.exit(1)
+
+    if execute(plan_runs(args), args):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
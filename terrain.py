@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+"""
+Load terrain files written by gen_terrain.py.
+
+A terrain csv file has the interval in the first row, followed by one terrain_z value per row. gen_terrain.py also
+writes a .npy sidecar next to each csv file with the same layout, [interval, z0, z1, ...], which is memory-mapped
+instead of parsing the csv. To build sidecars for csv files that were written some other way:
+    terrain.py terrain/*.csv
+
+A terrain spec can also name one of the endless streams in gen_terrain.py, with optional keyword arguments:
+    sitl_runner.py --terrain stream:fractal,sigma=0.5,seed=3
+"""
+
+import argparse
+import os
+from typing import Iterator
+
+import numpy as np
+
+
+def npy_path(csv_path: str) -> str:
+    return os.path.splitext(csv_path)[0] + '.npy'
+
+
+def write_npy(path: str, interval: float, z: np.ndarray):
+    """
+    Write a .npy sidecar, see Terrain
+    """
+    np.save(path, np.concatenate(([interval], np.asarray(z, dtype=np.float64))))
+
+
+class Terrain:
+    """
+    A terrain profile: a sequence of terrain_z values, one every interval seconds, that repeats forever
+    """
+
+    def __init__(self, interval: float, z: np.ndarray):
+        assert interval > 0 and len(z) > 0
+        self.interval = interval
+        self.z = z
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Load a terrain csv file, or its .npy sidecar if that is at least as new as the csv file
+        """
+        sidecar = npy_path(path)
+        if os.path.exists(sidecar) and (
+                not os.path.exists(path) or os.path.getmtime(sidecar) >= os.path.getmtime(path)):
+            data = np.load(sidecar, mmap_mode='r')
+            return cls(float(data[0]), data[1:])
+        return cls.load_csv(path)
+
+    @classmethod
+    def load_csv(cls, path: str):
+        data = np.loadtxt(path, dtype=np.float64, delimiter=',', ndmin=1)
+        return cls(float(data[0]), data[1:])
+
+    def __len__(self):
+        return len(self.z)
+
+    def __getitem__(self, i: int) -> float:
+        return float(self.z[i % len(self.z)])
+
+    def duration_s(self) -> float:
+        return len(self.z) * self.interval
+
+    def readings(self):
+        """
+        Generate terrain_z values forever
+        """
+        while True:
+            # Convert a block at a time, so a memory-mapped profile is never copied in full
+            for start in range(0, len(self.z), 4096):
+                yield from self.z[start:start + 4096].tolist()
+
+
+class TerrainStream:
+    """
+    A terrain profile that never repeats, read from a generator of numpy blocks. Only the current block is kept, so
+    readings must be requested in increasing order, gaps are fine.
+    """
+
+    def __init__(self, interval: float, blocks: Iterator[np.ndarray]):
+        self.interval = interval
+        self.blocks = blocks
+        self.block = np.empty(0)
+        self.base = 0
+
+    def __getitem__(self, i: int) -> float:
+        assert i >= self.base, 'TerrainStream cannot go back'
+        while i >= self.base + len(self.block):
+            self.base += len(self.block)
+            self.block = next(self.blocks)
+        return float(self.block[i - self.base])
+
+    def readings(self):
+        """
+        Generate terrain_z values forever
+        """
+        for block in self.blocks:
+            yield from block.tolist()
+
+
+STREAM_PREFIX = 'stream:'
+
+
+def open_terrain(spec: str) -> Terrain or TerrainStream:
+    """
+    Open a terrain csv file or a stream spec, e.g., stream:course,seed=3
+    """
+    if not spec.startswith(STREAM_PREFIX):
+        return Terrain.load(spec)
+
+    # Import here, gen_terrain imports this module
+    import gen_terrain
+
+    name, *kwargs = spec[len(STREAM_PREFIX):].split(',')
+    if name not in gen_terrain.STREAMS:
+        raise ValueError(f'Unknown terrain stream {name}, choose from {", ".join(gen_terrain.STREAMS)}')
+    stream, arg_types = gen_terrain.STREAMS[name]
+
+    parsed = {}
+    for kwarg in kwargs:
+        key, _, value = kwarg.partition('=')
+        if key not in arg_types:
+            raise ValueError(f'Unknown argument {key} for terrain stream {name}, choose from {", ".join(arg_types)}')
+        parsed[key] = arg_types[key](value)
+
+    return TerrainStream(gen_terrain.INTERVAL, stream(**parsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('path', nargs='+', help='terrain csv files')
+    args = parser.parse_args()
+
+    for path in args.path:
+        terrain = Terrain.load_csv(path)
+        write_npy(npy_path(path), terrain.interval, terrain.z)
+        print(f'{path}: {len(terrain)} readings, interval {terrain.interval}, wrote {npy_path(path)}')
+
+
+if __name__ == '__main__':
+    main()
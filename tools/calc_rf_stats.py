@@ -2,38 +2,231 @@
 
 """
 Read DISTANCE_SENSOR messages and calculate mean and stdev
+
+Also reports gaps in the message stream (no reading for more than --gap seconds) and the distribution of
+signal_quality, to characterize a sonar from field logs.
+
+The tlog is scanned rather than parsed: only the header of each packet is read, and only DISTANCE_SENSOR packets
+between start and stop are decoded. The scan stops at the first packet past stop. The mean and variance are computed
+online (Welford), and several tlogs are scanned in parallel.
+
+With --cache the readings are sliced from the columnar tlog cache instead, see tlog_cache.py. The first run converts
+each tlog, later runs over any time window are much faster.
 """
 
 import argparse
-import statistics
+import collections
+import concurrent.futures
+import math
+import mmap
+import os
+
+# Use MAVLink2 wire protocol, must include this before importing pymavlink.mavutil
+os.environ['MAVLINK20'] = '1'
 
+import numpy as np
 from pymavlink import mavutil
 
+from tlog_cache import DEFAULT_CACHE_DIR, TlogCache, TlogScanner
+
+mavutil.set_dialect('ardupilotmega')
+
+# Same as the AP_RangeFinder_MAVLink timeout, a longer gap makes the rangefinder unhealthy
+DEFAULT_GAP_S = 0.5
+
+
+class RunningStats:
+    """
+    Mean and variance in one pass, see https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, x: float):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+
+    def merge(self, other: 'RunningStats'):
+        """
+        Combine with the stats of another set of samples (Chan et al.)
+        """
+        count = self.count + other.count
+        if count == 0:
+            return
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+
+    def add_array(self, x: np.ndarray):
+        """
+        Add many samples at once
+        """
+        other = RunningStats()
+        other.count = len(x)
+        other.mean = float(np.mean(x))
+        other.m2 = float(np.sum((x - other.mean) ** 2))
+        self.merge(other)
+
+    def stdev(self) -> float:
+        """
+        Sample standard deviation, same as statistics.stdev
+        """
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+
+class TlogStats:
+    """
+    DISTANCE_SENSOR stats for one tlog, or several tlogs combined
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.distance = RunningStats()
+        self.signal_quality = collections.Counter()
+        self.first = None
+        self.last = None
+        self.gaps = 0
+        self.gap_s = 0.0
+        self.max_gap_s = 0.0
+        self.bad_bytes = 0
+
+    def add(self, timestamp: float, distance: int, signal_quality: int, gap_s: float):
+        if self.last is not None:
+            dt = timestamp - self.last
+            if dt > gap_s:
+                self.gaps += 1
+                self.gap_s += dt
+                self.max_gap_s = max(self.max_gap_s, dt)
+        else:
+            self.first = timestamp
+        self.last = timestamp
+        self.distance.add(distance)
+        self.signal_quality[signal_quality] += 1
+
+    def add_columns(self, timestamps: np.ndarray, distances: np.ndarray, signal_quality: np.ndarray, gap_s: float):
+        """
+        Same as calling add() for each reading, in time order
+        """
+        dt = np.diff(timestamps, prepend=timestamps[0] if self.last is None else self.last)
+        gaps = dt[dt > gap_s]
+        if self.first is None:
+            self.first = float(timestamps[0])
+        self.last = float(timestamps[-1])
+        self.gaps += len(gaps)
+        self.gap_s += float(gaps.sum())
+        self.max_gap_s = max(self.max_gap_s, float(gaps.max(initial=0.0)))
+        self.distance.add_array(np.asarray(distances, dtype=np.float64))
+        self.signal_quality.update(dict(zip(*np.unique(signal_quality, return_counts=True))))
+
+    def merge(self, other: 'TlogStats'):
+        """
+        Combine the stats of another tlog, the gap between tlogs is not counted
+        """
+        self.distance.merge(other.distance)
+        self.signal_quality.update(other.signal_quality)
+        self.gaps += other.gaps
+        self.gap_s += other.gap_s
+        self.max_gap_s = max(self.max_gap_s, other.max_gap_s)
+        self.bad_bytes += other.bad_bytes
+
+    def signal_quality_bins(self) -> list[tuple[str, int]]:
+        """
+        0 (unknown), 1-9, 10-19, ... 90-99 and 100
+        """
+        bins = [('0', self.signal_quality[0])]
+        for low in range(0, 100, 10):
+            low = max(low, 1)
+            high = low - low % 10 + 9
+            bins.append((f'{low}-{high}', sum(self.signal_quality[sq] for sq in range(low, high + 1))))
+        bins.append(('100', self.signal_quality[100]))
+        return bins
+
+    def print(self, seconds: float):
+        count = self.distance.count
+        print(f'Found {count} DISTANCE_SENSOR messages over {seconds} seconds, {count / seconds :.2f} Hz')
+        print(f'Mean {self.distance.mean :.2f}, stdev {self.distance.stdev() :.2f}')
+        print(f'{self.gaps} gaps, {self.gap_s :.2f} seconds total, longest {self.max_gap_s :.2f} seconds')
+        print('signal_quality: ' + ', '.join(f'{label}: {n / count :.1%}' for label, n in self.signal_quality_bins()
+                                             if n > 0))
+        if self.bad_bytes:
+            print(f'Skipped {self.bad_bytes} bad bytes')
+
+
+def scan_tlog(path: str, start: float, stop: float, gap_s: float) -> TlogStats:
+    """
+    Scan a tlog, decoding only the DISTANCE_SENSOR packets between start and stop
+    """
+    stats = TlogStats(path)
+    mav = mavutil.mavlink.MAVLink(None)
+    msg_id = mavutil.mavlink.MAVLINK_MSG_ID_DISTANCE_SENSOR
+
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        scanner = TlogScanner(data)
+        for timestamp, packet_id, packet in scanner.packets():
+            if timestamp >= stop:
+                break
+            if packet_id == msg_id and timestamp > start:
+                try:
+                    msg = mav.decode(bytearray(packet))
+                except mavutil.mavlink.MAVError:
+                    scanner.reject()
+                    continue
+                stats.add(timestamp, msg.current_distance, msg.signal_quality, gap_s)
+        stats.bad_bytes = scanner.bad_bytes
+
+    return stats
+
+
+def cached_stats(path: str, start: float, stop: float, gap_s: float, cache_dir: str) -> TlogStats:
+    """
+    Same as scan_tlog(), but slice the columns from the tlog cache, converting the tlog the first time
+    """
+    stats = TlogStats(path)
+    columns = TlogCache(path, cache_dir).query('DISTANCE_SENSOR', start, stop, ['current_distance', 'signal_quality'])
+    if columns and len(columns['timestamp']):
+        stats.add_columns(columns['timestamp'], columns['current_distance'], columns['signal_quality'], gap_s)
+    return stats
+
 
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('start', type=float, help='start timestamp')
     parser.add_argument('stop', type=float, help='end timestamp')
     parser.add_argument('path', nargs='+', type=str, help='tlog file')
+    parser.add_argument('--gap', type=float, default=DEFAULT_GAP_S,
+                        help=f'report gaps longer than this, default {DEFAULT_GAP_S} seconds')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='tlogs to scan in parallel, default #cores')
+    parser.add_argument('--cache', action='store_true', help='use the tlog cache, see tlog_cache.py')
+    parser.add_argument('--cache-dir', type=str, default=DEFAULT_CACHE_DIR, help=f'default {DEFAULT_CACHE_DIR}')
     args = parser.parse_args()
 
-    for path in args.path:
-        print(f'Reading {path}')
-        mlog = mavutil.mavlink_connection(path, dialect='ardupilotmega')
-
-        distances = []
-        while msg := mlog.recv_match(type='DISTANCE_SENSOR', blocking=False):
-            timestamp = getattr(msg, '_timestamp', 0.0)
-            if args.start < timestamp < args.stop:
-                distances.append(msg.current_distance)
+    seconds = args.stop - args.start
+    total = TlogStats('all')
 
-        if len(distances) == 0:
-            print(f'No DISTANCE_SENSOR messages found between {args.start} and {args.stop}')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(args.jobs, len(args.path))) as executor:
+        n = len(args.path)
+        if args.cache:
+            results = executor.map(cached_stats, args.path, [args.start] * n, [args.stop] * n, [args.gap] * n,
+                                   [args.cache_dir] * n)
         else:
-            xbar = statistics.mean(distances)
-            seconds = args.stop - args.start
-            print(f'Found {len(distances)} DISTANCE_SENSOR messages over {seconds} seconds, {len(distances) / seconds :.2f} Hz')
-            print(f'Mean {xbar :.2f}, stdev {statistics.stdev(distances, xbar) :.2f}')
+            results = executor.map(scan_tlog, args.path, [args.start] * n, [args.stop] * n, [args.gap] * n)
+        for stats in results:
+            print(f'Reading {stats.path}')
+            if stats.distance.count == 0:
+                print(f'No DISTANCE_SENSOR messages found between {args.start} and {args.stop}')
+            else:
+                stats.print(seconds)
+                total.merge(stats)
+
+    if len(args.path) > 1 and total.distance.count > 0:
+        print('All tlogs')
+        total.print(seconds * len(args.path))
 
 
 if __name__ == '__main__':
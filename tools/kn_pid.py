@@ -2,13 +2,32 @@
 
 """
 Compute PID coefficients per https://en.wikipedia.org/wiki/Ziegler%E2%80%93Nichols_method
+
+tune.py measures Ku and Tu in SITL and uses the same rules.
 """
 
 from argparse import ArgumentParser
 
+# Control type: (P, I, D) coefficients
+RULES = {
+    'Classic': (0.6, 1.2, 0.075),
+    'Some overshoot': (0.33, 0.66, 0.11),
+    'No overshoot': (0.2, 0.4, 0.066),
+    'PD': (0.8, 0.0, 0.1),
+}
+
+
+def zn_gains(ku: float, tu: float, rule: str) -> tuple[float, float, float]:
+    """
+    P, I and D gains for the ultimate gain Ku and oscillation period Tu
+    """
+    kpc, kic, kdc = RULES[rule]
+    return kpc * ku, kic * ku / tu, kdc * ku * tu
+
 
-def print_gains(ku, tu, name: str, kpc, kic, kdc):
-    print(f'{name :20}{kpc * ku :6.2f}{kic * ku / tu :6.2f}{kdc * ku * tu :6.2f}')
+def print_gains(ku, tu, name: str):
+    kp, ki, kd = zn_gains(ku, tu, name)
+    print(f'{name :20}{kp :6.2f}{ki :6.2f}{kd :6.2f}')
 
 
 def main():
@@ -18,10 +37,8 @@ def main():
     args = parser.parse_args()
 
     print(f'{"Control type" :20}{"P" :^6}{"I" :^6}{"D" :^6}')
-    print_gains(args.Ku, args.Tu, 'Classic', 0.6, 1.2, 0.075)
-    print_gains(args.Ku, args.Tu, 'Some overshoot', 0.33, 0.66, 0.11)
-    print_gains(args.Ku, args.Tu, 'No overshoot', 0.2, 0.4, 0.066)
-    print_gains(args.Ku, args.Tu, 'PD', 0.8, 0.0, 0.1)
+    for name in RULES:
+        print_gains(args.Ku, args.Tu, name)
 
 
 if __name__ == '__main__':
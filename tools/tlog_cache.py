@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+"""
+Convert tlogs to columnar numpy files, so repeated queries don't decode the whole log again.
+
+Each tlog is decoded once and split by message type. Every field becomes a .npy file, plus a timestamp column sorted
+in time order, under <cache dir>/<sha256 of the tlog>/<message type>/. A query for a time window memory-maps the
+columns and slices them with a binary search on the timestamps.
+
+The cache is keyed by the content hash, so a copied or renamed tlog is not converted again, and a modified tlog is.
+The hash of a file is remembered by (path, size, mtime), so it is only computed once.
+
+Example, convert several tlogs in parallel:
+    tlog_cache.py build *.tlog
+
+Example, print the DISTANCE_SENSOR readings in a time window:
+    tlog_cache.py query 2024-02-29.tlog DISTANCE_SENSOR --start 1709233200 --stop 1709233500 \\
+        --fields current_distance signal_quality
+
+Example, in Python:
+    from tlog_cache import TlogCache
+    columns = TlogCache('2024-02-29.tlog').query('DISTANCE_SENSOR', start, stop)
+    columns['timestamp'], columns['current_distance'], ...
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+from typing import Iterator, Optional
+
+import numpy as np
+
+# Use MAVLink2 wire protocol, must include this before importing pymavlink.mavutil
+os.environ['MAVLINK20'] = '1'
+
+from pymavlink import mavutil
+
+mavutil.set_dialect('ardupilotmega')
+
+MAGIC_V1 = 0xFE
+MAGIC_V2 = 0xFD
+
+# Bump this if the layout of the cache changes
+CACHE_VERSION = 1
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'ardusub_surftrak', 'tlog')
+
+INDEX_FILE = 'index.json'
+HASHES_FILE = 'hashes.json'
+
+
+class TlogScanner:
+    """
+    Walk the records of a tlog: a big-endian timestamp in microseconds followed by a MAVLink packet.
+
+    Only the packet header is read, so the caller can decide which packets to decode. If a packet turns out to be bad,
+    call reject() and the scan resumes at the next byte.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.ofs = 0
+        self.next_ofs = 0
+        self.bad_bytes = 0
+
+    def reject(self):
+        self.bad_bytes += 1
+        self.next_ofs = self.ofs + 1
+
+    def packets(self) -> Iterator[tuple[float, int, bytes]]:
+        """
+        Yield (timestamp, message id, packet) for each record
+        """
+        data = self.data
+        while self.ofs + 10 <= len(data):
+            magic = data[self.ofs + 8]
+            if magic == MAGIC_V2:
+                if self.ofs + 11 > len(data):
+                    # Truncated header, need the incompat flags to know the length
+                    break
+                length = 10 + data[self.ofs + 9] + 2 + (mavutil.mavlink.MAVLINK_SIGNATURE_BLOCK_LEN
+                                                        if data[self.ofs + 10] & mavutil.mavlink.MAVLINK_IFLAG_SIGNED
+                                                        else 0)
+                id_ofs, id_len = 15, 3
+            elif magic == MAGIC_V1:
+                length = 6 + data[self.ofs + 9] + 2
+                id_ofs, id_len = 13, 1
+            else:
+                # Lost sync, try the next byte
+                self.bad_bytes += 1
+                self.ofs += 1
+                continue
+
+            if self.ofs + 8 + length > len(data):
+                break
+
+            timestamp = struct.unpack_from('>Q', data, self.ofs)[0] * 1e-6
+            packet_id = int.from_bytes(data[self.ofs + id_ofs:self.ofs + id_ofs + id_len], 'little')
+            self.next_ofs = self.ofs + 8 + length
+            yield timestamp, packet_id, data[self.ofs + 8:self.ofs + 8 + length]
+            self.ofs = self.next_ofs
+
+
+def file_hash(path: str) -> str:
+    """
+    Hash in chunks, tlogs can be larger than memory
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def convert(path: str, out_dir: str):
+    """
+    Decode every message in a tlog and write the columns to out_dir
+    """
+    mav = mavutil.mavlink.MAVLink(None)
+    timestamps = collections.defaultdict(list)
+    columns = collections.defaultdict(lambda: collections.defaultdict(list))
+    unknown = 0
+
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        scanner = TlogScanner(data)
+        for timestamp, _, packet in scanner.packets():
+            try:
+                msg = mav.decode(bytearray(packet))
+            except mavutil.mavlink.MAVError:
+                scanner.reject()
+                continue
+            msg_type = msg.get_type()
+            if msg_type == 'UNKNOWN':
+                unknown += 1
+                continue
+            timestamps[msg_type].append(timestamp)
+            msg_columns = columns[msg_type]
+            for field in msg.get_fieldnames():
+                msg_columns[field].append(getattr(msg, field))
+
+    # Write to a temporary directory and rename it, so a failed conversion is never mistaken for a good one
+    tmp_dir = out_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    index = {'version': CACHE_VERSION, 'source': os.path.abspath(path), 'bad_bytes': scanner.bad_bytes,
+             'unknown': unknown, 'types': {}}
+    for msg_type, msg_timestamps in timestamps.items():
+        type_dir = os.path.join(tmp_dir, msg_type)
+        os.makedirs(type_dir)
+        ts = np.asarray(msg_timestamps, dtype=np.float64)
+
+        # A tlog is almost always in time order, but the queries depend on it
+        order = np.argsort(ts, kind='stable')
+        np.save(os.path.join(type_dir, 'timestamp.npy'), ts[order])
+        for field, values in columns[msg_type].items():
+            np.save(os.path.join(type_dir, f'{field}.npy'), np.asarray(values)[order])
+
+        index['types'][msg_type] = {'count': len(ts), 'fields': list(columns[msg_type]),
+                                    'start': float(ts.min()), 'stop': float(ts.max())}
+
+    with open(os.path.join(tmp_dir, INDEX_FILE), 'w') as f:
+        json.dump(index, f, indent=2)
+
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.rename(tmp_dir, out_dir)
+
+
+class TlogCache:
+    """
+    The columns of one tlog, converted on first use
+    """
+
+    def __init__(self, path: str, cache_dir: str = DEFAULT_CACHE_DIR):
+        self.path = path
+        self.cache_dir = cache_dir
+        self.dir = os.path.join(cache_dir, self.content_hash())
+
+        index_path = os.path.join(self.dir, INDEX_FILE)
+        self.index = None
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self.index = json.load(f)
+        if self.index is None or self.index.get('version') != CACHE_VERSION:
+            print(f'Converting {path}')
+            convert(path, self.dir)
+            with open(index_path) as f:
+                self.index = json.load(f)
+
+    def content_hash(self) -> str:
+        """
+        Look up the hash by (path, size, mtime), compute and remember it if the file is new or changed
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        hashes_path = os.path.join(self.cache_dir, HASHES_FILE)
+        key = json.dumps([os.path.abspath(self.path), os.path.getsize(self.path), os.path.getmtime(self.path)])
+
+        hashes = {}
+        try:
+            with open(hashes_path) as f:
+                hashes = json.load(f)
+        except (OSError, ValueError):
+            pass
+        if key not in hashes:
+            hashes[key] = file_hash(self.path)
+            # Several workers may convert at once, write a private file and rename it
+            tmp_path = f'{hashes_path}.{os.getpid()}'
+            with open(tmp_path, 'w') as f:
+                json.dump(hashes, f, indent=2)
+            os.replace(tmp_path, hashes_path)
+        return hashes[key]
+
+    def types(self) -> dict:
+        return self.index['types']
+
+    def query(self, msg_type: str, start: Optional[float] = None, stop: Optional[float] = None,
+              fields: Optional[list[str]] = None) -> dict[str, np.ndarray]:
+        """
+        Memory-mapped columns of one message type with start < timestamp < stop, empty if there are none
+        """
+        if msg_type not in self.index['types']:
+            return {}
+        type_dir = os.path.join(self.dir, msg_type)
+
+        timestamp = np.load(os.path.join(type_dir, 'timestamp.npy'), mmap_mode='r')
+        lo = 0 if start is None else np.searchsorted(timestamp, start, side='right')
+        hi = len(timestamp) if stop is None else np.searchsorted(timestamp, stop, side='left')
+
+        columns = {'timestamp': timestamp[lo:hi]}
+        for field in fields or self.index['types'][msg_type]['fields']:
+            columns[field] = np.load(os.path.join(type_dir, f'{field}.npy'), mmap_mode='r')[lo:hi]
+        return columns
+
+
+def build(path: str, cache_dir: str) -> tuple[str, dict]:
+    return path, TlogCache(path, cache_dir).types()
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('--cache-dir', type=str, default=DEFAULT_CACHE_DIR, help=f'default {DEFAULT_CACHE_DIR}')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='convert tlogs, print the message counts')
+    build_parser.add_argument('path', nargs='+', type=str, help='tlog file')
+    build_parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='tlogs to convert in parallel')
+
+    query_parser = subparsers.add_parser('query', help='print one message type as csv')
+    query_parser.add_argument('path', type=str, help='tlog file')
+    query_parser.add_argument('type', type=str, help='message type, e.g., DISTANCE_SENSOR')
+    query_parser.add_argument('--start', type=float, default=None, help='start timestamp')
+    query_parser.add_argument('--stop', type=float, default=None, help='end timestamp')
+    query_parser.add_argument('--fields', nargs='+', default=None, help='fields, default all')
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(args.jobs, len(args.path))) as executor:
+            for path, types in executor.map(build, args.path, [args.cache_dir] * len(args.path)):
+                print(f'{path}: ' + ', '.join(f'{name} {info["count"]}' for name, info in sorted(types.items())))
+    else:
+        cache = TlogCache(args.path, args.cache_dir)
+        columns = cache.query(args.type, args.start, args.stop, args.fields)
+        if not columns:
+            print(f'No {args.type} messages in {args.path}', file=sys.stderr)
+            sys.exit(1)
+        print(','.join(columns))
+        for row in zip(*[column.tolist() for column in columns.values()]):
+            print(','.join(str(value) for value in row))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+"""
+Tune a depth PID loop in SITL, unattended.
+
+1. Gain ramp: run the vehicle on flat terrain with I = D = 0 and a range of P gains, several simulations at a time.
+   The smallest P that makes the climb rate (CTUN.CRt) oscillate is the ultimate gain Ku, the period of the
+   oscillation is Tu. The ramp is repeated between the last quiet P and the first oscillating P to narrow down Ku.
+2. Ziegler-Nichols: Ku and Tu give the starting gains, see tools/kn_pid.py.
+3. Search: a grid of multiples of the starting gains is run on the test terrains and scored with a KPI from
+   metrics.py, averaged over the terrains. Each round zooms in around the best candidate.
+4. The best gains are written to a params file, on top of the base params file.
+
+A run oscillates if the RMS climb rate is above --min-amplitude and one frequency (with its neighbors) carries at
+least --min-peak of the power, ignoring periods over MAX_PERIOD_S. Measurement noise alone makes a small, broadband
+climb rate.
+
+Every run is kept under results/tune/<loop>/, with its params file in params/.
+
+Example, tune the acceleration PID, 8 simulations at a time:
+    tune.py --loop accz --jobs 8 --out params/tuned.params
+
+Example, only measure Ku and Tu:
+    tune.py --loop velz --ramp-only
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from sweep import Run, add_run_arguments, execute
+from tools.kn_pid import RULES, zn_gains
+
+# P, I and D parameters of each loop, and the range of the first gain ramp
+LOOPS = {
+    'accz': (('PSC_ACCZ_P', 'PSC_ACCZ_I', 'PSC_ACCZ_D'), (0.25, 8.0)),
+    'velz': (('PSC_VELZ_P', 'PSC_VELZ_I', 'PSC_VELZ_D'), (1.0, 40.0)),
+}
+
+# Oscillation detector defaults
+MIN_AMPLITUDE_CMS = 10.0
+MIN_PEAK = 0.3
+
+# Slower motion follows the terrain or the mission, it isn't a loop oscillation
+MAX_PERIOD_S = 20.0
+
+# ArduPilot parameter type for floats
+PARAM_TYPE_FLOAT = 9
+
+
+def oscillation(df: pd.DataFrame) -> tuple[float, float, float]:
+    """
+    RMS climb rate (cm/s), the share of the power in the strongest frequency, and the period of that frequency (s).
+    Measured while SURFTRAK has a rangefinder target, or over the second half of the run.
+    """
+    df = df.sort_values('TimeUS', kind='stable')
+    df = df[df['CRt'].notna()]
+    tracking = df['DSAlt'].to_numpy() > 0 if 'DSAlt' in df else np.zeros(len(df), dtype=bool)
+    df = df[tracking] if tracking.sum() > 20 else df.iloc[len(df) // 2:]
+    if len(df) < 20:
+        return 0.0, 0.0, float('nan')
+
+    t = df['TimeUS'].to_numpy(dtype=np.float64) * 1e-6
+    crt = df['CRt'].to_numpy(dtype=np.float64)
+    crt -= crt.mean()
+
+    # CTUN rows are close to evenly spaced, resample to be sure
+    dt = float(np.median(np.diff(t)))
+    grid = np.arange(t[0], t[-1], dt)
+    power = np.abs(np.fft.rfft(np.interp(grid, t, crt))) ** 2
+    power[np.fft.rfftfreq(len(grid), dt) < 1.0 / MAX_PERIOD_S] = 0.0
+    if power.sum() == 0.0:
+        return 0.0, 0.0, float('nan')
+    peak = int(np.argmax(power))
+    share = power[max(peak - 1, 0):peak + 2].sum() / power.sum()
+    period = 1.0 / np.fft.rfftfreq(len(grid), dt)[peak]
+    return float(np.sqrt(np.mean(crt ** 2))), float(share), float(period)
+
+
+def write_params(base: str, path: str, values: dict[str, float], comment: str):
+    """
+    Copy the base params file, replacing or appending the values
+    """
+    remaining = dict(values)
+    lines = []
+    with open(base) as f:
+        for line in f:
+            fields = line.split()
+            if not line.startswith('#') and len(fields) >= 5 and fields[2] in remaining:
+                fields[3] = f'{remaining.pop(fields[2]):.6g}'
+                line = '\t'.join(fields) + '\n'
+            lines.append(line)
+
+    if not lines[-1].endswith('\n'):
+        lines[-1] += '\n'
+    lines.append(f'\n# {comment}\n')
+    lines += [f'1\t1\t{name}\t{value:.6g}\t{PARAM_TYPE_FLOAT}\n' for name, value in remaining.items()]
+    with open(path, 'w') as f:
+        f.writelines(lines)
+
+
+class Tuner:
+    """
+    Run batches of candidate gains in SITL and collect the results
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.names, self.ramp_range = LOOPS[args.loop]
+        self.base = os.path.abspath(args.params)
+        self.dir = os.path.abspath(os.path.join(args.results, args.loop))
+        os.makedirs(os.path.join(self.dir, 'params'), exist_ok=True)
+
+    def run(self, stage: str, candidates: list[tuple[float, float, float]],
+            terrains: list[str]) -> list[list[Optional[str]]]:
+        """
+        Simulate each candidate (P, I, D) on each terrain, return the run directories, None if the run failed
+        """
+        runs = []
+        for i, gains in enumerate(candidates):
+            name = f'{stage}_{i :03}'
+            params = os.path.join(self.dir, 'params', f'{name}.params')
+            write_params(self.base, params, dict(zip(self.names, gains)),
+                         f'tune.py {stage}: ' + ', '.join(f'{n}={g :.4g}' for n, g in zip(self.names, gains)))
+            runs += [Run(os.path.join(self.dir, name, terrain), terrain, params, self.args.mode, self.args.seed,
+                         self.args) for terrain in terrains]
+
+        failed = {run.log_dir for run in execute(runs, self.args)}
+        log_dirs = [None if run.log_dir in failed else run.log_dir for run in runs]
+        return [log_dirs[i:i + len(terrains)] for i in range(0, len(log_dirs), len(terrains))]
+
+    def oscillates(self, log_dir: Optional[str]) -> tuple[bool, float]:
+        """
+        True if the run oscillated, and the period
+        """
+        if log_dir is None:
+            return False, float('nan')
+        amplitude, share, period = oscillation(pd.read_csv(os.path.join(log_dir, 'merged.csv')))
+        print(f'{log_dir}: climb rate RMS {amplitude :.1f}cm/s, peak {share :.0%} at {period :.2f}s')
+        return amplitude >= self.args.min_amplitude and share >= self.args.min_peak, period
+
+    def ultimate_gain(self) -> tuple[float, float]:
+        """
+        Find Ku and Tu with a gain ramp, then narrow the ramp
+        """
+        low, high = self.ramp_range
+        gains = np.geomspace(low, high, self.args.ramp)
+        quiet = None
+        for r in range(self.args.ramp_rounds):
+            results = [self.oscillates(log_dirs[0])
+                       for log_dirs in self.run(f'ramp{r}', [(p, 0.0, 0.0) for p in gains], ['zeros'])]
+            first = next((i for i, (oscillates, _) in enumerate(results) if oscillates), None)
+            if first is None:
+                if quiet is None:
+                    print(f'No oscillation for {self.names[0]} up to {gains[-1] :.4g}, raise the ramp range')
+                    sys.exit(1)
+                # The narrow ramp missed, keep the previous result
+                break
+            ku, tu = float(gains[first]), results[first][1]
+            if first > 0:
+                quiet = float(gains[first - 1])
+            elif quiet is None:
+                quiet = ku / 2.0
+            # Otherwise Ku is between the previous quiet gain and the first gain of this ramp, keep the quiet bound
+            print(f'Ramp {r + 1}: Ku between {quiet :.4g} and {ku :.4g}, Tu {tu :.2f}s')
+            gains = np.linspace(quiet, ku, self.args.ramp + 2)[1:-1].tolist() + [ku]
+        return ku, tu
+
+    def score(self, log_dirs: list[Optional[str]]) -> float:
+        """
+        The KPI averaged over the terrains, infinite if a run failed or the KPI is missing
+        """
+        values = []
+        for log_dir in log_dirs:
+            if log_dir is None:
+                return float('inf')
+            with open(os.path.join(log_dir, 'metrics.json')) as f:
+                value = json.load(f).get(self.args.kpi)
+            if value is None:
+                return float('inf')
+            values.append(value)
+        return float(np.mean(values))
+
+    def search(self, start: tuple[float, float, float]) -> tuple[tuple[float, float, float], float]:
+        """
+        Grid search over multiples of the starting gains, zooming in each round. Gains that start at 0 stay at 0.
+        """
+        best, best_score = start, float('inf')
+        span = self.args.span
+        for r in range(self.args.rounds):
+            factors = np.geomspace(1.0 / span, span, self.args.grid)
+            axes = [factors * g if g > 0 else [0.0] for g in best]
+            candidates = list(itertools.product(*axes))
+            scores = [self.score(log_dirs) for log_dirs in self.run(f'search{r}', candidates, self.args.terrain)]
+            i = int(np.argmin(scores))
+            if scores[i] < best_score:
+                best, best_score = candidates[i], scores[i]
+            print(f'Round {r + 1}: best ' + ', '.join(f'{n}={g :.4g}' for n, g in zip(self.names, best)) +
+                  f', {self.args.kpi} {best_score :.3f}')
+            span = span ** (1.0 / (self.args.grid - 1))
+        return best, best_score
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('--loop', choices=list(LOOPS), default='accz', help='PID loop to tune, default accz')
+    parser.add_argument('--params', type=str, default='params/sitl.params', help='base params file')
+    parser.add_argument('--out', type=str, default='params/tuned.params', help='params file to write')
+    parser.add_argument('--terrain', type=str, nargs='+', default=['trapezoid', 'sawtooth'],
+                        help='terrains to score the candidates on, default trapezoid sawtooth')
+    parser.add_argument('--mode', type=int, default=21, help='mode, default 21 (surftrak)')
+    parser.add_argument('--seed', type=int, default=1, help='noise seed, the same for every run, default 1')
+    parser.add_argument('--ramp', type=int, default=8, help='P gains per ramp, default 8')
+    parser.add_argument('--ramp-rounds', type=int, default=2, help='ramps, default 2')
+    parser.add_argument('--ramp-only', action='store_true', help='measure Ku and Tu, print the ZN gains and stop')
+    parser.add_argument('--ku', type=float, default=None, help='skip the ramp, use this Ku (and --tu)')
+    parser.add_argument('--tu', type=float, default=None, help='skip the ramp, use this Tu')
+    parser.add_argument('--min-amplitude', type=float, default=MIN_AMPLITUDE_CMS,
+                        help=f'min RMS climb rate of an oscillation, default {MIN_AMPLITUDE_CMS}cm/s')
+    parser.add_argument('--min-peak', type=float, default=MIN_PEAK,
+                        help=f'min share of power in the peak frequency of an oscillation, default {MIN_PEAK}')
+    parser.add_argument('--rule', choices=list(RULES), default='Some overshoot',
+                        help='Ziegler-Nichols rule for the starting gains, default "Some overshoot"')
+    parser.add_argument('--grid', type=int, default=3, help='values per gain in each search round, default 3')
+    parser.add_argument('--span', type=float, default=2.0, help='first round searches gain / span to gain * span')
+    parser.add_argument('--rounds', type=int, default=2, help='search rounds, default 2')
+    parser.add_argument('--kpi', type=str, default='rf_error_rms_m', help='KPI in metrics.json to minimize')
+    parser.add_argument('--results', type=str, default='results/tune', help='Results directory')
+    add_run_arguments(parser)
+    args = parser.parse_args()
+
+    # Runs only need metrics.json and merged.csv
+    args.metrics_only = True
+
+    if os.environ.get('ARDUPILOT_HOME') is None:
+        print('Error: ARDUPILOT_HOME is not set')
+        sys.exit(1)
+
+    tuner = Tuner(args)
+    if args.ku is not None and args.tu is not None:
+        ku, tu = args.ku, args.tu
+    else:
+        ku, tu = tuner.ultimate_gain()
+    print(f'Ku {ku :.4g}, Tu {tu :.3f}s')
+
+    start = zn_gains(ku, tu, args.rule)
+    print(f'Ziegler-Nichols "{args.rule}": ' + ', '.join(f'{n}={g :.4g}' for n, g in zip(tuner.names, start)))
+    if args.ramp_only:
+        return
+
+    best, best_score = tuner.search(start)
+    write_params(tuner.base, args.out, dict(zip(tuner.names, best)),
+                 f'tune.py --loop {args.loop}: Ku {ku :.4g}, Tu {tu :.3f}s, {args.kpi} {best_score :.3f} on '
+                 f'{" ".join(args.terrain)}')
+    print(f'{args.out} written')
+
+
+if __name__ == '__main__':
+    main()